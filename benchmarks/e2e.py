@@ -0,0 +1,365 @@
+"""
+End-to-end throughput and latency benchmark.
+
+Drives the publishers -> broker -> BuildingManagementSystem -> measurements
+path at increasing publish rates against a local mosquitto and Postgres, then
+times the dashboard query at several table sizes. Everything is written as
+one JSON document so runs from different versions can be compared:
+
+    python benchmarks/e2e.py --rates 200,1000,5000 --output results.json
+    python benchmarks/e2e.py --baseline results.json   # exit 1 on regressions
+
+Unless --external-subscriber is given, a subscriber process is started from
+subscriber/ with the current environment (INGEST_MODE, BATCH_SIZE, ...) and
+the deadband filter off, so every reading is committed as a row. An external
+subscriber running the filter must be given --subscriber-metrics; readings
+it suppressed are then not counted as lost.
+Publish-to-commit latency is measured by polling for newly committed rows
+and comparing the poll time with the reading's payload timestamp, so it is
+accurate to within --poll-interval. Each query stage also checks that the
+dashboard query returns the same rows as a plan without indexes; wrong
+results count as a regression.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Both services have a payloads.py and metrics.py; loadgen needs the publisher's
+sys.path.insert(0, os.path.join(ROOT, "subscriber"))
+sys.path.insert(0, os.path.join(ROOT, "publishers"))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+import loadgen  # noqa: E402
+from db_models import DB_HOST, DB_NAME, DB_USER, DB_PASSWORD  # noqa: E402
+from partitions import create_partitions  # noqa: E402
+
+# The query behind the dashboard's /zone_data endpoint
+ZONE_DATA_QUERY = text("""
+    SELECT m.id, d.id as device_id, d.device_type, m.value, m.timestamp
+    FROM measurements m
+    JOIN devices d ON m.device_id = d.id
+    WHERE d.zone_id = :zone_id
+    ORDER BY m.timestamp DESC
+    LIMIT 10
+""")
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    pick = lambda pct: values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+    ms = lambda value: round(value * 1000, 3)
+    return {"p50": ms(pick(50)), "p95": ms(pick(95)), "p99": ms(pick(99)), "max": ms(values[-1])}
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class CommitWatcher:
+    """Polls for newly committed measurements and records their publish-to-commit latency
+
+    Ids are assigned when a row is inserted, not when it commits, so a
+    transaction that commits late can make lower ids appear after higher
+    ones were seen. Skipped ids are polled again until they show up or
+    lookback seconds have passed (rolled back inserts leave holes for good).
+    """
+
+    def __init__(self, engine, poll_interval, lookback=30):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.lookback = lookback
+        with engine.connect() as conn:
+            self.last_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM measurements")).scalar()
+        self.gaps = {}  # id below last_id not seen yet -> monotonic time it was skipped
+        self.rows = 0
+        self.latencies = []
+        self.last_commit_seen = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        query = text("SELECT id, timestamp FROM measurements WHERE id > :last_id OR id = ANY(:gaps)")
+        with self.engine.connect() as conn:
+            while not self._stop.is_set():
+                rows = conn.execute(query, {"last_id": self.last_id, "gaps": list(self.gaps)}).fetchall()
+                conn.commit()
+                now = datetime.now()
+                polled = time.monotonic()
+                if rows:
+                    ids = {row[0] for row in rows}
+                    newest = max(ids)
+                    for missing in range(self.last_id + 1, newest):
+                        if missing not in ids:
+                            self.gaps[missing] = polled
+                    for seen in ids:
+                        self.gaps.pop(seen, None)
+                    self.last_id = max(self.last_id, newest)
+                    self.rows += len(rows)
+                    self.last_commit_seen = time.perf_counter()
+                    self.latencies.extend((now - row[1]).total_seconds() for row in rows)
+                for missing, since in list(self.gaps.items()):
+                    if polled - since > self.lookback:
+                        del self.gaps[missing]
+                self._stop.wait(self.poll_interval)
+
+
+def suppressed_readings(urls):
+    """Readings the subscribers' deadband filters kept out of measurements, summed over their /metrics URLs"""
+    total = 0
+    for url in urls:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            for line in response.read().decode().splitlines():
+                if line.startswith("bms_deadband_suppressed_total"):
+                    total += float(line.rsplit(" ", 1)[1])
+    return int(total)
+
+
+def run_ingest_stage(engine, rate, args):
+    """Publish at `rate` readings/sec for the stage duration and measure what gets committed"""
+    metrics_urls = [url for url in (args.subscriber_metrics or "").split(",") if url]
+    suppressed_before = suppressed_readings(metrics_urls)
+    watcher = CommitWatcher(engine, args.poll_interval)
+    watcher.start()
+
+    config = loadgen.load_config(args.loadgen_config, broker=args.broker, port=args.port,
+                                 target_rate=rate, duration=args.stage_duration,
+                                 clients=args.clients, qos=args.qos)
+    config["report_interval"] = min(config["report_interval"], args.stage_duration)
+    start = time.perf_counter()
+    published = loadgen.LoadGenerator(config).run()
+
+    # Let the subscriber drain: wait until no new rows arrive for a while
+    deadline = time.perf_counter() + args.drain_timeout
+    suppressed = 0
+    while time.perf_counter() < deadline:
+        idle_since = watcher.last_commit_seen or start
+        if metrics_urls:
+            suppressed = suppressed_readings(metrics_urls) - suppressed_before
+        if watcher.rows + suppressed >= published["readings"] or time.perf_counter() - idle_since > args.drain_idle:
+            break
+        time.sleep(args.poll_interval)
+    watcher.stop()
+
+    ingest_window = (watcher.last_commit_seen or time.perf_counter()) - start
+    return {
+        "target_rate": rate,
+        "published": published["readings"],
+        "publish_rate": published["achieved_rate"],
+        "publish_ack_latency_ms": published["ack_latency_ms"],
+        "stored": watcher.rows,
+        "suppressed": suppressed,
+        "lost": max(0, published["readings"] - suppressed - watcher.rows),
+        "ingest_rate": round(watcher.rows / ingest_window, 1) if ingest_window > 0 else None,
+        "publish_to_commit_ms": percentiles(watcher.latencies),
+    }
+
+
+def seed_measurements(engine, target_rows, days=30):
+    """Bulk insert synthetic history until the measurements table holds target_rows"""
+    now = datetime.now()
+    try:
+        with engine.begin() as conn:
+            create_partitions(conn, now - timedelta(days=days), now)
+    except Exception as e:
+        # Rows for that range already sit in the default partition; seed into it
+        print(f"Seeding without dedicated partitions: {e.__class__.__name__}", file=sys.stderr)
+
+    with engine.begin() as conn:
+        current = conn.execute(text("SELECT count(*) FROM measurements")).scalar()
+        missing = target_rows - current
+        if missing <= 0:
+            return current
+        conn.execute(text(
+            "INSERT INTO devices (id, zone_id, device_type) VALUES ('temp-benchseed', 1, 'temp') "
+            "ON CONFLICT DO NOTHING"
+        ))
+        conn.execute(text("""
+            INSERT INTO measurements (device_id, timestamp, field, value, unit)
+            SELECT 'temp-benchseed', :now - (g * :step) * interval '1 second', 'temperature', 65 + random() * 20, 'F'
+            FROM generate_series(1, :missing) g
+        """), {"now": now, "step": days * 86400.0 / missing, "missing": missing})
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE measurements"))
+    return target_rows
+
+
+def check_zone_data(conn, zone_ids):
+    """Zones for which the dashboard query returns other rows than the same query run without indexes"""
+    with conn.begin():
+        # One snapshot for both plans, so rows committed in between can't cause a difference
+        conn.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+        planned = {zone_id: [row.timestamp for row in conn.execute(ZONE_DATA_QUERY, {"zone_id": zone_id})]
+                   for zone_id in zone_ids}
+        for setting in ("enable_indexscan", "enable_indexonlyscan", "enable_bitmapscan"):
+            conn.execute(text(f"SET LOCAL {setting} = off"))
+        # Ties on timestamp may come back in any order, so only timestamps are compared
+        return [zone_id for zone_id in zone_ids
+                if planned[zone_id] != [row.timestamp for row in conn.execute(ZONE_DATA_QUERY, {"zone_id": zone_id})]]
+
+
+def run_query_stage(engine, args, label):
+    """Time the dashboard query against the current table and check its results"""
+    with engine.connect() as conn:
+        table_rows = conn.execute(text("SELECT count(*) FROM measurements")).scalar()
+        latencies = []
+        for i in range(args.query_repeats):
+            start = time.perf_counter()
+            conn.execute(ZONE_DATA_QUERY, {"zone_id": i % 3 + 1}).fetchall()
+            latencies.append(time.perf_counter() - start)
+        conn.commit()
+        mismatched = check_zone_data(conn, [1, 2, 3])
+    result = {"label": label, "table_rows": table_rows, "zone_data_query_ms": percentiles(latencies),
+              "correct": not mismatched, "mismatched_zones": mismatched}
+
+    if args.frontend_url:
+        import urllib.parse
+        import urllib.request
+        http_latencies = []
+        for i in range(args.query_repeats):
+            body = urllib.parse.urlencode({"zone_id": i % 3 + 1}).encode()
+            start = time.perf_counter()
+            with urllib.request.urlopen(args.frontend_url.rstrip("/") + "/zone_data", data=body, timeout=30) as response:
+                response.read()
+            http_latencies.append(time.perf_counter() - start)
+        result["zone_data_http_ms"] = percentiles(http_latencies)
+    return result
+
+
+def start_subscriber(args):
+    # Lost readings are published minus committed rows, which only holds if every reading becomes a row
+    env = dict(os.environ, MQTT_BROKER=args.broker, MQTT_PORT=str(args.port), DEADBAND_FILTER="0")
+    process = subprocess.Popen(
+        [sys.executable, "-c", "import BMS; BMS.BuildingManagementSystem().run()"],
+        cwd=os.path.join(ROOT, "subscriber"), env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.STDOUT if not args.verbose else None,
+    )
+    time.sleep(args.subscriber_warmup)
+    if process.poll() is not None:
+        raise RuntimeError(f"Subscriber exited with code {process.returncode}")
+    return process
+
+
+def compare(results, baseline, tolerance):
+    """List metrics that regressed by more than tolerance (fraction) versus the baseline"""
+    regressions = []
+    base_ingest = {stage["target_rate"]: stage for stage in baseline.get("ingest", [])}
+    for stage in results["ingest"]:
+        base = base_ingest.get(stage["target_rate"])
+        if not base:
+            continue
+        if base["ingest_rate"] and stage["ingest_rate"] is not None and \
+                stage["ingest_rate"] < base["ingest_rate"] * (1 - tolerance):
+            regressions.append(f"ingest_rate@{stage['target_rate']}: {base['ingest_rate']} -> {stage['ingest_rate']}")
+        base_p99, p99 = base["publish_to_commit_ms"]["p99"], stage["publish_to_commit_ms"]["p99"]
+        if base_p99 and p99 is not None and p99 > base_p99 * (1 + tolerance):
+            regressions.append(f"publish_to_commit_p99@{stage['target_rate']}: {base_p99} -> {p99}")
+    for stage in results["query"]:
+        if not stage["correct"]:
+            regressions.append(f"zone_data_results@{stage['label']}: wrong rows for zones {stage['mismatched_zones']}")
+    # Stages are matched by what they measured, e.g. "after-ingest@500" or "seeded@1000000"
+    base_query = {stage.get("label"): stage for stage in baseline.get("query", [])}
+    for stage in results["query"]:
+        base = base_query.get(stage["label"])
+        if not base:
+            continue
+        base_p99, p99 = base["zone_data_query_ms"]["p99"], stage["zone_data_query_ms"]["p99"]
+        if base_p99 and p99 is not None and p99 > base_p99 * (1 + tolerance):
+            regressions.append(f"zone_data_query_p99@{stage['label']}: {base_p99} -> {p99}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", default=os.environ.get("MQTT_BROKER", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("MQTT_PORT", 1883)))
+    parser.add_argument("--rates", default="100,500,1000,2000", help="comma separated publish rates (readings/sec)")
+    parser.add_argument("--stage-duration", type=float, default=20, help="seconds of publishing per rate")
+    parser.add_argument("--loadgen-config", help="publisher load generator config (device fleet)")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--qos", type=int, default=1, choices=[0, 1, 2])
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="seconds between commit polls")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="max seconds to wait for the backlog")
+    parser.add_argument("--drain-idle", type=float, default=5, help="stop waiting after this long without new rows")
+    parser.add_argument("--table-sizes", default="", help="comma separated row counts to seed and query at")
+    parser.add_argument("--query-repeats", type=int, default=200)
+    parser.add_argument("--frontend-url", help="also time /zone_data over HTTP")
+    parser.add_argument("--external-subscriber", action="store_true", help="don't start a subscriber")
+    parser.add_argument("--subscriber-metrics",
+                        help="comma separated /metrics URLs of an external subscriber running the deadband filter")
+    parser.add_argument("--subscriber-warmup", type=float, default=5)
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression as a fraction")
+    parser.add_argument("--verbose", action="store_true", help="show subscriber output")
+    args = parser.parse_args()
+
+    engine = create_engine(f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}")
+    subscriber = None if args.external_subscriber else start_subscriber(args)
+    results = {
+        "version": git_version(),
+        "started_at": datetime.now().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "subscriber_env": {key: os.environ[key] for key in
+                           ("INGEST_MODE", "BATCH_SIZE", "FLUSH_INTERVAL", "BMS_WORKERS") if key in os.environ},
+        "ingest": [],
+        "query": [],
+    }
+    try:
+        for rate in [float(r) for r in args.rates.split(",") if r]:
+            stage = run_ingest_stage(engine, rate, args)
+            print(f"rate {rate:>8.0f}: ingest {stage['ingest_rate']} readings/s, "
+                  f"commit p99 {stage['publish_to_commit_ms']['p99']} ms, lost {stage['lost']}", file=sys.stderr)
+            results["ingest"].append(stage)
+            results["query"].append(run_query_stage(engine, args, f"after-ingest@{rate:g}"))
+    finally:
+        if subscriber is not None:
+            subscriber.terminate()
+            subscriber.wait()
+
+    for size in [int(s) for s in args.table_sizes.split(",") if s]:
+        seed_measurements(engine, size)
+        stage = run_query_stage(engine, args, f"seeded@{size}")
+        print(f"{stage['table_rows']:>10} rows: zone_data p99 {stage['zone_data_query_ms']['p99']} ms"
+              f"{'' if stage['correct'] else ', WRONG RESULTS'}", file=sys.stderr)
+        results["query"].append(stage)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        exit_code = 1 if regressions else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Memory and CPU cost of simulated publisher devices.
+
+Builds the same fleet as one Device object per sensor (devices.py) and as
+an array-backed Fleet (fleet.py), then reports the memory allocated per
+device and the CPU time needed to produce each message, covering topic,
+value and payload, without a broker, as JSON.
+
+    python benchmarks/fleet.py --devices 100000 --messages 200000
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "publishers"))
+
+from devices import TemperatureSensor, HumiditySensor, CO2Sensor  # noqa: E402
+from fleet import Fleet  # noqa: E402
+from payloads import encode_readings  # noqa: E402
+
+SENSOR_TYPES = {"temperature": TemperatureSensor, "humidity": HumiditySensor, "co2": CO2Sensor}
+
+
+def buildings_config(devices):
+    """One building with 20 sensors per zone, split like loadgen.json"""
+    zones = max(1, devices // 20)
+    return [{"id": "hyatt-place", "zones": zones, "devices_per_zone": {"temperature": 10, "humidity": 5, "co2": 5}}]
+
+
+def build_objects(buildings):
+    """One Device object per sensor, the way the load generator used to build its fleet"""
+    devices = []
+    next_id = 1
+    for building in buildings:
+        for zone_id in range(1, building["zones"] + 1):
+            for field, count in building["devices_per_zone"].items():
+                for _ in range(count):
+                    device = SENSOR_TYPES[field](next_id, zone_id=zone_id)
+                    device.building_id = building["id"]
+                    devices.append(device)
+                    next_id += 1
+    return devices
+
+
+def measure_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    built = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, current
+
+
+def cpu_per_message(produce, messages, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.process_time()
+        produce(messages)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=100, help="readings per envelope for the struct rows")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    buildings = buildings_config(args.devices)
+    objects, object_bytes = measure_memory(lambda: build_objects(buildings))
+    fleet, fleet_bytes = measure_memory(lambda: Fleet.from_buildings(buildings))
+    n = len(fleet)
+
+    # Both sweep the fleet, one new value per device per sweep, and return the bytes produced
+    def objects_json(messages):
+        produced = done = 0
+        while done < messages:
+            # generate_message() draws the device's next value itself, the counterpart of fleet.advance()
+            for index in range(min(n, messages - done)):
+                d = objects[index]
+                topic = f"{d.building_id}/sensors/zone{d._zone_id}/{d._measurement_info['field']}"
+                produced += len(topic) + len(d.generate_message())
+            done += n
+        return produced
+
+    def fleet_json(messages):
+        produced = done = 0
+        while done < messages:
+            fleet.advance()
+            for index in range(min(n, messages - done)):
+                produced += len(fleet.topic(index)) + len(fleet.message(index))
+            done += n
+        return produced
+
+    def objects_struct(messages):
+        for start in range(0, messages, args.batch_size):
+            batch = [objects[i % n].generate_reading() for i in range(start, min(messages, start + args.batch_size))]
+            encode_readings(batch, "struct")
+
+    def fleet_struct(messages):
+        done = 0
+        while done < messages:
+            fleet.advance()
+            for start in range(0, min(n, messages - done), args.batch_size):
+                encode_readings(fleet.readings(slice(start, min(n, messages - done, start + args.batch_size))), "struct")
+            done += n
+
+    results = []
+    for name, memory, produce_json, produce_struct in (
+            ("objects", object_bytes, objects_json, objects_struct),
+            ("fleet", fleet_bytes, fleet_json, fleet_struct)):
+        results.append({
+            "representation": name,
+            "devices": n,
+            "bytes_per_device": round(memory / n, 1),
+            "json_us_per_message": round(cpu_per_message(produce_json, args.messages, args.repeats) * 1e6, 3),
+            "struct_us_per_reading": round(cpu_per_message(produce_struct, args.messages, args.repeats) * 1e6, 3),
+        })
+        r = results[-1]
+        print(f"{name:>8}: {r['bytes_per_device']:>7} bytes/device, {r['json_us_per_message']:>6} us/JSON message, "
+              f"{r['struct_us_per_reading']:>6} us/reading in struct batches", file=sys.stderr)
+
+    start = time.process_time()
+    for _ in range(args.repeats):
+        fleet.advance()
+    results.append({"advance_us_per_device": round((time.process_time() - start) / args.repeats / n * 1e6, 4)})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Wire size and parse cost of the sensor payload formats.
+
+Encodes the same readings as the original one-JSON-object-per-message format
+and as the compact formats (JSON/msgpack/struct batch envelopes), then decodes
+them the way the subscriber does and reports bytes on the wire and decode CPU
+time per reading as JSON.
+
+    python benchmarks/payloads.py --readings 20000 --batch-size 100
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "publishers"))
+
+from devices import TemperatureSensor, HumiditySensor, CO2Sensor  # noqa: E402
+
+
+def load_module(name, path):
+    # Both services call their module payloads.py, so load each one by path
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+publisher_payloads = load_module("publisher_payloads", "publishers/payloads.py")
+subscriber_payloads = load_module("subscriber_payloads", "subscriber/payloads.py")
+
+
+class Message:
+    """Minimal stand-in for paho's MQTTMessage"""
+
+    def __init__(self, topic, payload, content_type=None):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else payload.encode()
+        self.properties = type("Properties", (), {"ContentType": content_type})() if content_type else None
+
+
+def build_messages(devices, readings, batch_size, fmt):
+    if fmt == "json-single":
+        return [Message(f"hyatt-place/sensors/zone{d._zone_id}/{d._measurement_info['field']}",
+                        d.generate_message())
+                for d in (devices[i % len(devices)] for i in range(readings))]
+    content_type = publisher_payloads.CONTENT_TYPES[fmt] if fmt != "json" else None
+    messages = []
+    for start in range(0, readings, batch_size):
+        batch = [devices[i % len(devices)].generate_reading() for i in range(start, min(readings, start + batch_size))]
+        messages.append(Message(publisher_payloads.batch_topic("hyatt-place", fmt),
+                                publisher_payloads.encode_readings(batch, fmt), content_type))
+    return messages
+
+
+def decode_all(messages, fmt):
+    count = 0
+    for msg in messages:
+        for reading in subscriber_payloads.decode_readings(msg):
+            if fmt == "json-single":
+                # The original path also parsed the ISO timestamp string
+                datetime.fromisoformat(reading["timestamp"])
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readings", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    devices = [cls(i, zone_id=i % 3 + 1) for i, cls in
+               enumerate([TemperatureSensor, HumiditySensor, CO2Sensor] * 100)]
+    formats = ["json-single", "json", "struct"]
+    if publisher_payloads.msgpack is not None:
+        formats.insert(2, "msgpack")
+
+    results = []
+    for fmt in formats:
+        messages = build_messages(devices, args.readings, args.batch_size, fmt)
+        wire_bytes = sum(len(msg.payload) for msg in messages)
+        best = None
+        for _ in range(args.repeats):
+            start = time.process_time()
+            decoded = decode_all(messages, fmt)
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({
+            "format": fmt,
+            "messages": len(messages),
+            "readings": decoded,
+            "bytes_per_reading": round(wire_bytes / decoded, 1),
+            "decode_us_per_reading": round(best / decoded * 1e6, 3),
+        })
+        print(f"{fmt:>12}: {results[-1]['bytes_per_reading']:>6} bytes/reading, "
+              f"{results[-1]['decode_us_per_reading']:>7} us/reading decode", file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from sqlalchemy import create_engine, desc, text
 from sqlalchemy.orm import sessionmaker
+from cache import TTLCache
+from live import LiveFeed
+from metrics import REQUESTS, REQUEST_SECONDS, collector
+from timeseries import (ARROW_AVAILABLE, ArchivedRangeError, bucket_series, lttb_series, parse_timestamp, stream_arrow,
+                        stream_json)
+from datetime import datetime, timedelta
 import os
+import select
+import threading
 import time
+import psycopg2
 
 app = Flask(__name__)
 
@@ -12,47 +22,291 @@ DB_PASSWORD = os.environ.get('DB_PASSWORD', 'building_password')
 DB_HOST = os.environ.get('DB_HOST', 'postgres')
 DB_NAME = os.environ.get('DB_NAME', 'building_data')
 
-# Create SQLAlchemy engine and session
+# Connection pool settings (per process)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # seconds
+
+# One engine and pool for the lifetime of the process
+engine = create_engine(
+    f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}",
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    pool_recycle=DB_POOL_RECYCLE,
+)
+Session = sessionmaker(bind=engine)
+
+def _reset_pool_after_fork():
+    # Pre-fork servers (gunicorn etc.) fork after import; connections inherited
+    # from the parent must not be shared, so the child starts with an empty pool
+    # without closing the parent's sockets.
+    engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
 def get_db_session():
-    db_url = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
-    engine = create_engine(db_url)
-    Session = sessionmaker(bind=engine)
     return Session()
 
+collector.register("frontend_db_pool", lambda: {
+    "size": engine.pool.size(), "checked_out": engine.pool.checkedout(), "overflow": max(0, engine.pool.overflow())})
+
+# Response caches. Zone metadata barely changes and is kept for minutes;
+# measurement responses live for a couple of seconds, or until the subscriber
+# announces new data for the zone or building on NOTIFY_CHANNEL.
+ZONE_CACHE_TTL = float(os.environ.get('ZONE_CACHE_TTL', 300))  # seconds
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 2))  # seconds
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+NOTIFY_CHANNEL = os.environ.get('NOTIFY_CHANNEL', 'measurements_ingested')
+CACHE_INVALIDATION = os.environ.get('CACHE_INVALIDATION', '1') == '1'
+MAX_ZONE_DATA_LIMIT = 100
+
+zone_cache = TTLCache(maxsize=256, ttl=ZONE_CACHE_TTL)
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+collector.register("frontend_zone_cache", zone_cache.stats, counters=("hits", "misses"))
+collector.register("frontend_response_cache", response_cache.stats, counters=("hits", "misses"))
+
+def load_zones(building_id=None):
+    with get_db_session() as session:
+        if building_id is None:
+            return session.execute(text("SELECT id, name, square_footage FROM zones ORDER BY id")).fetchall()
+        return session.execute(text("SELECT id, name, square_footage FROM zones WHERE building_id = :building_id ORDER BY id"),
+                               {"building_id": building_id}).fetchall()
+
+def load_buildings():
+    """Buildings with their zone and device counts"""
+    with get_db_session() as session:
+        return session.execute(text("""
+        SELECT b.id, b.name,
+               (SELECT count(*) FROM zones z WHERE z.building_id = b.id),
+               (SELECT count(*) FROM devices d WHERE d.building_id = b.id)
+        FROM buildings b
+        ORDER BY b.id
+        """)).fetchall()
+
+def load_building_zones(building_id):
+    """Zones of a building with their device counts"""
+    with get_db_session() as session:
+        return session.execute(text("""
+        SELECT z.id, z.name, z.square_footage, count(d.id)
+        FROM zones z
+        LEFT JOIN devices d ON d.zone_id = z.id
+        WHERE z.building_id = :building_id
+        GROUP BY z.id
+        ORDER BY z.id
+        """), {"building_id": building_id}).fetchall()
+
+def load_zone(zone_id):
+    with get_db_session() as session:
+        return session.execute(text("SELECT name, square_footage FROM zones WHERE id = :zone_id"), 
+                               {"zone_id": zone_id}).fetchone()
+
+def invalidate_zone(zone_id):
+    """Drop cached responses for a zone (keys are tuples starting with the zone id)"""
+    response_cache.invalidate(lambda key: key[0] == zone_id)
+
+def invalidate_building(building_id):
+    """Drop cached responses for a building (keys are tuples starting with "building", building id)"""
+    response_cache.invalidate(lambda key: key[:2] == ("building", building_id))
+    # A building the cached list doesn't have yet was just added; reload the list instead of 404ing it for minutes
+    if not any(b[0] == building_id for b in zone_cache.get_or_load("buildings", load_buildings)):
+        zone_cache.invalidate(lambda key: key == "buildings")
+
+def invalidate_for(payload):
+    """Invalidate what a notification names: a zone id, "building:<id>", or anything else for everything"""
+    if payload.startswith("building:"):
+        invalidate_building(payload[len("building:"):])
+        return
+    try:
+        invalidate_zone(int(payload))
+    except ValueError:
+        response_cache.invalidate()
+
+# Listener thread state, per process
+_listener_lock = threading.Lock()
+_listener_started = False
+
+def _listen_for_invalidations():
+    """LISTEN for new-data notifications from the subscriber and invalidate cached zones"""
+    retry_delay = 1
+    while True:
+        try:
+            conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+            # Anything cached while we were disconnected may be stale
+            response_cache.invalidate()
+            retry_delay = 1
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    invalidate_for(conn.notifies.pop(0).payload)
+        except Exception as e:
+            print(f"Cache invalidation listener error: {e}; retrying in {retry_delay}s")
+            time.sleep(retry_delay)
+            retry_delay = min(30, retry_delay * 2)
+
+def _ensure_listener():
+    global _listener_started
+    if _listener_started or not CACHE_INVALIDATION:
+        return
+    with _listener_lock:
+        if not _listener_started:
+            threading.Thread(target=_listen_for_invalidations, name="cache-invalidation", daemon=True).start()
+            _listener_started = True
+
+def _reset_listener_after_fork():
+    # Threads don't survive fork; each worker process starts its own listener
+    global _listener_started, _listener_lock
+    _listener_started = False
+    _listener_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_listener_after_fork)
+
+# Live updates: one upstream MQTT subscription per process fanned out to
+# every connected browser over server-sent events
+MQTT_BROKER = os.environ.get('MQTT_BROKER', 'mqtt-broker')
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
+LIVE_TOPIC = os.environ.get('LIVE_TOPIC', '+/sensors/#')  # every building; zone ids are unique across them
+LIVE_CLIENT_BUFFER = int(os.environ.get('LIVE_CLIENT_BUFFER', 100))  # events buffered per slow client
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))  # seconds
+
+_live_feed = None
+_live_feed_lock = threading.Lock()
+
+def get_live_feed():
+    global _live_feed
+    if _live_feed is None:
+        with _live_feed_lock:
+            if _live_feed is None:
+                feed = LiveFeed(MQTT_BROKER, MQTT_PORT, LIVE_TOPIC, client_buffer=LIVE_CLIENT_BUFFER)
+                feed.start()
+                collector.register("frontend_live", feed.stats, counters=("messages", "frames", "invalid", "dropped_frames"))
+                _live_feed = feed
+    return _live_feed
+
+def _reset_live_feed_after_fork():
+    # The MQTT network thread isn't inherited, so each worker opens its own feed
+    global _live_feed, _live_feed_lock
+    _live_feed = None
+    _live_feed_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_live_feed_after_fork)
+
+@app.before_request
+def start_cache_listener():
+    _ensure_listener()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Route templates, not raw paths, so /stream/<zone_id> is one series
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if hasattr(g, "request_start"):
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for this process"""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
 @app.route('/')
 def index():
-    # Get all zones for the dropdown
-    session = get_db_session()
-    zones = session.execute(text("SELECT id, name, square_footage FROM zones")).fetchall()
-    session.close()
-    return render_template('index.html', zones=zones)
+    # Get the zones for the dropdown, optionally of a single building
+    building_id = request.args.get('building') or None
+    buildings = zone_cache.get_or_load("buildings", load_buildings)
+    zones = zone_cache.get_or_load(("zones", building_id), lambda: load_zones(building_id))
+    return render_template('index.html', zones=zones, buildings=buildings, selected_building=building_id)
 
-@app.route('/zone_data', methods=['POST'])
-def zone_data():
-    zone_id = request.form.get('zone_id')
-    if not zone_id:
-        return jsonify({"error": "No zone selected"}), 400
-    
-    session = get_db_session()
-    
-    # Get zone name and square footage
-    zone = session.execute(text("SELECT name, square_footage FROM zones WHERE id = :zone_id"), 
-                          {"zone_id": zone_id}).fetchone()
-    
-    # Get recent measurements for devices in the selected zone
-    query = text("""
-    SELECT m.id, d.id as device_id, d.device_type, m.value, m.timestamp
-    FROM measurements m
-    JOIN devices d ON m.device_id = d.id
-    WHERE d.zone_id = :zone_id
-    ORDER BY m.timestamp DESC
-    LIMIT 10
-    """)
+@app.route('/buildings')
+def buildings():
+    """All buildings with their zone and device counts"""
+    rows = zone_cache.get_or_load("buildings", load_buildings)
+    return jsonify([{"id": b[0], "name": b[1], "zones": b[2], "devices": b[3]} for b in rows])
+
+@app.route('/buildings/<building_id>')
+def building(building_id):
+    """A building and its zones"""
+    match = next((b for b in zone_cache.get_or_load("buildings", load_buildings) if b[0] == building_id), None)
+    if match is None:
+        return jsonify({"error": "Unknown building"}), 404
+    zones = zone_cache.get_or_load(("building_zones", building_id), lambda: load_building_zones(building_id))
+    return jsonify({
+        "id": match[0],
+        "name": match[1],
+        "zones": [{"id": z[0], "name": z[1], "square_footage": z[2], "devices": z[3]} for z in zones],
+    })
+
+def load_current_state(zone_id=None, building_id=None):
+    """Newest reading of every device and field in a zone or a building, from the subscriber's
+    latest_readings table; cost grows with the number of devices, not with history"""
+    # Devices carry their building, so those registered without a zone are included
+    scope = "d.zone_id = :key" if zone_id is not None else "d.building_id = :key"
+    with get_db_session() as session:
+        rows = session.execute(text(f"""
+        SELECT d.zone_id, l.device_id, d.device_type, l.field, l.value, l.unit, l.timestamp
+        FROM latest_readings l
+        JOIN devices d ON d.id = l.device_id
+        WHERE {scope}
+        ORDER BY d.zone_id, l.device_id, l.field
+        """), {"key": zone_id if zone_id is not None else building_id}).fetchall()
+    return [
+        {
+            "zone_id": r[0],
+            "device_id": r[1],
+            "device_type": r[2],
+            "field": r[3],
+            "value": r[4],
+            "unit": r[5],
+            "timestamp": r[6].isoformat(),
+        } for r in rows
+    ]
+
+@app.route('/zones/<int:zone_id>/current')
+def zone_current(zone_id):
+    """Current reading of every device and field in a zone"""
+    zone = zone_cache.get_or_load(("zone", zone_id), lambda: load_zone(zone_id))
+    if zone is None:
+        return jsonify({"error": "Unknown zone"}), 404
+    # Keyed by zone id first, so NOTIFY invalidation drops it with the zone's other responses
+    readings = response_cache.get_or_load((zone_id, "current"), lambda: load_current_state(zone_id=zone_id))
+    return jsonify({"zone_id": zone_id, "zone_name": zone[0], "readings": readings})
+
+@app.route('/buildings/<building_id>/current')
+def building_current(building_id):
+    """Current reading of every device and field in a building's zones"""
+    if not any(b[0] == building_id for b in zone_cache.get_or_load("buildings", load_buildings)):
+        return jsonify({"error": "Unknown building"}), 404
+    readings = response_cache.get_or_load(("building", building_id, "current"),
+                                          lambda: load_current_state(building_id=building_id))
+    return jsonify({"building_id": building_id, "readings": readings})
+
+def load_zone_data(zone_id, limit):
+    zone = zone_cache.get_or_load(("zone", zone_id), lambda: load_zone(zone_id))
     
-    measurements = session.execute(query, {"zone_id": zone_id}).fetchall()
-    session.close()
+    # Sessions borrow a pooled connection and return it on exit, even on errors
+    with get_db_session() as session:
+        # Get recent measurements for devices in the selected zone
+        query = text("""
+        SELECT m.id, d.id as device_id, d.device_type, m.value, m.timestamp
+        FROM measurements m
+        JOIN devices d ON m.device_id = d.id
+        WHERE d.zone_id = :zone_id
+        ORDER BY m.timestamp DESC
+        LIMIT :limit
+        """)
+        
+        measurements = session.execute(query, {"zone_id": zone_id, "limit": limit}).fetchall()
     
-    return jsonify({
+    return {
         "zone_name": zone[0] if zone else "Unknown Zone",
         "square_footage": zone[1] if zone else None,
         "measurements": [
@@ -64,8 +318,107 @@ def zone_data():
                 "timestamp": m[4].strftime("%Y-%m-%d %H:%M:%S") if m[4] else None
             } for m in measurements
         ]
-    })
+    }
+
+@app.route('/zone_data', methods=['POST'])
+def zone_data():
+    zone_id = request.form.get('zone_id')
+    if not zone_id:
+        return jsonify({"error": "No zone selected"}), 400
+    try:
+        zone_id = int(zone_id)
+        limit = max(1, min(MAX_ZONE_DATA_LIMIT, int(request.form.get('limit', 10))))
+    except ValueError:
+        return jsonify({"error": "Invalid zone or limit"}), 400
+    
+    data = response_cache.get_or_load((zone_id, "zone_data", limit), lambda: load_zone_data(zone_id, limit))
+    return jsonify(data)
+
+@app.route('/stream/<int:zone_id>')
+def stream(zone_id):
+    """Server-sent events with every new measurement for a zone"""
+    feed = get_live_feed()
+    subscription = feed.subscribe(zone_id)
+
+    def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                frames = subscription.drain(SSE_KEEPALIVE)
+                # A comment line keeps proxies from timing out and lets us notice disconnects
+                yield "".join(frames) if frames else ": keepalive\n\n"
+        finally:
+            feed.unsubscribe(subscription)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Time-series API for charts: at most TIMESERIES_MAX_POINTS points per response,
+# bucketed in Postgres and streamed through a server-side cursor
+TIMESERIES_MAX_POINTS = int(os.environ.get('TIMESERIES_MAX_POINTS', 5000))
+TIMESERIES_USE_ROLLUPS = os.environ.get('TIMESERIES_USE_ROLLUPS', '1') == '1'
+TIMESERIES_FETCH_ROWS = int(os.environ.get('TIMESERIES_FETCH_ROWS', 10000))  # rows per cursor round trip
+
+@app.route('/timeseries')
+def timeseries():
+    """Downsampled series for one device or zone.
+
+    Query parameters: device_id, zone_id or building_id, field, start and end (ISO 8601;
+    end defaults to now, start to a day before end), points (default 500),
+    method ("avg" buckets, or "lttb" for a device) and format ("json" or "arrow").
+    """
+    device_id = request.args.get('device_id')
+    zone_id = request.args.get('zone_id')
+    building_id = request.args.get('building_id')
+    field = request.args.get('field', 'temperature')
+    method = request.args.get('method', 'avg')
+    fmt = request.args.get('format', 'json')
+    if [device_id, zone_id, building_id].count(None) != 2:
+        return jsonify({"error": "Pass exactly one of device_id, zone_id or building_id"}), 400
+    try:
+        zone_id = int(zone_id) if zone_id is not None else None
+        end = parse_timestamp(request.args['end']) if 'end' in request.args else datetime.now()
+        start = parse_timestamp(request.args['start']) if 'start' in request.args else end - timedelta(days=1)
+        points = int(request.args.get('points', 500))
+    except ValueError:
+        return jsonify({"error": "Invalid zone_id, start, end or points"}), 400
+    if start >= end or not 1 <= points <= TIMESERIES_MAX_POINTS:
+        return jsonify({"error": f"Need start < end and 1 <= points <= {TIMESERIES_MAX_POINTS}"}), 400
+    if method not in ("avg", "lttb") or (method == "lttb" and device_id is None):
+        return jsonify({"error": "method must be avg, or lttb with a device_id"}), 400
+    if fmt not in ("json", "arrow"):
+        return jsonify({"error": "format must be json or arrow"}), 400
+    if fmt == "arrow" and not ARROW_AVAILABLE:
+        return jsonify({"error": "format=arrow needs pyarrow installed on the server"}), 400
+
+    # The connection stays checked out while the response streams and is returned when it ends
+    conn = engine.connect().execution_options(stream_results=True, max_row_buffer=TIMESERIES_FETCH_ROWS)
+    try:
+        if method == "lttb":
+            meta, rows = lttb_series(conn, field, start, end, points, device_id)
+        else:
+            meta, rows = bucket_series(conn, field, start, end, points, device_id=device_id, zone_id=zone_id,
+                                       building_id=building_id, use_rollups=TIMESERIES_USE_ROLLUPS)
+        encode = stream_arrow if fmt == "arrow" else stream_json
+        body = encode(dict(meta, device_id=device_id, zone_id=zone_id, building_id=building_id, field=field), rows)
+        first = next(body)  # surfaces query and encoding errors before the response starts
+    except ArchivedRangeError as e:
+        conn.close()
+        return jsonify({"error": f"{e}; use method=avg over a range served from rollups"}), 400
+    except Exception:
+        conn.close()
+        raise
+
+    def generate():
+        try:
+            yield first
+            yield from body
+        finally:
+            conn.close()
+
+    mimetype = 'application/vnd.apache.arrow.stream' if fmt == "arrow" else 'application/json'
+    return Response(generate(), mimetype=mimetype)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
 
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Load:
+    """An in-flight load: waiters block on done; stale is set if the key is invalidated meanwhile"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.stale = False
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds.
+
+    get_or_load() is read-through and single-flight: when many requests miss on
+    the same key at once, only one runs the loader and the rest wait for its
+    result. A key invalidated while its load is in flight is not re-cached
+    with the (possibly stale) loaded value; loads of other keys are unaffected.
+    """
+
+    def __init__(self, maxsize=1024, ttl=2.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._loading = {}  # key -> _Load
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_fresh(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def get_or_load(self, key, loader):
+        while True:
+            with self._lock:
+                found, value = self._get_fresh(key, time.monotonic())
+                if found:
+                    self.hits += 1
+                    return value
+                load = self._loading.get(key)
+                if load is None:
+                    # We are the loader for this key
+                    self.misses += 1
+                    load = self._loading[key] = _Load()
+                    break
+            # Someone else is loading; wait, then re-check the cache
+            load.done.wait()
+
+        try:
+            value = loader()
+        except BaseException:
+            # Nothing to cache; the waiters retry and one of them loads next
+            with self._lock:
+                del self._loading[key]
+            load.done.set()
+            raise
+
+        # Cached before the waiters wake, so they find the value instead of loading again
+        with self._lock:
+            if not load.stale:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+            del self._loading[key]
+        load.done.set()
+        return value
+
+    def invalidate(self, predicate=None):
+        """Drop entries whose key matches predicate(key), or everything if no predicate"""
+        with self._lock:
+            for key, load in self._loading.items():
+                if predicate is None or predicate(key):
+                    load.stale = True
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
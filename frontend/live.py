@@ -0,0 +1,148 @@
+import json
+import threading
+from collections import deque
+from datetime import datetime
+import paho.mqtt.client as mqtt
+
+
+class Subscription:
+    """Bounded per-client event buffer; a slow client loses its oldest events, not the feed"""
+
+    def __init__(self, zone_id, maxlen):
+        self.zone_id = zone_id
+        self.dropped = 0
+        self._events = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+
+    def push(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def drain(self, timeout):
+        """Wait up to timeout seconds for events and return everything pending"""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class LiveFeed:
+    """Fans measurements from one shared MQTT subscription out to every connected viewer.
+
+    Each process holds a single upstream subscription no matter how many
+    browsers are connected, and nothing touches the database. Incoming
+    readings are encoded as a server-sent event once and the same frame is
+    handed to every subscriber of that zone.
+    """
+
+    def __init__(self, broker, port, topic, client_buffer=100):
+        self.broker = broker
+        self.port = port
+        self.topic = topic
+        self.client_buffer = client_buffer
+        self._subscribers = {}  # zone id -> set of Subscription
+        self._lock = threading.Lock()
+        self._client = None
+        self.messages = 0  # MQTT messages received
+        self.frames = 0    # events handed to viewers
+        self.invalid = 0   # readings that could not be turned into an event
+
+    def start(self):
+        self._client = mqtt.Client(protocol=mqtt.MQTTv5)
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+        # A bug in a callback must not stop the network loop and with it the feed
+        self._client.suppress_exceptions = True
+        # connect_async + loop_start keeps retrying in the background if the broker is down
+        self._client.connect_async(self.broker, self.port, 60)
+        self._client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            client.subscribe(self.topic)
+            print(f"Live feed subscribed to {self.topic}")
+        else:
+            print(f"Live feed failed to connect to MQTT broker with result code {rc}")
+
+    def _on_message(self, client, userdata, msg):
+        # Single JSON readings or JSON batch envelopes; binary batch formats
+        # (msgpack/struct) are not decoded here and are skipped
+        self.messages += 1
+        try:
+            data = json.loads(msg.payload)
+        except (ValueError, UnicodeDecodeError):
+            return
+        readings = data.get("readings", [data]) if isinstance(data, dict) else []
+        if not isinstance(readings, list):
+            readings = []
+
+        for reading in readings:
+            # One malformed reading skips itself, not the rest of the batch
+            try:
+                self._dispatch(reading)
+            except Exception:
+                self.invalid += 1
+
+    def _dispatch(self, reading):
+        """Encode a reading once and hand it to every subscriber of its zone"""
+        try:
+            zone_id = int(reading.get("zone_id"))
+        except (ValueError, TypeError):
+            self.invalid += 1
+            return
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(zone_id, ()))
+        if not subscribers:
+            return
+
+        device_id = str(reading.get("device_id"))
+        if "timestamp_ms" in reading:
+            timestamp = datetime.fromtimestamp(reading["timestamp_ms"] / 1000.0).isoformat()
+        else:
+            timestamp = str(reading.get("timestamp") or "")
+        frame = "data: " + json.dumps({
+            "device_id": device_id,
+            "device_type": device_id.split('-')[0],
+            "field": reading.get("field"),
+            "value": reading.get("reading"),
+            "unit": reading.get("unit"),
+            "timestamp": timestamp[:19].replace("T", " "),
+        }) + "\n\n"
+        for subscription in subscribers:
+            subscription.push(frame)
+        self.frames += len(subscribers)
+
+    def subscribe(self, zone_id):
+        subscription = Subscription(zone_id, self.client_buffer)
+        with self._lock:
+            self._subscribers.setdefault(zone_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.zone_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.zone_id]
+
+    def viewer_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def stats(self):
+        with self._lock:
+            subscriptions = [s for subscribers in self._subscribers.values() for s in subscribers]
+        return {
+            "viewers": len(subscriptions),
+            "messages": self.messages,
+            "frames": self.frames,
+            "invalid": self.invalid,
+            "dropped_frames": sum(s.dropped for s in subscriptions),
+        }
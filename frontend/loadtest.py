@@ -0,0 +1,106 @@
+"""
+Small load test for the dashboard.
+
+Hammers the index page and /zone_data from a number of concurrent clients for
+a fixed duration and reports requests/sec and latency percentiles. Run it once
+against the old build and once against the new one to compare, e.g.
+
+    python loadtest.py --url http://localhost:5002 --concurrency 20 --duration 30 --label pooled
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def client(base_url, zone_ids, index_ratio, deadline, latencies, errors, lock):
+    """Issue requests back to back until the deadline"""
+    local_latencies = []
+    local_errors = 0
+    i = 0
+    while time.monotonic() < deadline:
+        if random.random() < index_ratio:
+            request = urllib.request.Request(base_url + "/")
+        else:
+            body = urllib.parse.urlencode({"zone_id": zone_ids[i % len(zone_ids)]}).encode()
+            request = urllib.request.Request(base_url + "/zone_data", data=body)
+        i += 1
+
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+        except (urllib.error.URLError, OSError):
+            local_errors += 1
+            continue
+        local_latencies.append(time.perf_counter() - start)
+
+    with lock:
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+
+
+def run(args):
+    zone_ids = [int(z) for z in args.zones.split(",")]
+    latencies, errors, lock = [], [], threading.Lock()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=client, args=(args.url.rstrip("/"), zone_ids, args.index_ratio,
+                                               deadline, latencies, errors, lock))
+        for _ in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        "label": args.label,
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 2),
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "requests_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5002")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--zones", default="1,2,3", help="comma separated zone ids for /zone_data")
+    parser.add_argument("--index-ratio", type=float, default=0.1, help="fraction of requests hitting /")
+    parser.add_argument("--label", default="", help="tag stored with the results, e.g. 'before'")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(f"{result['requests_per_sec']} req/s, p50 {result['latency_ms']['p50']} ms, "
+          f"p99 {result['latency_ms']['p99']} ms, {result['errors']} errors")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+from prometheus_client import Counter, Histogram, REGISTRY
+from stats import StatsCollector
+
+# Same conventions as subscriber/metrics.py; served by the app itself at /metrics
+REQUESTS = Counter("frontend_requests", "HTTP requests handled", ["endpoint", "method", "status"])
+REQUEST_SECONDS = Histogram("frontend_request_seconds", "Time to build a response", ["endpoint"],
+                            buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+collector = StatsCollector()
+REGISTRY.register(collector)
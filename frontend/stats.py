@@ -0,0 +1,80 @@
+"""
+Stats export and sampled logging shared by the subscriber, publishers and frontend.
+
+Each service image is built from its own directory, so every service keeps a
+copy of this file; the copies must stay identical (subscriber/test_stats.py
+checks this when the sibling directories are present).
+"""
+import os
+import threading
+import time
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Per-message log lines are emitted at most once per LOG_SAMPLE_INTERVAL seconds (0 logs everything)
+LOG_SAMPLE_INTERVAL = float(os.environ.get("LOG_SAMPLE_INTERVAL", 10))
+
+
+class StatsCollector:
+    """Exports stats() snapshots of long-lived components when Prometheus scrapes.
+
+    Components keep their own counters, so reading them at scrape time costs
+    the hot path nothing. Keys named in counters become counters, other
+    numeric keys gauges; non-numeric values are skipped. Components of the
+    same kind (e.g. one batch writer per building) register under one prefix
+    with distinguishing labels and share metric families.
+    """
+
+    def __init__(self):
+        self._sources = {}  # (prefix, labels) -> (stats_fn, counter keys)
+        self._lock = threading.Lock()
+
+    def register(self, prefix, stats_fn, counters=(), labels=None):
+        key = (prefix, tuple((labels or {}).items()))
+        with self._lock:
+            self._sources[key] = (stats_fn, set(counters))
+
+    def collect(self):
+        with self._lock:
+            sources = list(self._sources.items())
+        families = {}
+        for (prefix, labels), (stats_fn, counters) in sources:
+            try:
+                stats = stats_fn()
+            except Exception:
+                continue
+            for key, value in stats.items():
+                if not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                family = families.get(name)
+                if family is None:
+                    metric = CounterMetricFamily if key in counters else GaugeMetricFamily
+                    family = families[name] = metric(name, f"{prefix} {key}", labels=[k for k, _ in labels])
+                family.add_metric([v for _, v in labels], value)
+        yield from families.values()
+
+
+class SampledLog:
+    """Rate-limited logging for per-message events.
+
+    Emits at most one line per key every interval seconds and reports how many
+    were suppressed in between, so logging cost no longer scales with message rate.
+    The message is only formatted (str.format with args) when it is emitted.
+    """
+
+    def __init__(self, emit=print, interval=LOG_SAMPLE_INTERVAL):
+        self.emit = emit
+        self.interval = interval
+        self._state = {}  # key -> (last emitted, suppressed since)
+
+    def __call__(self, key, message, *args):
+        if self.interval > 0:
+            now = time.monotonic()
+            last, suppressed = self._state.get(key, (float("-inf"), 0))
+            if now - last < self.interval:
+                self._state[key] = (last, suppressed + 1)
+                return
+            self._state[key] = (now, 0)
+            if suppressed:
+                message += f" (+{suppressed} similar)"
+        self.emit(message.format(*args) if args else message)
@@ -0,0 +1,70 @@
+import threading
+import time
+import unittest
+
+from cache import TTLCache
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_concurrent_misses_load_once(self):
+        for _ in range(50):
+            cache = TTLCache(ttl=60)
+            calls = []
+            start = threading.Barrier(8)
+
+            def loader():
+                calls.append(1)
+                time.sleep(0.001)
+                return "value"
+
+            def get():
+                start.wait()
+                self.assertEqual(cache.get_or_load("key", loader), "value")
+
+            threads = [threading.Thread(target=get) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(calls), 1)
+
+    def test_invalidation_only_affects_matching_loads(self):
+        cache = TTLCache(ttl=60)
+
+        def loader(value):
+            cache.invalidate(lambda key: key[0] == 2)
+            return value
+
+        cache.get_or_load((1, "current"), lambda: loader("a"))
+        cache.get_or_load((2, "current"), lambda: loader("b"))
+        self.assertEqual(cache.stats()["size"], 1)
+        self.assertEqual(cache.get_or_load((1, "current"), lambda: "reloaded"), "a")
+        self.assertEqual(cache.get_or_load((2, "current"), lambda: "reloaded"), "reloaded")
+
+    def test_failed_load_releases_waiters(self):
+        cache = TTLCache(ttl=60)
+        started, release = threading.Event(), threading.Event()
+        results = []
+
+        def failing():
+            started.set()
+            release.wait()
+            raise RuntimeError("database down")
+
+        def fail():
+            with self.assertRaises(RuntimeError):
+                cache.get_or_load("key", failing)
+
+        first = threading.Thread(target=fail)
+        first.start()
+        started.wait()
+        waiter = threading.Thread(target=lambda: results.append(cache.get_or_load("key", lambda: "loaded")))
+        waiter.start()
+        release.set()
+        first.join()
+        waiter.join()
+        self.assertEqual(results, ["loaded"])
+
+
+if __name__ == "__main__":
+    unittest.main()
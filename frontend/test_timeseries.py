@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from timeseries import (WATERMARK_FILE, ArchivedRangeError, check_not_archived, lttb_series, parse_timestamp, plan_buckets,
+                        stream_json)
+
+
+class FakeConnection:
+    """Answers lttb_series' two queries (bucket means, then raw rows) from a list of (timestamp, value)"""
+
+    def __init__(self, points):
+        self.points = sorted(points)
+
+    def execute(self, query, params):
+        rows = [(ts, value) for ts, value in self.points if params["start"] <= ts < params["end"]]
+        if "GROUP BY" not in str(query):
+            return FakeResult(rows)
+        origin, width = params["origin"], params["width"]
+        buckets = {}
+        for ts, value in rows:
+            buckets.setdefault(origin + (ts - origin) // width * width, []).append(((ts - origin).total_seconds(), value))
+        return FakeResult([(bucket, sum(s for s, _ in members) / len(members), sum(v for _, v in members) / len(members))
+                           for bucket, members in sorted(buckets.items())])
+
+
+class FakeResult(list):
+    def fetchall(self):
+        return list(self)
+
+
+START = datetime(2025, 1, 1)
+
+
+class PlanBucketsTest(unittest.TestCase):
+    def test_short_ranges_read_raw_rows(self):
+        width, origin, resolution = plan_buckets(START, START + timedelta(hours=1), 100)
+        self.assertEqual((width, origin, resolution), (timedelta(seconds=36), START, None))
+
+    def test_width_is_rounded_to_whole_rollup_buckets(self):
+        start = START + timedelta(seconds=30)
+        width, origin, resolution = plan_buckets(start, start + timedelta(days=1), 100)
+        self.assertEqual((width, origin, resolution), (timedelta(minutes=15), START, "1m"))
+
+    def test_coarsest_fitting_rollup_is_used(self):
+        start = START + timedelta(hours=5)
+        width, origin, resolution = plan_buckets(start, start + timedelta(days=30), 10)
+        self.assertEqual((width, origin, resolution), (timedelta(days=3), START, "1d"))
+
+    def test_incomplete_raw_rows_force_rollups(self):
+        start = START + timedelta(seconds=30)
+        for use_rollups in (True, False):
+            width, origin, resolution = plan_buckets(start, start + timedelta(hours=1), 100, use_rollups,
+                                                     raw_complete=False)
+            self.assertEqual((width, origin, resolution), (timedelta(minutes=1), START, "1m"))
+
+    def test_rollups_can_be_disabled(self):
+        width, origin, resolution = plan_buckets(START, START + timedelta(days=1), 100, use_rollups=False)
+        self.assertEqual((width, origin, resolution), (timedelta(minutes=14, seconds=24), START, None))
+
+
+class LttbTest(unittest.TestCase):
+    def series(self, points, count=1000):
+        readings = [(START + timedelta(seconds=i), 70.0) for i in range(count)]
+        readings[437] = (readings[437][0], 95.0)  # a spike averaging would flatten
+        meta, rows = lttb_series(FakeConnection(readings), "temperature", START, START + timedelta(seconds=count),
+                                 points, "temp-1")
+        return readings, meta, list(rows)
+
+    def test_output_is_bounded_and_keeps_the_ends(self):
+        readings, meta, rows = self.series(20)
+        self.assertLessEqual(len(rows), 20)
+        self.assertEqual((rows[0], rows[-1]), (readings[0], readings[-1]))
+        self.assertEqual([ts for ts, _ in rows], sorted(ts for ts, _ in rows))
+        self.assertEqual((meta["method"], meta["source"]), ("lttb", "raw"))
+
+    def test_spikes_survive_decimation(self):
+        _, _, rows = self.series(20)
+        self.assertIn(95.0, [value for _, value in rows])
+
+    def test_empty_range(self):
+        meta, rows = lttb_series(FakeConnection([]), "temperature", START, START + timedelta(hours=1), 20, "temp-1")
+        self.assertEqual(list(rows), [])
+
+    def test_single_reading(self):
+        readings = [(START, 70.0)]
+        _, rows = lttb_series(FakeConnection(readings), "temperature", START, START + timedelta(hours=1), 20, "temp-1")
+        self.assertEqual(list(rows), readings)
+
+
+class ArchiveWatermarkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_ranges_before_the_watermark_are_refused(self):
+        with open(os.path.join(self.directory, WATERMARK_FILE), "w") as f:
+            json.dump({"archived_before": START.isoformat(), "generation": 1}, f)
+        with self.assertRaises(ArchivedRangeError):
+            check_not_archived(START - timedelta(seconds=1), self.directory)
+        check_not_archived(START, self.directory)
+
+    def test_no_archive(self):
+        check_not_archived(START, self.directory)
+
+
+class ParseTimestampTest(unittest.TestCase):
+    def test_naive_timestamps_are_kept(self):
+        self.assertEqual(parse_timestamp("2025-01-01T12:00:00"), datetime(2025, 1, 1, 12))
+
+    def test_offsets_are_converted_to_naive_local_time(self):
+        ts = parse_timestamp("2025-01-01T12:00:00+02:00")
+        self.assertIsNone(ts.tzinfo)
+        expected = datetime(2025, 1, 1, 10, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+        self.assertEqual(ts, expected)
+
+    def test_garbage_is_a_value_error(self):
+        with self.assertRaises(ValueError):
+            parse_timestamp("yesterday")
+
+
+class StreamJsonTest(unittest.TestCase):
+    def test_chunks_join_into_one_document(self):
+        rows = [(START + timedelta(minutes=i), float(i)) for i in range(5)]
+        body = "".join(stream_json({"method": "lttb"}, rows, chunk_size=2))
+        document = json.loads(body)
+        self.assertEqual(document["method"], "lttb")
+        self.assertEqual(document["points"][4], [(START + timedelta(minutes=4)).isoformat(), 4.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
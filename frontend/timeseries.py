@@ -0,0 +1,273 @@
+import io
+import json
+import math
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+try:
+    import pyarrow as pa
+except ImportError:  # only needed for format=arrow
+    pa = None
+
+ARROW_AVAILABLE = pa is not None
+
+# Rollup tables kept by the subscriber (see subscriber/rollups.py), finest first
+ROLLUP_RESOLUTIONS = {
+    "1m": timedelta(minutes=1),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+
+# The subscriber's Parquet archive (see subscriber/archive.py), mounted read-only; raw
+# measurements before its watermark are no longer in Postgres
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "/app/archive")
+WATERMARK_FILE = "watermark.json"
+
+# Set as for the subscriber: with its deadband filter on, raw rows are only the change
+# points of each series, so averages, mins, maxes and counts must come from the rollups
+DEADBAND_FILTER = os.environ.get("DEADBAND_FILTER", "0") == "1"
+RAW_ROWS = "changes" if DEADBAND_FILTER else "all"
+
+# Columns of each response row
+BUCKET_COLUMNS = ("timestamp", "value", "min", "max", "count")
+LTTB_COLUMNS = ("timestamp", "value")
+
+
+def _floor(ts, step):
+    """Start of the step-aligned interval containing ts (steps are whole minutes, hours or days)"""
+    if step >= ROLLUP_RESOLUTIONS["1d"]:
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if step >= ROLLUP_RESOLUTIONS["1h"]:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+def parse_timestamp(value):
+    """Parse an ISO timestamp query parameter into a naive local time, like the stored timestamps.
+
+    A value with a UTC offset is converted rather than compared as is: naive and
+    aware datetimes can't be compared. Raises ValueError for anything else.
+    """
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone().replace(tzinfo=None)
+    return ts
+
+
+class ArchivedRangeError(ValueError):
+    """A raw-row query reaching back past the archive watermark"""
+
+
+def read_watermark(directory=ARCHIVE_DIR):
+    """Timestamp before which raw measurements were moved to the archive, or None"""
+    try:
+        with open(os.path.join(directory, WATERMARK_FILE)) as f:
+            return datetime.fromisoformat(json.load(f)["archived_before"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def check_not_archived(start_time, directory=ARCHIVE_DIR):
+    """Raise ArchivedRangeError if raw rows from start_time on are no longer all in Postgres"""
+    watermark = read_watermark(directory)
+    if watermark is not None and start_time < watermark:
+        raise ArchivedRangeError(f"Raw measurements before {watermark.isoformat()} are archived")
+
+
+def plan_buckets(start_time, end_time, points, use_rollups=True, raw_complete=True):
+    """Bucket width, bucket origin and rollup resolution (None for raw rows) giving at most points buckets.
+
+    When the width spans at least one rollup bucket the query reads the
+    coarsest such rollup instead of raw rows; the width is then rounded up to
+    a whole number of rollup buckets so every bucket is made of complete ones.
+    Without complete raw rows (raw_complete=False) rollups are always used,
+    widening narrower buckets to the finest rollup.
+    """
+    width = max((end_time - start_time) / points, timedelta(milliseconds=1))
+    width = timedelta(milliseconds=math.ceil(width / timedelta(milliseconds=1)))
+    if use_rollups or not raw_complete:
+        for resolution in reversed(list(ROLLUP_RESOLUTIONS)):
+            step = ROLLUP_RESOLUTIONS[resolution]
+            if width >= step or (not raw_complete and resolution == "1m"):
+                return math.ceil(width / step) * step, _floor(start_time, step), resolution
+    return width, start_time, None
+
+
+# Rows of a device, a zone or a building (the devices in its zones, as in the zone rollups)
+_RAW_SCOPES = {
+    "device": "m.device_id = :key",
+    "zone": "m.device_id IN (SELECT id FROM devices WHERE zone_id = :key)",
+    "building": "m.device_id IN (SELECT d.id FROM devices d JOIN zones z ON z.id = d.zone_id WHERE z.building_id = :key)",
+}
+_ROLLUP_SCOPES = {
+    "device": ("device_rollups", "r.device_id = :key"),
+    "zone": ("zone_rollups", "r.zone_id = :key"),
+    "building": ("zone_rollups", "r.zone_id IN (SELECT id FROM zones WHERE building_id = :key)"),
+}
+
+
+def bucket_series(conn, field, start_time, end_time, points, device_id=None, zone_id=None, building_id=None,
+                  use_rollups=True, raw_rows=RAW_ROWS):
+    """Average, min, max and count per time bucket, computed in Postgres with date_bin.
+
+    raw_rows is "all", or "changes" when the deadband filter stores only change
+    points, in which case rollups are used at every width.
+    Returns (meta, rows); rows is a lazy iterator over the streamed result.
+    Raises ArchivedRangeError if raw rows are needed from before the archive watermark.
+    """
+    scope, key = next((scope, key) for scope, key in
+                      (("device", device_id), ("zone", zone_id), ("building", building_id)) if key is not None)
+    width, origin, resolution = plan_buckets(start_time, end_time, points, use_rollups, raw_rows == "all")
+    params = {"field": field, "start": start_time, "end": end_time, "width": width, "origin": origin, "key": key}
+    if resolution is not None:
+        table, condition = _ROLLUP_SCOPES[scope]
+        params["resolution"] = resolution
+        # Rollup buckets overlapping the range; the edges may reach up to one rollup
+        # bucket past it, but the latest (still filling) bucket is included
+        query = text(f"""
+        SELECT date_bin(:width, r.bucket_start, :origin) AS bucket,
+               sum(r.sum_value) / sum(r.count), min(r.min_value), max(r.max_value), sum(r.count)
+        FROM {table} r
+        WHERE r.resolution = :resolution AND {condition} AND r.field = :field
+          AND r.bucket_start >= :origin AND r.bucket_start < :end
+        GROUP BY bucket
+        ORDER BY bucket
+        """)
+    else:
+        check_not_archived(start_time)
+        query = text(f"""
+        SELECT date_bin(:width, m.timestamp, :origin) AS bucket,
+               avg(m.value), min(m.value), max(m.value), count(*)
+        FROM measurements m
+        WHERE {_RAW_SCOPES[scope]} AND m.field = :field AND m.timestamp >= :start AND m.timestamp < :end
+        GROUP BY bucket
+        ORDER BY bucket
+        """)
+    meta = {
+        "method": "avg",
+        "bucket_seconds": width.total_seconds(),
+        "source": f"{resolution} rollups" if resolution else "raw",
+        "raw_rows": raw_rows,
+        "columns": BUCKET_COLUMNS,
+    }
+    return meta, iter(conn.execute(query, params))
+
+
+def _area(a, b, c):
+    """Twice the area of the triangle abc of (seconds since origin, value) points"""
+    return abs((a[0] - c[0]) * (b[1] - a[1]) - (a[0] - b[0]) * (c[1] - a[1]))
+
+
+def lttb_series(conn, field, start_time, end_time, points, device_id, raw_rows=RAW_ROWS):
+    """Largest-Triangle-Three-Buckets decimation of one device's raw readings.
+
+    A grouped query first computes each time bucket's mean point; the raw rows
+    are then streamed in timestamp order and, per bucket, only the running best
+    point is kept: the one forming the largest triangle with the point chosen
+    for the previous bucket and the next bucket's mean. Memory stays
+    proportional to the number of buckets, not readings. The first and last
+    readings are always included. With raw_rows="changes" (deadband filter)
+    the input is the series' change points, which meta reports so clients
+    can draw it as steps. Raises ArchivedRangeError if the range
+    starts before the archive watermark.
+    """
+    check_not_archived(start_time)
+    width, origin, _ = plan_buckets(start_time, end_time, max(1, points - 2), use_rollups=False)
+    params = {"device_id": device_id, "field": field, "start": start_time, "end": end_time,
+              "width": width, "origin": origin}
+    where = "device_id = :device_id AND field = :field AND timestamp >= :start AND timestamp < :end"
+    means = conn.execute(text(f"""
+        SELECT date_bin(:width, timestamp, :origin) AS bucket,
+               avg(extract(epoch FROM timestamp - :origin)), avg(value)
+        FROM measurements WHERE {where}
+        GROUP BY bucket ORDER BY bucket
+        """), params).fetchall()
+    next_mean = {means[i][0]: (means[i + 1][1], means[i + 1][2]) for i in range(len(means) - 1)}
+    if means:
+        # The last bucket has nothing after it; its own mean stands in
+        next_mean[means[-1][0]] = (means[-1][1], means[-1][2])
+    meta = {"method": "lttb", "bucket_seconds": width.total_seconds(), "source": "raw", "raw_rows": raw_rows,
+            "columns": LTTB_COLUMNS}
+    rows = conn.execute(text(f"SELECT timestamp, value FROM measurements WHERE {where} ORDER BY timestamp"), params)
+
+    def seconds(ts):
+        return (ts - origin).total_seconds()
+
+    def select():
+        chosen = None  # (seconds, value) of the last emitted point
+        bucket = best = last = None
+        best_area = -1.0
+        for ts, value in rows:
+            last = (ts, value)
+            if chosen is None:
+                chosen = (seconds(ts), value)
+                yield last
+                bucket = origin + (ts - origin) // width * width
+                continue
+            row_bucket = origin + (ts - origin) // width * width
+            if row_bucket != bucket:
+                if best is not None:
+                    chosen = (seconds(best[0]), best[1])
+                    yield best
+                bucket, best, best_area = row_bucket, None, -1.0
+            mean = next_mean.get(bucket)
+            if mean is None:
+                continue
+            area = _area(chosen, (seconds(ts), value), (float(mean[0]), mean[1]))
+            if area > best_area:
+                best, best_area = last, area
+        if best is not None and best != last:
+            yield best
+        if last is not None and (chosen is None or seconds(last[0]) != chosen[0]):
+            yield last
+
+    return meta, select()
+
+
+def _iso(ts):
+    return ts.isoformat() if ts is not None else None
+
+
+def stream_json(meta, rows, chunk_size=1000):
+    """Encode {..meta, "points": [[timestamp, ...], ...]} incrementally, chunk_size rows per yield"""
+    header = json.dumps(meta)
+    yield header[:-1] + ', "points": ['
+    chunk, first = [], True
+    for row in rows:
+        chunk.append(json.dumps([_iso(row[0]), *row[1:]]))
+        if len(chunk) >= chunk_size:
+            yield ("" if first else ",") + ",".join(chunk)
+            chunk, first = [], False
+    if chunk:
+        yield ("" if first else ",") + ",".join(chunk)
+    yield "]}"
+
+
+def stream_arrow(meta, rows, chunk_size=10000):
+    """Encode rows as an Arrow IPC stream with one record batch per chunk_size rows"""
+    if pa is None:
+        raise RuntimeError("format=arrow requires pyarrow")
+    fields = [pa.field("timestamp", pa.timestamp("us"))] + [
+        pa.field(name, pa.int64() if name == "count" else pa.float64()) for name in meta["columns"][1:]]
+    schema = pa.schema(fields, metadata={k: str(v) for k, v in meta.items()
+                                             if k != "columns" and v is not None})
+    sink = io.BytesIO()
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                writer.write_batch(pa.record_batch(list(zip(*chunk)), schema=schema))
+                chunk = []
+                yield drain()
+        if chunk:
+            writer.write_batch(pa.record_batch(list(zip(*chunk)), schema=schema))
+    yield drain()
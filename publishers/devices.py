@@ -1,5 +1,6 @@
 import json
 import random
+import time
 from datetime import datetime
 # Base Device class
 class Device:
@@ -12,6 +13,12 @@ class Device:
     def generate_message(self):
         raise NotImplementedError("Subclasses must implement this method")
 
+    def generate_reading(self):
+        """Reading tuple for the compact payload formats (see payloads.py)"""
+        value = random.randint(self._measurement_info["min-value"], self._measurement_info["max-value"])
+        return (self._device_id, self._zone_id, self._measurement_info["field"], value,
+                int(time.time() * 1000), self._measurement_info["unit"])
+
 # Temperature sensor implementation
 class TemperatureSensor(Device):
     def __init__(self, id, zone_id=0):
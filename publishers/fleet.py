@@ -0,0 +1,136 @@
+import threading
+import time
+from datetime import datetime
+import numpy as np
+
+# Sensor kinds of the simulated fleet. Field, range and unit mirror the sensor
+# classes in devices.py; step is the random-walk standard deviation per reading
+# and decimals the precision values are published with.
+SENSOR_SPECS = (
+    # field,        id prefix, low, high, unit,  step, decimals
+    ("temperature", "temp",    65,  85,   "F",   0.15, 1),
+    ("humidity",    "hum",     30,  70,   "%",   0.4,  1),
+    ("co2",         "co2",     350, 1500, "ppm", 12.0, 0),
+)
+FIELDS = {spec[0]: kind for kind, spec in enumerate(SENSOR_SPECS)}
+
+# Pull towards the middle of the range per reading, so walks don't stick to the limits
+MEAN_REVERSION = 0.02
+
+
+def _template(zone_id, kind):
+    """JSON payload of a group with %-slots for the device number, value and timestamp"""
+    field, prefix, _, _, unit, _, decimals = (str(part).replace("%", "%%") for part in SENSOR_SPECS[kind])
+    return (f'{{"device_id": "{prefix}-%d", "zone_id": {zone_id}, "reading": %.{decimals}f, '
+            f'"timestamp": "%s", "field": "{field}", "unit": "{unit}"}}')
+
+
+class Fleet:
+    """Array-backed set of simulated sensors for publishing very large fleets.
+
+    Instead of one object per device, each device is a slot in a few NumPy
+    arrays (device number, group and current value). Devices of the same
+    building, zone and sensor kind share a group, which holds the precomputed
+    topic and JSON payload template. advance() moves the values of many
+    devices at once as a mean-reverting random walk. Device ids, payloads and
+    reading tuples are only built when a message is published.
+    """
+
+    __slots__ = ("buildings", "topics", "templates", "group_buildings", "group_zones", "group_kinds",
+                 "numbers", "groups", "values", "_low", "_high", "_step", "_mid", "_rng", "_rng_lock",
+                 "_ts_ms", "_ts_iso")
+
+    def __init__(self, numbers, groups, group_keys, seed=None):
+        """numbers and groups are per-device arrays; group_keys[g] is the (building id, zone id, kind) of group g"""
+        self.buildings = sorted({building_id for building_id, _, _ in group_keys})
+        self.topics = [f"{building_id}/sensors/zone{zone_id}/{SENSOR_SPECS[kind][0]}"
+                       for building_id, zone_id, kind in group_keys]
+        self.templates = [_template(zone_id, kind) for _, zone_id, kind in group_keys]
+        self.group_buildings = np.array([self.buildings.index(key[0]) for key in group_keys], dtype=np.int16)
+        self.group_zones = np.array([key[1] for key in group_keys], dtype=np.int32)
+        self.group_kinds = np.array([key[2] for key in group_keys], dtype=np.int8)
+        self.numbers = np.asarray(numbers, dtype=np.int32)
+        self.groups = np.asarray(groups, dtype=np.int32)
+
+        kinds = self.group_kinds[self.groups]
+        self._low = np.array([spec[2] for spec in SENSOR_SPECS], dtype=float)
+        self._high = np.array([spec[3] for spec in SENSOR_SPECS], dtype=float)
+        self._step = np.array([spec[5] for spec in SENSOR_SPECS], dtype=float)
+        self._mid = (self._low + self._high) / 2
+        self._rng = np.random.default_rng(seed)
+        self._rng_lock = threading.Lock()
+        # Start around the middle of each range
+        spread = (self._high - self._low)[kinds] / 4
+        self.values = self._mid[kinds] + self._rng.uniform(-1, 1, len(kinds)) * spread
+        self._ts_ms = None
+        self._ts_iso = None
+
+    @classmethod
+    def from_buildings(cls, buildings, seed=None):
+        """Fleet described by a load generator buildings config.
+
+        Devices are numbered across the whole fleet, in the order the config
+        lists them, since device ids are the primary key on the subscriber side.
+        """
+        numbers, groups, group_keys = [], [], []
+        next_id = 1
+        for building in buildings:
+            zone_ids = building.get("zone_ids") or range(1, building["zones"] + 1)
+            for zone_id in zone_ids:
+                for field, count in building["devices_per_zone"].items():
+                    if count <= 0:
+                        continue
+                    group = len(group_keys)
+                    group_keys.append((building["id"], zone_id, FIELDS[field]))
+                    numbers.extend(range(next_id, next_id + count))
+                    groups.extend([group] * count)
+                    next_id += count
+        return cls(numbers, groups, group_keys, seed=seed)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def advance(self, indices=None):
+        """Take one random-walk step for the given devices (all by default)"""
+        if indices is None:
+            indices = slice(None)
+        kinds = self.group_kinds[self.groups[indices]]
+        values = self.values[indices]
+        with self._rng_lock:
+            noise = self._rng.standard_normal(len(values))
+        values += MEAN_REVERSION * (self._mid[kinds] - values) + self._step[kinds] * noise
+        self.values[indices] = np.clip(values, self._low[kinds], self._high[kinds])
+
+    def _timestamp(self):
+        """ISO timestamp of the current millisecond, formatted once per millisecond"""
+        now_ms = int(time.time() * 1000)
+        if now_ms != self._ts_ms:
+            self._ts_iso = datetime.fromtimestamp(now_ms / 1000).isoformat(timespec="milliseconds")
+            self._ts_ms = now_ms
+        return self._ts_iso
+
+    def device_id(self, index):
+        return f"{SENSOR_SPECS[self.group_kinds[self.groups[index]]][1]}-{self.numbers[index]}"
+
+    def building(self, index):
+        return self.buildings[self.group_buildings[self.groups[index]]]
+
+    def topic(self, index):
+        return self.topics[self.groups[index]]
+
+    def message(self, index):
+        """One-reading JSON payload, as Device.generate_message() produces"""
+        return self.templates[self.groups[index]] % (self.numbers[index], self.values[index], self._timestamp())
+
+    def readings(self, indices):
+        """Reading tuples for the compact payload formats (see payloads.py)"""
+        timestamp_ms = int(time.time() * 1000)
+        groups = self.groups[indices]
+        kinds = self.group_kinds[groups]
+        values = self.values[indices]
+        return [
+            (f"{SENSOR_SPECS[kind][1]}-{number}", zone_id, SENSOR_SPECS[kind][0],
+             round(value, SENSOR_SPECS[kind][6]), timestamp_ms, SENSOR_SPECS[kind][4])
+            for number, zone_id, kind, value in zip(self.numbers[indices].tolist(), self.group_zones[groups].tolist(),
+                                                    kinds.tolist(), values.tolist())
+        ]
@@ -0,0 +1,309 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import numpy as np
+from fleet import Fleet
+from payloads import CONTENT_TYPES, batch_topic, encode_readings
+from metrics import ACK_SECONDS, collector, start_metrics_server
+
+logger = logging.getLogger('mqtt_loadgen')
+
+DEFAULT_CONFIG = {
+    "broker": os.environ.get("MQTT_BROKER", "mqtt-broker"),
+    "port": int(os.environ.get("MQTT_PORT", 1883)),
+    "target_rate": 1000,      # aggregate readings per second
+    "duration": 0,            # seconds, 0 runs until interrupted
+    "clients": 4,             # MQTT connections publishing in parallel
+    "qos": 0,
+    "max_inflight": 1000,     # unacknowledged QoS 1/2 messages per client
+    "report_interval": 5,     # seconds
+    "payload_format": "json", # json, msgpack or struct
+    "batch_size": 1,          # readings per MQTT message; >1 sends gateway-style batched envelopes
+    "buildings": [
+        {"id": "hyatt-place", "zones": 3, "devices_per_zone": {"temperature": 1, "humidity": 1, "co2": 1}}
+    ],
+}
+
+
+def load_config(path=None, **overrides):
+    """Merge a JSON config file and command line overrides over the defaults"""
+    config = dict(DEFAULT_CONFIG)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    return config
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class PublisherClient:
+    """One MQTT connection publishing its share of the fleet at a fixed rate"""
+
+    def __init__(self, index, config, fleet, indices, rate):
+        self.index = index
+        self.config = config
+        self.fleet = fleet
+        self.indices = indices  # fleet slots of this client's devices
+        self.rate = rate
+        self.payload_format = config["payload_format"]
+        self.batch_size = max(1, config["batch_size"])
+
+        # Gateway batches: (topic, fleet slots) pairs, one MQTT message each. Single
+        # readings go to each device's precomputed topic, so need no per-device state here
+        self.batches = []
+        if self.batch_size > 1:
+            buildings = fleet.group_buildings[fleet.groups[indices]]
+            for b, building_id in enumerate(fleet.buildings):
+                building_indices = indices[buildings == b]
+                self.batches.extend(
+                    (batch_topic(building_id, self.payload_format), building_indices[i:i + self.batch_size])
+                    for i in range(0, len(building_indices), self.batch_size))
+        self.properties = None
+        if self.payload_format != "json":
+            self.properties = Properties(PacketTypes.PUBLISH)
+            self.properties.ContentType = CONTENT_TYPES[self.payload_format]
+
+        self.client = mqtt.Client(client_id=f"loadgen-{os.getpid()}-{index}", protocol=mqtt.MQTTv5)
+        self.client.max_inflight_messages_set(config["max_inflight"])
+        self.client.on_publish = self._on_publish
+
+        self.lock = threading.Lock()
+        self.sent_at = {}      # mid -> send time, until the ack arrives
+        self.early_acks = {}   # mid -> ack time, for acks that beat publish() returning
+        self.latencies = []    # ack latencies (seconds) since the last report
+        self.sent = 0
+        self.readings = 0
+        self.bytes = 0
+        self.acked = 0
+        self.errors = 0
+
+    def _on_publish(self, client, userdata, mid, *args):
+        now = time.perf_counter()
+        with self.lock:
+            sent = self.sent_at.pop(mid, None)
+            if sent is None:
+                self.early_acks[mid] = now
+                return
+            self.acked += 1
+            self.latencies.append(now - sent)
+        ACK_SECONDS.observe(now - sent)
+
+    def _record_send(self, mid, sent, readings, size):
+        with self.lock:
+            self.sent += 1
+            self.readings += readings
+            self.bytes += size
+            acked = self.early_acks.pop(mid, None)
+            if acked is None:
+                self.sent_at[mid] = sent
+            else:
+                self.acked += 1
+                self.latencies.append(acked - sent)
+        if acked is not None:
+            ACK_SECONDS.observe(acked - sent)
+
+    def take_stats(self):
+        """Counters so far plus the ack latencies collected since the previous call"""
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            return self.sent, self.readings, self.bytes, self.acked, self.errors, latencies
+
+    def stats(self):
+        """Counters so far, without consuming the collected latencies"""
+        with self.lock:
+            return {"sent": self.sent, "readings": self.readings, "bytes": self.bytes, "acked": self.acked,
+                    "errors": self.errors, "inflight": len(self.sent_at)}
+
+    def _units(self):
+        """(topic, fleet slots) of every message in one round over this client's devices"""
+        if self.batch_size > 1:
+            return self.batches
+        fleet = self.fleet
+        return ((fleet.topic(index), index) for index in self.indices.tolist())
+
+    def _payload(self, unit):
+        if self.batch_size > 1:
+            return encode_readings(self.fleet.readings(unit), self.payload_format)
+        if self.payload_format == "json":
+            return self.fleet.message(unit)
+        return encode_readings(self.fleet.readings([unit]), self.payload_format)
+
+    def run(self, stop):
+        self.client.connect(self.config["broker"], self.config["port"], 60)
+        self.client.loop_start()
+        qos = self.config["qos"]
+        interval = 1.0 / self.rate  # per reading
+        start = time.perf_counter()
+        count = 0
+        try:
+            while not stop.is_set():
+                # One vectorized random-walk step per round for all of this client's devices
+                self.fleet.advance(self.indices)
+                for topic, unit in self._units():
+                    # Pace against the schedule, not the previous send, so we don't drift
+                    delay = start + count * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if stop.is_set():
+                        break
+                    payload = self._payload(unit)
+                    readings = len(unit) if self.batch_size > 1 else 1
+                    sent = time.perf_counter()
+                    info = self.client.publish(topic, payload, qos=qos, properties=self.properties)
+                    count += readings
+                    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                        self._record_send(info.mid, sent, readings, len(payload))
+                    else:
+                        with self.lock:
+                            self.errors += 1
+        finally:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+
+class LoadGenerator:
+    """Publishes a large simulated device fleet at a target aggregate rate"""
+
+    def __init__(self, config):
+        self.config = config
+        self.fleet = Fleet.from_buildings(config["buildings"])
+        num_clients = max(1, min(config["clients"], len(self.fleet)))
+        per_client_rate = config["target_rate"] / num_clients
+        slots = np.arange(len(self.fleet))
+        self.clients = [
+            PublisherClient(i, config, self.fleet, slots[i::num_clients], per_client_rate)
+            for i in range(num_clients)
+        ]
+        self.stop = threading.Event()
+        collector.register("loadgen", self.stats, counters=("sent", "readings", "bytes", "acked", "errors"))
+
+    def stats(self):
+        """Counters summed over all clients, exported as metrics"""
+        totals = {"devices": len(self.fleet), "target_rate": self.config["target_rate"]}
+        for client in self.clients:
+            for key, value in client.stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _collect(self):
+        sent = readings = size = acked = errors = 0
+        latencies = []
+        for client in self.clients:
+            c_sent, c_readings, c_size, c_acked, c_errors, c_latencies = client.take_stats()
+            sent += c_sent
+            readings += c_readings
+            size += c_size
+            acked += c_acked
+            errors += c_errors
+            latencies.extend(c_latencies)
+        latencies.sort()
+        return sent, readings, size, acked, errors, latencies
+
+    def run(self):
+        config = self.config
+        logger.info(f"Load generator: {len(self.fleet)} devices, {len(self.clients)} clients, "
+                    f"target {config['target_rate']} readings/s, QoS {config['qos']}, "
+                    f"{config['payload_format']} payloads, {config['batch_size']} readings per message")
+        threads = [threading.Thread(target=client.run, args=(self.stop,), daemon=True) for client in self.clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        all_latencies = []
+        last_readings, last_time = 0, start
+        deadline = start + config["duration"] if config["duration"] else None
+        try:
+            while not self.stop.is_set():
+                time.sleep(config["report_interval"])
+                now = time.perf_counter()
+                sent, readings, size, acked, errors, latencies = self._collect()
+                all_latencies.extend(latencies)
+                rate = (readings - last_readings) / (now - last_time)
+                last_readings, last_time = readings, now
+                p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+                logger.info(f"sent={sent} readings={readings} acked={acked} errors={errors} rate={rate:.0f} readings/s "
+                            f"ack p50={p50 * 1000 if p50 is not None else float('nan'):.2f}ms "
+                            f"p99={p99 * 1000 if p99 is not None else float('nan'):.2f}ms")
+                if deadline and now >= deadline:
+                    break
+        except KeyboardInterrupt:
+            logger.info("Load generation stopped")
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.perf_counter() - start
+        sent, readings, size, acked, errors, latencies = self._collect()
+        all_latencies.extend(latencies)
+        all_latencies.sort()
+        ms = lambda value: round(value * 1000, 3) if value is not None else None
+        summary = {
+            "devices": len(self.fleet),
+            "clients": len(self.clients),
+            "qos": config["qos"],
+            "payload_format": config["payload_format"],
+            "batch_size": config["batch_size"],
+            "target_rate": config["target_rate"],
+            "achieved_rate": round(readings / elapsed, 1),
+            "messages_per_sec": round(sent / elapsed, 1),
+            "duration_s": round(elapsed, 2),
+            "sent": sent,
+            "readings": readings,
+            "bytes_per_reading": round(size / readings, 1) if readings else None,
+            "acked": acked,
+            "errors": errors,
+            "ack_latency_ms": {
+                "p50": ms(percentile(all_latencies, 50)),
+                "p95": ms(percentile(all_latencies, 95)),
+                "p99": ms(percentile(all_latencies, 99)),
+                "max": ms(all_latencies[-1] if all_latencies else None),
+            },
+        }
+        logger.info(f"Load generation summary: {json.dumps(summary)}")
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="High-rate MQTT load generator for simulated building sensors")
+    parser.add_argument("--config", default=os.environ.get("LOADGEN_CONFIG"), help="JSON config file")
+    parser.add_argument("--broker")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--rate", dest="target_rate", type=float,
+                        help="aggregate readings per second; messages per second is this divided by --batch-size")
+    parser.add_argument("--duration", type=float, help="seconds, 0 runs until interrupted")
+    parser.add_argument("--clients", type=int, help="parallel MQTT connections")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2])
+    parser.add_argument("--format", dest="payload_format", choices=sorted(CONTENT_TYPES))
+    parser.add_argument("--batch-size", type=int, help="readings per MQTT message")
+    parser.add_argument("--output", help="write the summary JSON to this file")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("METRICS_PORT", 0)) or None,
+                        help="serve Prometheus metrics on this port")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.metrics_port:
+        logger.info(f"Metrics available on :{start_metrics_server(args.metrics_port)}/metrics")
+    config = load_config(args.config, broker=args.broker, port=args.port, target_rate=args.target_rate,
+                         duration=args.duration, clients=args.clients, qos=args.qos,
+                         payload_format=args.payload_format, batch_size=args.batch_size)
+    summary = LoadGenerator(config).run()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+from prometheus_client import Counter, Histogram, REGISTRY, start_http_server
+from stats import SampledLog, StatsCollector  # noqa: F401 (re-exported)
+
+# Same conventions as subscriber/metrics.py; StatsCollector and SampledLog come from the shared stats.py
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+MESSAGES_PUBLISHED = Counter("publisher_messages_published", "MQTT messages handed to the client", ["topic"])
+PUBLISH_FAILED = Counter("publisher_publish_failed", "MQTT publishes rejected by the client", ["topic"])
+BYTES_PUBLISHED = Counter("publisher_bytes_published", "Payload bytes published")
+ACK_SECONDS = Histogram("publisher_ack_seconds", "Time from publish to broker acknowledgement (QoS 1/2)",
+                        buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+collector = StatsCollector()
+REGISTRY.register(collector)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics over HTTP from a daemon thread"""
+    start_http_server(port)
+    return port
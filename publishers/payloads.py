@@ -0,0 +1,64 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # msgpack is only needed for the "msgpack" format
+    msgpack = None
+
+# Compact wire formats for sensor readings. A reading is the tuple
+# (device_id, zone_id, field, value, timestamp_ms, unit). Field and unit
+# strings are interned to one-byte codes shared with the subscriber.
+FIELD_CODES = {"temperature": 1, "humidity": 2, "co2": 3}
+UNIT_CODES = {"F": 1, "%": 2, "ppm": 3}
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/x-msgpack",
+    "struct": "application/vnd.bms.readings",
+}
+
+# struct layout: header (magic, version, count) then per reading
+# device id length + bytes, zone id, field code, unit code, value, epoch millis
+STRUCT_MAGIC = b"BR"
+STRUCT_VERSION = 1
+STRUCT_HEADER = struct.Struct("!2sBH")
+STRUCT_READING = struct.Struct("!HBBdq")
+MAX_BATCH = 65535
+
+
+def batch_topic(building_id, payload_format):
+    """Topic a gateway publishes batched envelopes to"""
+    return f"{building_id}/sensors/batch/{payload_format}"
+
+
+def encode_readings(readings, payload_format):
+    """Encode a list of readings as one payload in the given format"""
+    if len(readings) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} readings per envelope")
+
+    if payload_format == "json":
+        return json.dumps({"readings": [
+            {"device_id": device_id, "zone_id": zone_id, "field": field, "reading": value,
+             "timestamp_ms": timestamp_ms, "unit": unit}
+            for device_id, zone_id, field, value, timestamp_ms, unit in readings
+        ]})
+
+    if payload_format == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("The msgpack payload format requires the msgpack package")
+        return msgpack.packb({"v": 1, "r": [
+            [device_id, zone_id, FIELD_CODES[field], UNIT_CODES[unit], value, timestamp_ms]
+            for device_id, zone_id, field, value, timestamp_ms, unit in readings
+        ]})
+
+    if payload_format == "struct":
+        parts = [STRUCT_HEADER.pack(STRUCT_MAGIC, STRUCT_VERSION, len(readings))]
+        for device_id, zone_id, field, value, timestamp_ms, unit in readings:
+            device_bytes = device_id.encode()
+            parts.append(bytes((len(device_bytes),)))
+            parts.append(device_bytes)
+            parts.append(STRUCT_READING.pack(zone_id, FIELD_CODES[field], UNIT_CODES[unit], value, timestamp_ms))
+        return b"".join(parts)
+
+    raise ValueError(f"Unknown payload format: {payload_format}")
@@ -1,6 +1,10 @@
 import os
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from devices import Device, TemperatureSensor, HumiditySensor, CO2Sensor
+from payloads import CONTENT_TYPES, encode_readings
+from metrics import MESSAGES_PUBLISHED, PUBLISH_FAILED, BYTES_PUBLISHED, SampledLog, start_metrics_server
 import logging
 import logging.handlers
 from datetime import datetime
@@ -12,17 +16,29 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger('mqtt_publisher')
+# Per-publish lines are sampled; the counts are in the metrics
+sampled_info = SampledLog(logger.info)
+sampled_error = SampledLog(logger.error)
 
 # MQTT Publisher for devices
 class DevicePublisher:
-    def __init__(self, broker_host, topic_prefix="building/sensors"):
+    def __init__(self, broker_host, topic_prefix="building/sensors", payload_format="json"):
         self.client = mqtt.Client(protocol=mqtt.MQTTv5)
         self.broker_host = broker_host
         self.topic_prefix = topic_prefix
         self.devices = []
+        self.topics = []  # per device, built once
+
+        # Compact formats are announced with the MQTT v5 content type
+        self.payload_format = payload_format
+        self.properties = None
+        if payload_format != "json":
+            self.properties = Properties(PacketTypes.PUBLISH)
+            self.properties.ContentType = CONTENT_TYPES[payload_format]
         
     def add_device(self, device: Device):
         self.devices.append(device)
+        self.topics.append(f"{self.topic_prefix}/zone{device._zone_id}/{device._measurement_info['field']}")
         
     def connect(self):
         logger.info(f"Connecting to MQTT broker at {self.broker_host}...")
@@ -47,18 +63,27 @@ class DevicePublisher:
         
         try:
             while True:
-                for device in self.devices:
-                    # Create device-specific topic
-                    zone_topic = f"{self.topic_prefix}/zone{device._zone_id}/{device._measurement_info['field']}"
-                    message = device.generate_message()
+                for device, zone_topic in zip(self.devices, self.topics):
+                    if self.payload_format == "json":
+                        message = device.generate_message()
+                    else:
+                        message = encode_readings([device.generate_reading()], self.payload_format)
                     
                     # Publish message
-                    result = self.client.publish(zone_topic, message)
+                    result = self.client.publish(zone_topic, message, properties=self.properties)
                     status = result[0]
                     if status == 0:
-                        logger.info(f"Published to {zone_topic}: {message}")
+                        MESSAGES_PUBLISHED.labels(zone_topic).inc()
+                        BYTES_PUBLISHED.inc(len(message))
+                        if self.payload_format == "json":
+                            sampled_info(zone_topic, "Published to {}: {}", zone_topic, message)
+                        else:
+                            # Binary payloads aren't readable in a log line
+                            sampled_info(zone_topic, "Published to {}: {} byte {} payload",
+                                         zone_topic, len(message), self.payload_format)
                     else:
-                        logger.error(f"Failed to publish to {zone_topic}")
+                        PUBLISH_FAILED.labels(zone_topic).inc()
+                        sampled_error(zone_topic, "Failed to publish to {}", zone_topic)
                     
                     # Small delay between device publishes
                     time.sleep(0.5)
@@ -76,7 +101,8 @@ def main():
     broker_host = os.environ.get("MQTT_BROKER", "mqtt-broker")
     
     # Create publisher
-    publisher = DevicePublisher(broker_host, topic_prefix="hyatt-place/sensors")
+    publisher = DevicePublisher(broker_host, topic_prefix="hyatt-place/sensors",
+                                payload_format=os.environ.get("PAYLOAD_FORMAT", "json"))
     
     # Create multiple devices across different zones
     # Zone 1 (Office area)
@@ -101,4 +127,10 @@ if __name__ == "__main__":
     # Allow time for the broker to start up
     print("Waiting for services to start...")
     time.sleep(10)
-    main()
\ No newline at end of file
+    logger.info(f"Metrics available on :{start_metrics_server()}/metrics")
+    if os.environ.get("PUBLISHER_MODE") == "loadgen":
+        # Capacity testing: simulate a large fleet from LOADGEN_CONFIG
+        import loadgen
+        loadgen.LoadGenerator(loadgen.load_config(os.environ.get("LOADGEN_CONFIG", "loadgen.json"))).run()
+    else:
+        main()
\ No newline at end of file
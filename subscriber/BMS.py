@@ -1,28 +1,225 @@
+import argparse
 import json
+import multiprocessing
 import os
+import signal
 import time
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
 import paho.mqtt.client as mqtt
+from sqlalchemy import insert, text
+from sqlalchemy.exc import InterfaceError, OperationalError
 from sqlalchemy.orm import Session
-from db_models import init_db, Device, Measurement
+from db_models import DEFAULT_BUILDING, Device, Measurement, Zone, load_spool_position, save_spool_position
+from buildings import ShardMap, building_from_topic
+from cleaning import BatchCleaner
+from deadband import DEADBAND_FILTER, MAX_SILENCE, DeadbandFilter
+from latest import LATEST_ENABLED, LatestState, get_current_state, upsert_latest
+from anomaly import (ANOMALY_DETECTION, ANOMALY_FLUSH_INTERVAL, ALERT_KINDS, ALERT_QOS, ALERT_TOPIC,
+                     AnomalyDetector, alert_message, store_alerts)
+from ingest import BatchWriter, RejectedRows, isolate_failures
+from metrics import (MESSAGES_FAILED, READINGS_RECEIVED, READINGS_REJECTED, READINGS_STORED, WRITE_ERRORS,
+                     PARSE_SECONDS, CLEAN_SECONDS, COMMIT_SECONDS, BATCH_ROWS, SampledLog, collector, pool_stats,
+                     count_message, start_metrics_server)
+from payloads import decode_readings
+from spool import Spool, POSITION_KEY, SEGMENT_SUFFIX, CHECKPOINT_FILE
+from partitions import start_partition_maintenance
+from archive import ARCHIVE_AFTER_DAYS, read_archived_series, read_watermark, start_archive_maintenance
+from rollups import (ROLLUPS_ENABLED, update_rollups, choose_resolution, get_zone_average, get_building_average,
+                     get_device_rollup_series)
 
 # Get MQTT broker details from environment
 # because of shared network, internal DNS lookup allows finding container service by name
 # so mqtt-broker: port connects to that process. 
 MQTT_BROKER = os.environ.get("MQTT_BROKER", "mqtt-broker")
 MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
-MQTT_TOPIC = "hyatt-place/sensors/#"  # Subscribe to all sensor topics
+# Sensor topics of every building; the first topic level is the building id
+MQTT_TOPIC = os.environ.get("MQTT_TOPIC", "+/sensors/#")
+
+# Ingestion mode: "direct" stores every reading in its own transaction,
+# "batch" buffers readings and writes them with one multi-row insert per flush,
+# "spool" appends them to a durable on-disk spool that is drained into the database
+INGEST_MODE = os.environ.get("INGEST_MODE", "direct")
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 500))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 1.0))  # seconds
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", 10000))
+BACKPRESSURE = os.environ.get("BACKPRESSURE", "drop_oldest")  # block, drop_newest or drop_oldest
+# Longest a "block" put may hold the MQTT network thread; keep it well inside the 60s keepalive
+BLOCK_TIMEOUT = float(os.environ.get("BLOCK_TIMEOUT", 0.5))  # seconds
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", 60))  # seconds, 0 disables
+
+# Spool mode: segment files under SPOOL_DIR/<building> survive restarts and database outages
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "/app/spool")
+SPOOL_SEGMENT_MB = int(os.environ.get("SPOOL_SEGMENT_MB", 64))
+SPOOL_MAX_MB = int(os.environ.get("SPOOL_MAX_MB", 1024))  # readings are dropped beyond this
+SPOOL_BATCH_SIZE = int(os.environ.get("SPOOL_BATCH_SIZE", 5000))  # max rows per replayed insert
+SPOOL_FSYNC_INTERVAL = float(os.environ.get("SPOOL_FSYNC_INTERVAL", 0.5))  # seconds
+
+# Range/null/timestamp validation of every batch before it is written (see cleaning.py)
+BATCH_CLEANING = os.environ.get("BATCH_CLEANING", "1") == "1"
+
+# Optionally NOTIFY listeners (e.g. the frontend cache) which zones received new data
+NOTIFY_ON_INGEST = os.environ.get("NOTIFY_ON_INGEST", "0") == "1"
+NOTIFY_CHANNEL = os.environ.get("NOTIFY_CHANNEL", "measurements_ingested")
+
+# Errors that say nothing about the rows being written: batches failing with them are retried whole
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+# Scale-out: with more than one worker, WORKER_ROUTING=device has every process subscribe
+# to the full topic and keep only the devices that hash to it, so the per-device state
+# (cleaner history, deadband, latest readings, anomaly bounds) lives in one process.
+# WORKER_ROUTING=shared uses an MQTT v5 shared subscription ($share/<group>/<topic>) and
+# lets the broker load-balance messages, which only works without those stages
+BMS_WORKERS = int(os.environ.get("BMS_WORKERS", 1))
+WORKER_ROUTING = os.environ.get("WORKER_ROUTING", "device")  # device or shared
+MQTT_SHARE_GROUP = os.environ.get("MQTT_SHARE_GROUP", "bms")
+
+
+def shared_topic(topic, group=MQTT_SHARE_GROUP):
+    """Shared-subscription form of a topic filter"""
+    return f"$share/{group}/{topic}"
+
+
+def device_partition(device_id, workers):
+    """Worker owning a device's readings under WORKER_ROUTING=device"""
+    return zlib.crc32(str(device_id).encode()) % workers
+
+
+def stateful_stages():
+    """Enabled stages that keep per-device state and need all of a device's readings in one process"""
+    stages = {"BATCH_CLEANING": BATCH_CLEANING, "DEADBAND_FILTER": DEADBAND_FILTER,
+              "LATEST_ENABLED": LATEST_ENABLED, "ANOMALY_DETECTION": ANOMALY_DETECTION}
+    return [name for name, enabled in stages.items() if enabled]
 
 class BuildingManagementSystem:
-    def __init__(self):
-        # Initialize database connection
-        self.engine, self.SessionFactory = init_db()
-        
+    def __init__(self, worker_id=None, topic=MQTT_TOPIC, workers=1):
+        self.worker_id = worker_id
+        self.topic = topic
+        # With device routing every worker receives every message and keeps its own devices
+        self.workers = workers
+
+        # Initialize database connections: the default database plus any building shards
+        # (BUILDING_DATABASES), each with its own pool and registry of known devices and
+        # zones, so the hot path doesn't query for them
+        self.shards = ShardMap()
+        default = self.shards.default
+        self.engine, self.SessionFactory, self.registry = default.engine, default.SessionFactory, default.registry
+
+        self.init_pipeline()
+
         # Initialize MQTT client
-        self.client = mqtt.Client(protocol=mqtt.MQTTv5)
+        client_id = f"bms-worker-{worker_id}-{os.getpid()}" if worker_id is not None else ""
+        self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.connected = False
+
+        # In-stream alerting on the raw readings. It runs on its own thread, so it never
+        # waits on the database or a spool backlog, and drops its oldest readings rather
+        # than slowing ingestion down when it falls behind
+        if self.detector is not None:
+            self.anomaly_stage = BatchWriter(
+                self.process_alerts,
+                batch_size=BATCH_SIZE,
+                flush_interval=ANOMALY_FLUSH_INTERVAL,
+                max_queue=MAX_QUEUE,
+                backpressure="drop_oldest",
+                stats_interval=0,
+                name="anomaly",
+            )
+
+        # In batch and spool mode on_message only enqueues. Every building gets its own
+        # writer thread (or spool), created on its first message, so a busy building or a
+        # slow shard only backs up its own queue
+        self.writers = {}  # building id -> BatchWriter or Spool
+        if INGEST_MODE == "spool":
+            self.spool_dir = SPOOL_DIR if worker_id is None else os.path.join(SPOOL_DIR, f"worker-{worker_id}")
+            adopt_legacy_spool(self.spool_dir, DEFAULT_BUILDING)
+            # Resume draining the backlog of every building spooled before a restart
+            if os.path.isdir(self.spool_dir):
+                for building_id in sorted(os.listdir(self.spool_dir)):
+                    if os.path.isdir(os.path.join(self.spool_dir, building_id)):
+                        self.add_writer(building_id)
+        self.register_metrics()
+
+    def init_pipeline(self):
+        """Create the stages every engine runs readings through between parsing and the database"""
+        # Vectorized validation; keeps per device+field history for median fallbacks
+        self.cleaner = BatchCleaner() if BATCH_CLEANING else None
+        # Change-of-value filter deciding which cleaned readings are stored as raw rows
+        self.deadband = DeadbandFilter() if DEADBAND_FILTER else None
+        # Newest reading per device+field, mirrored into latest_readings
+        self.latest = LatestState() if LATEST_ENABLED else None
+        # In-stream alerting on the raw readings, before the cleaner repairs them
+        self.detector = AnomalyDetector() if ANOMALY_DETECTION else None
+        # Per-message events are logged sampled; counts live in the metrics
+        self.log = SampledLog()
+
+    def register_pipeline_metrics(self):
+        """Export the stats of the stages created by init_pipeline"""
+        if self.cleaner is not None:
+            collector.register("bms_cleaning", self.cleaner.stats, counters=self.cleaner.stats())
+        if self.deadband is not None:
+            collector.register("bms_deadband", self.deadband.stats, counters=(
+                "seen", "stored", "suppressed", "changed", "heartbeat", "first", "out_of_order"))
+        if self.latest is not None:
+            collector.register("bms_latest", self.latest.stats)
+        if self.detector is not None:
+            collector.register("bms_anomaly", self.detector.stats, counters=("seen",) + ALERT_KINDS)
+
+    def print_pipeline_stats(self):
+        if self.cleaner is not None:
+            print(f"Cleaning: {self.cleaner.stats()}")
+        if self.deadband is not None:
+            print(f"Deadband filter: {self.deadband.stats()}")
+        if self.detector is not None:
+            print(f"Anomaly detection: {self.detector.stats()}")
+
+    def register_metrics(self):
+        """Export component stats (read at scrape time) alongside the hot-path metrics"""
+        for shard in self.shards.all():
+            collector.register("bms_db_pool", pool_stats(shard.engine.pool), labels={"database": shard.name})
+        self.register_pipeline_metrics()
+        if self.detector is not None:
+            collector.register("bms_anomaly_queue", self.anomaly_stage.stats, counters=(
+                "enqueued", "dropped", "flushes", "flushed_rows", "failed_flushes", "failed_rows"))
+
+    def add_writer(self, building_id):
+        """Create and start the batch writer or spool for a building's readings"""
+        if INGEST_MODE == "spool":
+            shard = self.shards.for_building(building_id)
+            writer = Spool(
+                os.path.join(self.spool_dir, building_id),
+                self.write_batch,
+                segment_bytes=SPOOL_SEGMENT_MB * 1024 * 1024,
+                max_bytes=SPOOL_MAX_MB * 1024 * 1024,
+                batch_size=SPOOL_BATCH_SIZE,
+                fsync_interval=SPOOL_FSYNC_INTERVAL,
+                # Only connection problems are retried; anything else would fail again
+                retry_on=TRANSIENT_ERRORS,
+                stats_interval=STATS_INTERVAL,
+                name=building_id,
+                # Stored by write_rows with the rows, so replayed batches are skipped
+                stored_position=lambda spool_id: load_spool_position(shard.engine, spool_id),
+            )
+            collector.register("bms_spool", writer.stats, labels={"building": building_id}, counters=(
+                "appended", "dropped", "drained", "retries", "failed_batches", "failed_rows", "quarantined", "skipped"))
+        else:
+            writer = BatchWriter(
+                self.write_batch,
+                batch_size=BATCH_SIZE,
+                flush_interval=FLUSH_INTERVAL,
+                max_queue=MAX_QUEUE,
+                backpressure=BACKPRESSURE,
+                put_timeout=BLOCK_TIMEOUT,
+                stats_interval=STATS_INTERVAL,
+                name=building_id,
+            )
+            collector.register("bms_batch", writer.stats, labels={"building": building_id}, counters=(
+                "enqueued", "dropped", "flushes", "flushed_rows", "failed_flushes", "failed_rows"))
+        writer.start()
+        self.writers[building_id] = writer
+        return writer
     
     def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback when connected to MQTT broker"""
@@ -30,91 +227,268 @@ class BuildingManagementSystem:
             print(f"Connected to MQTT broker at {MQTT_BROKER}")
             self.connected = True
             # Subscribe to the building sensors topic
-            self.client.subscribe(MQTT_TOPIC)
-            print(f"Subscribed to topic: {MQTT_TOPIC}")
+            self.client.subscribe(self.topic)
+            print(f"Subscribed to topic: {self.topic}")
         else:
             print(f"Failed to connect to MQTT broker with result code {rc}")
             self.connected = False
     
     def on_message(self, client, userdata, msg):
         """Callback when message is received"""
+        count_message(msg.topic)
         try:
-            # Parse message payload
-            payload = json.loads(msg.payload.decode())
-            
             # Extract topic components
             topic_parts = msg.topic.split('/')
-            if len(topic_parts) < 3:
-                print(f"Invalid topic format: {msg.topic}")
+            building_id = building_from_topic(msg.topic)
+            if len(topic_parts) < 3 or building_id is None:
+                MESSAGES_FAILED.inc()
+                self.log("invalid-topic", "Invalid topic format: {}", msg.topic)
                 return
             
-            print(f"Received message on topic {msg.topic}: {payload}")
-            
-            # Process and store the measurement
-            self.process_measurement(payload)
+            # Parse message payload; JSON, msgpack or struct, single readings or batches
+            start = time.perf_counter()
+            readings = self.owned(decode_readings(msg))
+            if not readings:
+                return
+
+            if INGEST_MODE in ("batch", "spool"):
+                # Hand off to the building's batch writer or spool; no database work on the network thread
+                rows = self.parse_readings(readings, building_id)
+                PARSE_SECONDS.observe(time.perf_counter() - start)
+                READINGS_RECEIVED.inc(len(rows))
+                self.detect_anomalies(rows)
+                writer = self.writers.get(building_id) or self.add_writer(building_id)
+                for row in rows:
+                    writer.put(row)
+                return
+
+            PARSE_SECONDS.observe(time.perf_counter() - start)
+            READINGS_RECEIVED.inc(len(readings))
+            self.log("received", "Received {} readings on topic {}", len(readings), msg.topic)
+
+            # Process and store the message's readings (a whole envelope) in one transaction
+            self.process_measurements(readings, building_id)
             
         except json.JSONDecodeError as e:
-            print(f"Error decoding JSON payload: {e}")
+            MESSAGES_FAILED.inc()
+            self.log("decode-error", "Error decoding JSON payload: {}", e)
         except Exception as e:
-            print(f"Error processing message: {e}")
+            MESSAGES_FAILED.inc()
+            self.log("message-error", "Error processing message: {}", e)
+
+    def owned(self, readings):
+        """Readings of the devices this worker owns; all of them unless routing by device"""
+        if self.workers <= 1:
+            return readings
+        return [data for data in readings
+                if device_partition(data.get("device_id"), self.workers) == self.worker_id]
 
     def clean_data(self, timestamp_str, reading, zone_id):
-        # Convert timestamp string to datetime
-        try:
-            timestamp = datetime.fromisoformat(timestamp_str)
-        except (ValueError, TypeError):
-            timestamp = datetime.now()  # Fallback to current time
+        # Convert timestamp string to datetime (compact payloads are already decoded)
+        if isinstance(timestamp_str, datetime):
+            timestamp = timestamp_str
+        else:
+            try:
+                timestamp = datetime.fromisoformat(timestamp_str)
+            except (ValueError, TypeError):
+                timestamp = datetime.now()  # Fallback to current time
         
         zone_id = max(0, int(zone_id))
-        # could implement some check if reading in valid range, if NULL set to median value, etc
+        # Range checks and NULL/outlier replacement happen per batch in BatchCleaner
 
         return timestamp, reading, zone_id
         
     
-    def process_measurement(self, data):
-        """Process and store measurement data in the database"""
+    def parse_readings(self, readings, building_id=DEFAULT_BUILDING):
+        """Parse a message's readings into rows, skipping (and counting) those that can't be stored"""
+        rows = []
+        for data in readings:
+            try:
+                rows.append(self.parse_measurement(data, building_id))
+            except (ValueError, TypeError, AttributeError) as e:
+                READINGS_REJECTED.labels("invalid").inc()
+                self.log("invalid-reading", "Skipping invalid reading: {}", e)
+        return rows
+
+    def parse_measurement(self, data, building_id=DEFAULT_BUILDING):
+        """Extract and clean the fields of a reading into a measurement row"""
+        device_id = data.get('device_id')
+        zone_id = data.get('zone_id')
+        reading = data.get('reading')
+        timestamp_str = data.get('timestamp')
+        field = data.get('field')
+        unit = data.get('unit')
+        # Keys of the stored row and of the cleaner's and detector's per-series state
+        for name, text_value in (("device_id", device_id), ("field", field), ("unit", unit)):
+            if not isinstance(text_value, str) or not text_value:
+                raise ValueError(f"Reading without a valid {name}: {text_value!r}")
+
+        timestamp, reading, zone_id = self.clean_data(timestamp_str, reading, zone_id)
+
         try:
-            # Create a new database session
-            session = self.SessionFactory()
-            
-            # Extract fields from the data
-            device_id = data.get('device_id')
-            zone_id = data.get('zone_id')
-            reading = data.get('reading')
-            timestamp_str = data.get('timestamp')
-            field = data.get('field')
-            unit = data.get('unit')
-
-            timestamp, reading, zone_id = self.clean_data(timestamp_str, reading, zone_id)
-            
-            # Check if device exists in the database
-            device = session.query(Device).filter_by(id=device_id).first()
-            if not device:
-                # Create new device
-                device_type = device_id.split('-')[0]  # Extract type from device_id (e.g., 'temp' from 'temp-1')
-                device = Device(id=device_id, zone_id=zone_id, device_type=device_type)
-                session.add(device)
-                print(f"Added new device: {device_id}")
-            
-            # Create new measurement
-            measurement = Measurement(
-                device_id=device_id,
-                timestamp=timestamp,
-                field=field,
-                value=float(reading),
-                unit=unit
-            )
-            session.add(measurement)
-            
-            # Commit changes
+            value = float(reading)
+        except (ValueError, TypeError):
+            if self.cleaner is None:
+                raise
+            value = float("nan")  # replaced with the rolling median by the cleaner
+
+        return {
+            "device_id": device_id,
+            "zone_id": zone_id,
+            "timestamp": timestamp,
+            "field": field,
+            "value": value,
+            "unit": unit,
+            "building_id": building_id,
+        }
+
+    def write_rows(self, session, rows, registry=None, stored=None):
+        """Issue the statements storing a batch in the session's transaction; returns new devices
+
+        stored is the subset of rows kept as raw measurements (all of them by
+        default); devices, rollups and notifications always cover every row.
+        """
+        registry = registry or self.registry
+        stored = rows if stored is None else stored
+        # Upsert devices the registry hasn't seen; known devices cost no query
+        device_zones = {row["device_id"]: (row["zone_id"], row["building_id"]) for row in rows}
+        new_devices = registry.ensure_devices(session, device_zones)
+        in_zone = lambda row: registry.has_zone(row["zone_id"], row["building_id"])
+
+        # One multi-row INSERT for the whole batch
+        if stored:
+            session.execute(insert(Measurement), [
+                {
+                    "device_id": row["device_id"],
+                    "timestamp": row["timestamp"],
+                    "field": row["field"],
+                    "value": row["value"],
+                    "unit": row["unit"],
+                } for row in stored
+            ])
+        if ROLLUPS_ENABLED:
+            # 1-minute/1-hour/1-day aggregates, committed with the raw rows
+            update_rollups(session, rows, in_zone)
+        if self.latest is not None:
+            # Current state, from every reading including those the deadband filter held back
+            upsert_latest(session, self.latest.merge(rows))
+        positions = [row[POSITION_KEY] for row in rows if POSITION_KEY in row]
+        if positions:
+            # Spooled rows: how far the spool is stored commits or rolls back with them
+            spool_id, *position = max(positions)
+            save_spool_position(session, spool_id, position)
+        if NOTIFY_ON_INGEST:
+            # Delivered on commit, once per zone touched by the batch and once per building
+            payloads = [str(zone_id) for zone_id in sorted({row["zone_id"] for row in rows if in_zone(row)})]
+            payloads += [f"building:{building_id}" for building_id in sorted({row["building_id"] for row in rows})]
+            for payload in payloads:
+                session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                {"channel": NOTIFY_CHANNEL, "payload": payload})
+        return new_devices
+
+    def write_batch(self, rows, reject=None):
+        """Store a batch of one building's measurement rows in a single transaction; returns the rows accepted
+
+        Readings held back by the deadband filter count as accepted: they are
+        reflected in the rollups, just not stored as raw rows. If the batch
+        fails for a reason other than the database being unavailable it is
+        split until the offending rows are found; the rest is stored, reject
+        is called for each offending row and RejectedRows is raised.
+        """
+        rows, stored = self.prepare_batch(rows)
+        if not rows:
+            return 0
+        shard = self.shards.for_building(rows[0]["building_id"])
+        kept = {id(row) for row in stored}
+        failed, error = isolate_failures(
+            lambda chunk: self.store_rows(shard, chunk, [row for row in chunk if id(row) in kept]),
+            rows, TRANSIENT_ERRORS, reject)
+        if failed:
+            raise RejectedRows(failed, error)
+        return len(rows)
+
+    def prepare_batch(self, rows):
+        """Clean a batch and pick the readings stored as raw rows; returns (rows, stored)"""
+        if self.cleaner is not None:
+            with CLEAN_SECONDS.time():
+                rows = self.cleaner.clean(rows)
+        stored = self.deadband.filter(rows) if self.deadband is not None and rows else rows
+        return rows, stored
+
+    def batch_failed(self, rows):
+        """Undo the in-memory effects of a batch whose transaction rolled back"""
+        WRITE_ERRORS.inc()
+        if self.deadband is not None:
+            # The filter already counted these as stored
+            self.deadband.forget(rows)
+        if self.latest is not None:
+            self.latest.forget(rows)
+
+    def batch_committed(self, rows, stored, new_devices, registry, start):
+        COMMIT_SECONDS.observe(time.perf_counter() - start)
+        READINGS_STORED.inc(len(stored))
+        BATCH_ROWS.observe(len(rows))
+        registry.mark_registered(new_devices)
+
+    def store_rows(self, shard, rows, stored):
+        """Write cleaned rows to a shard in one transaction"""
+        start = time.perf_counter()
+        session = shard.SessionFactory()
+        try:
+            new_devices = self.write_rows(session, rows, shard.registry, stored)
             session.commit()
-            print(f"Stored measurement: {field}={reading}{unit} for device {device_id}")
-            
-        except Exception as e:
-            print(f"Error storing measurement: {e}")
+        except Exception:
             session.rollback()
+            self.batch_failed(rows)
+            raise
         finally:
             session.close()
+        self.batch_committed(rows, stored, new_devices, shard.registry, start)
+
+    def detect_anomalies(self, rows):
+        """Hand raw readings to the anomaly detection stage"""
+        if self.detector is not None:
+            for row in rows:
+                # Copies: the cleaner repairs values in place before they are stored
+                self.anomaly_stage.put(dict(row))
+
+    def process_alerts(self, rows):
+        """Run a batch of raw readings through the detector, then publish and store its alerts"""
+        alerts = self.detector.detect(rows)
+        if not alerts:
+            return
+        # MQTT first, so alerts go out even while the database is unavailable
+        for alert in alerts:
+            topic, payload = alert_message(alert)
+            self.client.publish(topic, payload, qos=ALERT_QOS)
+        by_shard = {}
+        for alert in alerts:
+            by_shard.setdefault(self.shards.for_building(alert["building_id"]), []).append(alert)
+        for shard, shard_alerts in by_shard.items():
+            session = shard.SessionFactory()
+            try:
+                store_alerts(session, shard_alerts)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    def process_measurements(self, readings, building_id=DEFAULT_BUILDING):
+        """Process and store the readings of one message in a single transaction"""
+        try:
+            rows = self.parse_readings(readings, building_id)
+            self.detect_anomalies(rows)
+            stored = self.write_batch(rows)
+            if stored < len(rows):
+                self.log("rejected", "Rejected {} of {} measurements: no valid fallback value",
+                         len(rows) - stored, len(rows))
+            if stored:
+                self.log("stored", "Stored {} measurements from building {}", stored, building_id)
+
+        except Exception as e:
+            self.log("store-error", "Error storing measurements: {}", e)
     
     def connect_mqtt(self):
         """Connect to the MQTT broker with retries"""
@@ -151,33 +525,85 @@ class BuildingManagementSystem:
         # manual interface.
 
         if self.connect_mqtt():
+            start_metrics_server(self.worker_id)
+            if self.detector is not None:
+                self.anomaly_stage.start()
+                print(f"Anomaly detection enabled (alerts published to {ALERT_TOPIC})")
+            if self.worker_id in (None, 0):
+                # One process keeps future measurement partitions created, in every shard
+                for shard in self.shards.all():
+                    start_partition_maintenance(shard.engine)
+                if ARCHIVE_AFTER_DAYS > 0:
+                    # Only the default database is archived; rollups stay in Postgres
+                    start_archive_maintenance(self.engine)
+            if INGEST_MODE == "spool":
+                print(f"Spooled ingestion enabled ({self.spool_dir}/<building>, max {SPOOL_MAX_MB}MB per building)")
+            elif INGEST_MODE == "batch":
+                print(f"Batch ingestion enabled (batch size {BATCH_SIZE}, flush interval {FLUSH_INTERVAL}s, "
+                      f"one writer per building)")
             try:
                 # Start the MQTT loop                
                 self.client.loop_forever()
             except KeyboardInterrupt:
                 print("Shutting down...")
             finally:
+                if self.detector is not None:
+                    # Publish the last alerts while still connected
+                    self.anomaly_stage.stop()
                 self.client.disconnect()
                 print("Disconnected from MQTT broker")
+                for building_id, writer in list(self.writers.items()):
+                    # Flush whatever is still buffered before exiting
+                    writer.stop()
+                    print(f"{INGEST_MODE.capitalize()} writer for {building_id} stopped: {writer.stats()}")
+                self.print_pipeline_stats()
         else:
             print("Could not start the Building Management System due to connection issues")
 
 # Sample functions that could be integrated into frontend; not yet completed. 
 def get_zone_average_temperature(session, zone_id, start_time, end_time):
     """Get the average temperature for a zone during a specific time period"""
-    from sqlalchemy import func
-    return session.query(func.avg(Measurement.value)).\
-        join(Device).\
-        filter(
-            Device.zone_id == zone_id,
-            Measurement.field == 'temperature',
-            Measurement.timestamp >= start_time,
-            Measurement.timestamp <= end_time
-        ).scalar()
+    # Whole buckets come from the coarsest rollup that fits, only the edges hit raw rows
+    return get_zone_average(session, zone_id, 'temperature', start_time, end_time)
+
+def get_building_zones(session, building_id):
+    """Get the zones of a building"""
+    return session.query(Zone).filter(Zone.building_id == building_id).order_by(Zone.id).all()
+
+def get_building_average_temperature(session, building_id, start_time, end_time):
+    """Get the average temperature over all zones of a building during a specific time period"""
+    return get_building_average(session, building_id, 'temperature', start_time, end_time)
 
-def get_device_timeseries(session, device_id, field, start_time, end_time):
-    """Get a timeseries of measurements for a specific device and field"""
-    return session.query(Measurement.timestamp, Measurement.value).\
+def get_zone_current_state(session, zone_id):
+    """Newest reading of every device and field in a zone, from latest_readings"""
+    return get_current_state(session, zone_id=zone_id)
+
+def get_building_current_state(session, building_id):
+    """Newest reading of every device and field in a building's zones"""
+    return get_current_state(session, building_id=building_id)
+
+def get_device_timeseries(session, device_id, field, start_time, end_time, resolution="auto"):
+    """Get a timeseries of measurements for a specific device and field
+
+    With resolution="auto" long ranges are served from the coarsest rollup that
+    still gives a useful number of points; pass None to force raw readings or
+    '1m'/'1h'/'1d' for a specific rollup. Raw readings older than the archive
+    watermark are read from the Parquet archive (see archive.py).
+    """
+    if resolution == "auto":
+        resolution = choose_resolution(start_time, end_time)
+    if resolution is not None:
+        return get_device_rollup_series(session, device_id, field, start_time, end_time, resolution)
+
+    archived = []
+    watermark = read_watermark()
+    if watermark is not None and start_time < watermark:
+        archived = read_archived_series(device_id, field, start_time, min(end_time, watermark))
+        if end_time < watermark:
+            return archived
+        start_time = watermark
+
+    return archived + session.query(Measurement.timestamp, Measurement.value).\
         filter(
             Measurement.device_id == device_id,
             Measurement.field == field,
@@ -185,11 +611,120 @@ def get_device_timeseries(session, device_id, field, start_time, end_time):
             Measurement.timestamp <= end_time
         ).order_by(Measurement.timestamp).all()
 
+def get_device_step_series(session, device_id, field, start_time, end_time, interval=None):
+    """Step-wise series of a device and field, for data stored through the deadband filter
+
+    Each stored reading holds until the next one. The series starts with the
+    value held at start_time (the last reading before it; heartbeats bound how
+    far back that is). With interval (a timedelta) the held value is sampled
+    on a regular grid from start_time instead of returning the change points.
+    """
+    rows = get_device_timeseries(session, device_id, field, start_time, end_time, resolution=None)
+    if not rows or rows[0][0] > start_time:
+        # The held value may be older than the archive watermark, so go through the archive-aware reader
+        before = get_device_timeseries(session, device_id, field, start_time - timedelta(seconds=MAX_SILENCE),
+                                       start_time, resolution=None)
+        before = [row for row in before if row[0] < start_time]
+        if before:
+            rows = [(start_time, before[-1][1])] + list(rows)
+    if interval is None:
+        return rows
+
+    samples = []
+    held = None
+    i = 0
+    t = start_time
+    while t <= end_time:
+        while i < len(rows) and rows[i][0] <= t:
+            held = rows[i][1]
+            i += 1
+        samples.append((t, held))
+        t += interval
+    return samples
+
+def adopt_legacy_spool(spool_dir, building_id):
+    """Move a spool written before per-building spools into building_id's directory"""
+    if not os.path.isdir(spool_dir):
+        return
+    names = [name for name in os.listdir(spool_dir) if name.endswith(SEGMENT_SUFFIX) or name == CHECKPOINT_FILE]
+    target = os.path.join(spool_dir, building_id)
+    if not names or os.path.exists(target):
+        return
+    os.makedirs(target)
+    for name in names:
+        os.rename(os.path.join(spool_dir, name), os.path.join(target, name))
+    print(f"Moved existing spool in {spool_dir} to {target}")
+
+def run_worker(worker_id, topic, workers=1):
+    """Entry point of a worker process; builds its own engine, pool and MQTT client"""
+    bms = BuildingManagementSystem(worker_id=worker_id, topic=topic, workers=workers)
+    try:
+        bms.run()
+    except KeyboardInterrupt:
+        pass
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_workers(num_workers, target=run_worker):
+    """Run num_workers subscriber processes, routed by device or sharing one MQTT subscription"""
+    if WORKER_ROUTING == "device":
+        topic, workers = MQTT_TOPIC, num_workers
+    elif WORKER_ROUTING == "shared":
+        stages = stateful_stages()
+        if stages:
+            raise SystemExit(f"WORKER_ROUTING=shared spreads a device's readings over workers, which breaks "
+                             f"per-device state; disable {', '.join(stages)} or use WORKER_ROUTING=device")
+        topic, workers = shared_topic(MQTT_TOPIC), 1
+    else:
+        raise SystemExit(f"Unknown WORKER_ROUTING: {WORKER_ROUTING}")
+
+    # Treat SIGTERM (docker stop) like Ctrl+C; workers inherit the handler, so
+    # each one disconnects and flushes its buffered readings before exiting
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    # Create the schema (in every shard) once up front so workers don't race on create_all
+    for shard in ShardMap().all():
+        shard.engine.dispose()
+
+    print(f"Starting {num_workers} workers on {topic} ({WORKER_ROUTING} routing)")
+    workers_by_id = {}
+    for worker_id in range(num_workers):
+        workers_by_id[worker_id] = multiprocessing.Process(
+            target=target, args=(worker_id, topic, workers), name=f"bms-worker-{worker_id}")
+        workers_by_id[worker_id].start()
+
+    try:
+        # Restart any worker that dies so the pool keeps its size
+        while True:
+            for worker_id, process in workers_by_id.items():
+                process.join(timeout=1)
+                if not process.is_alive():
+                    print(f"Worker {worker_id} exited with code {process.exitcode}; restarting")
+                    workers_by_id[worker_id] = multiprocessing.Process(
+                        target=target, args=(worker_id, topic, workers), name=f"bms-worker-{worker_id}")
+                    workers_by_id[worker_id].start()
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+    finally:
+        for process in workers_by_id.values():
+            process.terminate()
+        for process in workers_by_id.values():
+            process.join()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Building Management System subscriber")
+    parser.add_argument("--workers", type=int, default=BMS_WORKERS,
+                        help="number of subscriber processes (default: $BMS_WORKERS or 1)")
+    args = parser.parse_args()
+
     # Allow time for the database and broker to start up
     print("Waiting for services to start...")
     time.sleep(10)
     
-    # Create and run the Building Management System
-    bms = BuildingManagementSystem()
-    bms.run()
\ No newline at end of file
+    if args.workers > 1:
+        run_workers(args.workers)
+    else:
+        # Create and run the Building Management System
+        bms = BuildingManagementSystem()
+        bms.run()
\ No newline at end of file
@@ -0,0 +1,182 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+import numpy as np
+from sqlalchemy import insert
+from cleaning import FIELD_LIMITS
+from db_models import Alert
+
+# In-stream alerting on incoming readings, before cleaning replaces out-of-range values.
+# ANOMALY_DETECTION=1 enables it; alerts are published to ALERT_TOPIC and stored in `alerts`.
+ANOMALY_DETECTION = os.environ.get("ANOMALY_DETECTION", "0") == "1"
+# (low, high) alert limits per field, the sensor ranges by default;
+# ALERT_LIMITS='{"co2": [null, 1000]}' overrides entries, null disables a side
+ALERT_LIMITS = dict(FIELD_LIMITS)
+ALERT_LIMITS.update({field: tuple(limits) for field, limits in json.loads(os.environ.get("ALERT_LIMITS", "{}")).items()})
+ANOMALY_ALPHA = float(os.environ.get("ANOMALY_ALPHA", 0.05))  # EWMA weight of the newest reading
+ANOMALY_Z = float(os.environ.get("ANOMALY_Z", 4.0))  # |z-score| that raises a statistical alert
+ANOMALY_WARMUP = int(os.environ.get("ANOMALY_WARMUP", 30))  # readings per series before z-scores count
+ALERT_COOLDOWN = float(os.environ.get("ALERT_COOLDOWN", 300))  # seconds between z-score alerts of a series
+# How far back inside its limits a series must come before it counts as back in range: a fraction
+# of the field's limit range, or of |limit| for fields limited on one side only
+ALERT_HYSTERESIS = float(os.environ.get("ALERT_HYSTERESIS", 0.02))
+ALERT_TOPIC = os.environ.get("ALERT_TOPIC", "{building_id}/alerts/{field}")
+ALERT_QOS = int(os.environ.get("ALERT_QOS", 1))
+ANOMALY_FLUSH_INTERVAL = float(os.environ.get("ANOMALY_FLUSH_INTERVAL", 0.25))  # seconds readings wait for detection
+
+ALERT_KINDS = ("above_limit", "below_limit", "back_in_range", "zscore")
+
+
+class AnomalyDetector:
+    """Threshold and EWMA z-score alerts with constant state per device and field.
+
+    Every series keeps an exponentially weighted mean and variance, a reading
+    count, whether it is currently outside its limits, and when it last raised
+    a z-score alert, in NumPy arrays indexed like BatchCleaner's history. A
+    batch is processed in rounds of at most one reading per series, so the
+    statistics update as vectorized array operations while readings of the
+    same series are still applied in order.
+
+    Limit alerts fire when a series leaves its (low, high) band and once more
+    when it is back at least ALERT_HYSTERESIS inside it, so a series hovering
+    at a limit doesn't alert on every crossing. A z-score alert fires when a
+    reading is more than ANOMALY_Z standard deviations from the series' mean,
+    at most once per ALERT_COOLDOWN seconds. The standard deviation is floored
+    at 1% of the field's limit range so steady sensors don't alert on tiny
+    changes.
+    """
+
+    def __init__(self, limits=ALERT_LIMITS, alpha=ANOMALY_ALPHA, z_threshold=ANOMALY_Z, warmup=ANOMALY_WARMUP,
+                 cooldown=ALERT_COOLDOWN, hysteresis=ALERT_HYSTERESIS):
+        self.limits = limits
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self.hysteresis = hysteresis
+        self.slots = {}  # (device_id, field) -> index into the state arrays
+        self.mean = np.zeros(1024)
+        self.var = np.zeros(1024)
+        self.count = np.zeros(1024, dtype=np.int64)
+        self.state = np.zeros(1024, dtype=np.int8)  # 1 above the limits, -1 below, 0 within
+        self.last_z_alert = np.full(1024, -np.inf)
+        self.counters = Counter()
+        self.seen = 0
+        self._lock = threading.Lock()
+
+    def _slot_ids(self, rows):
+        slots = self.slots
+        ids = np.fromiter((slots.setdefault((row["device_id"], row["field"]), len(slots)) for row in rows),
+                          dtype=np.intp, count=len(rows))
+        if len(slots) > len(self.mean):
+            size = max(len(slots), 2 * len(self.mean))
+            for name, fill in (("mean", 0), ("var", 0), ("count", 0), ("state", 0), ("last_z_alert", -np.inf)):
+                old = getattr(self, name)
+                grown = np.full(size, fill, dtype=old.dtype)
+                grown[:len(old)] = old
+                setattr(self, name, grown)
+        return ids
+
+    def _bounds(self, rows):
+        # Fields are numbered through a dict, as in BatchCleaner: np.unique can't sort None among strings
+        codes = {}
+        inverse = np.fromiter((codes.setdefault(row["field"], len(codes)) for row in rows),
+                              dtype=np.intp, count=len(rows))
+        limits = [self.limits.get(field, (None, None)) for field in codes]
+        low = np.array([-np.inf if lo is None else lo for lo, _ in limits], dtype=float)
+        high = np.array([np.inf if hi is None else hi for _, hi in limits], dtype=float)
+        span = high - low
+        # Floor for the standard deviation; fields without both limits get none
+        min_std = np.where(np.isfinite(span), span * 0.01, 0.0)
+        scale = np.where(np.isfinite(span), span,
+                         np.where(np.isfinite(high), np.abs(high), np.where(np.isfinite(low), np.abs(low), 0.0)))
+        return low[inverse], high[inverse], min_std[inverse], (scale * self.hysteresis)[inverse]
+
+    def detect(self, rows):
+        """Update the statistics with a batch of parsed readings and return the alerts it raises"""
+        rows = [row for row in rows if not math.isnan(row["value"])]
+        if not rows:
+            return []
+        alerts = []
+        now = time.time()
+        with self._lock:
+            self.seen += len(rows)
+            values = np.array([row["value"] for row in rows], dtype=float)
+            low, high, min_std, hysteresis = self._bounds(rows)
+            slot_ids = self._slot_ids(rows)
+
+            # Rank of every reading within its series, in arrival order
+            order = np.argsort(slot_ids, kind="stable")
+            _, starts, counts = np.unique(slot_ids[order], return_index=True, return_counts=True)
+            rank = np.empty(len(rows), dtype=np.intp)
+            rank[order] = np.arange(len(rows)) - np.repeat(starts, counts)
+
+            for r in range(counts.max()):
+                batch = np.flatnonzero(rank == r)
+                s, x = slot_ids[batch], values[batch]
+                mean, var, n = self.mean[s], self.var[s], self.count[s]
+
+                # Score against the statistics before this reading
+                std = np.maximum(np.sqrt(var), min_std[batch])
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    z = np.where((n >= self.warmup) & (std > 0), (x - mean) / std, 0.0)
+                diff = x - mean
+                self.mean[s] = np.where(n == 0, x, mean + self.alpha * diff)
+                self.var[s] = np.where(n == 0, 0.0, (1 - self.alpha) * (var + self.alpha * diff * diff))
+                self.count[s] = n + 1
+
+                state, lo, hi, h = self.state[s], low[batch], high[batch], hysteresis[batch]
+                new_state = np.select(
+                    [x > hi, x < lo, (state == 1) & (x > hi - h), (state == -1) & (x < lo + h)],
+                    [1, -1, 1, -1], 0).astype(np.int8)
+                changed = np.flatnonzero(new_state != state)
+                self.state[s] = new_state
+                for i in changed:
+                    kind = ("below_limit", "back_in_range", "above_limit")[new_state[i] + 1]
+                    threshold = hi[i] if new_state[i] > 0 else lo[i] if new_state[i] < 0 else None
+                    alerts.append(self._alert(rows[batch[i]], kind, threshold=threshold))
+
+                spikes = np.flatnonzero((np.abs(z) > self.z_threshold) & (now - self.last_z_alert[s] >= self.cooldown))
+                self.last_z_alert[s[spikes]] = now
+                for i in spikes:
+                    alerts.append(self._alert(rows[batch[i]], "zscore", score=z[i], mean=mean[i]))
+            self.counters.update(alert["kind"] for alert in alerts)
+        return alerts
+
+    @staticmethod
+    def _alert(row, kind, threshold=None, score=None, mean=None):
+        return {
+            "device_id": row["device_id"],
+            "zone_id": row["zone_id"],
+            "building_id": row["building_id"],
+            "field": row["field"],
+            "kind": kind,
+            "value": row["value"],
+            "threshold": None if threshold is None else float(threshold),
+            "score": None if score is None else round(float(score), 3),
+            "mean": None if mean is None else float(mean),
+            "timestamp": row["timestamp"],
+        }
+
+    def stats(self):
+        with self._lock:
+            return {"seen": self.seen, "series": len(self.slots), **{kind: self.counters[kind] for kind in ALERT_KINDS}}
+
+
+def alert_message(alert):
+    """(topic, JSON payload) an alert is published with"""
+    payload = dict(alert, timestamp=alert["timestamp"].isoformat())
+    return ALERT_TOPIC.format(**alert), json.dumps(payload)
+
+
+def store_alerts(session, alerts):
+    """Insert alerts into the alerts table in the session's transaction"""
+    if alerts:
+        session.execute(insert(Alert), [
+            {key: alert[key] for key in ("device_id", "zone_id", "building_id", "field", "kind", "value",
+                                         "threshold", "score", "timestamp")}
+            for alert in alerts
+        ])
@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from cleaning import MAX_READING_AGE
+from partitions import DEFAULT_PARTITION, PARENT_TABLE, list_partitions
+
+# Measurements older than ARCHIVE_AFTER_DAYS move from Postgres to Parquet files under
+# ARCHIVE_DIR (date=YYYY-MM-DD/*.parquet); 0 disables the background job
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "/app/archive")
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", 0))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 6 * 3600))  # seconds between runs
+ARCHIVE_DROP = os.environ.get("ARCHIVE_DROP", "1") == "1"  # 0 keeps archived partitions as detached tables
+ARCHIVE_COMPRESSION = os.environ.get("ARCHIVE_COMPRESSION", "zstd")
+ARCHIVE_FETCH_ROWS = int(os.environ.get("ARCHIVE_FETCH_ROWS", 50000))  # rows per cursor round trip and record batch
+ARCHIVE_ROW_GROUP = int(os.environ.get("ARCHIVE_ROW_GROUP", 250000))
+
+WATERMARK_FILE = "watermark.json"
+MAIN_FILE = "measurements.parquet"
+
+SCHEMA = pa.schema([
+    pa.field("device_id", pa.string()),
+    pa.field("field", pa.string()),
+    pa.field("timestamp", pa.timestamp("us")),
+    pa.field("value", pa.float64()),
+    pa.field("unit", pa.string()),
+])
+
+
+def _day_dir(directory, day):
+    return os.path.join(directory, f"date={day:%Y-%m-%d}")
+
+
+def read_watermark(directory=ARCHIVE_DIR):
+    """Timestamp before which measurements live in the archive instead of Postgres, or None"""
+    return _read_state(directory)[0]
+
+
+def _read_state(directory):
+    """(watermark or None, generation) from the watermark file
+
+    The generation names the late files of the next run; it only changes once
+    a run has committed, so a run retried after a failure overwrites its own
+    late files instead of adding copies.
+    """
+    try:
+        with open(os.path.join(directory, WATERMARK_FILE)) as f:
+            state = json.load(f)
+        return datetime.fromisoformat(state["archived_before"]), state.get("generation", 0)
+    except (OSError, ValueError, KeyError):
+        return None, 0
+
+
+def _write_watermark(directory, watermark, generation):
+    path = os.path.join(directory, WATERMARK_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"archived_before": watermark.isoformat(), "generation": generation,
+                   "updated": datetime.now().isoformat()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    _fsync_dir(directory)
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _export_day(conn, directory, day, name):
+    """Stream one day of measurements, ordered by device, field and time, into a Parquet file.
+
+    Rows come from a server-side cursor and are written a record batch at a
+    time, so memory stays flat however large the day is. Ordering by device
+    keeps each row group to a narrow device range, which lets readers skip
+    row groups using their statistics. Returns the number of rows written.
+    """
+    result = conn.execute(text(f"""
+        SELECT device_id, field, timestamp, value, unit FROM {PARENT_TABLE}
+        WHERE timestamp >= :day AND timestamp < :next_day
+        ORDER BY device_id, field, timestamp
+    """), {"day": day, "next_day": day + timedelta(days=1)},
+        execution_options={"stream_results": True, "max_row_buffer": ARCHIVE_FETCH_ROWS})
+    path = os.path.join(_day_dir(directory, day), name)
+    writer = None
+    count = 0
+    try:
+        for chunk in result.partitions(ARCHIVE_FETCH_ROWS):
+            if writer is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writer = pq.ParquetWriter(path + ".tmp", SCHEMA, compression=ARCHIVE_COMPRESSION)
+            columns = list(zip(*chunk))
+            writer.write_batch(pa.record_batch(columns, schema=SCHEMA), row_group_size=ARCHIVE_ROW_GROUP)
+            count += len(chunk)
+    finally:
+        result.close()
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        return 0
+    with open(path + ".tmp", "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    _fsync_dir(os.path.dirname(path))
+    return count
+
+
+def archive_measurements(engine, older_than, directory=ARCHIVE_DIR, drop=ARCHIVE_DROP):
+    """Move measurements older than the cutoff out of Postgres into the archive.
+
+    The cutoff is rounded down to a partition boundary and never moves
+    backwards. Every day before it is exported to date=<day>/ Parquet files,
+    then the old partitions are detached (and dropped unless drop=False) and
+    the matching rows deleted from the default partition. Everything runs in
+    one REPEATABLE READ transaction, so the deleted rows are exactly the
+    exported ones; the watermark file is only updated once it has committed.
+    Files are named after the run's generation rather than its start time,
+    so re-running after a failure overwrites what the failed run exported.
+    Days that were archived by an earlier run can only have late rows in the
+    default partition; those go to a late-<generation> file next to the
+    day's main file. Returns (watermark, rows archived).
+    """
+    if (datetime.now() - older_than).total_seconds() <= MAX_READING_AGE:
+        # Newer readings can still arrive (see cleaning.py) and would land in an archived range
+        raise ValueError("The archive cutoff must be older than MAX_READING_AGE")
+    os.makedirs(directory, exist_ok=True)
+    previous, generation = _read_state(directory)
+
+    total = 0
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="REPEATABLE READ")
+        with conn.begin():
+            partitions = list_partitions(conn)
+            watermark = older_than
+            for _, start, end in partitions:
+                if start < watermark < end:
+                    watermark = start  # only whole partitions are archived
+            if previous is not None:
+                watermark = max(watermark, previous)
+            archived = [name for name, _, end in partitions if end <= watermark]
+
+            first = conn.execute(text(f"SELECT min(timestamp) FROM {PARENT_TABLE} WHERE timestamp < :watermark"),
+                                 {"watermark": watermark}).scalar()
+            if first is not None:
+                late_name = f"late-{generation}.parquet"
+                day = first.replace(hour=0, minute=0, second=0, microsecond=0)
+                while day < watermark:
+                    late = previous is not None and day < previous
+                    total += _export_day(conn, directory, day, late_name if late else MAIN_FILE)
+                    day += timedelta(days=1)
+
+            for name in archived:
+                conn.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+                if drop:
+                    conn.execute(text(f"DROP TABLE {name}"))
+            conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE timestamp < :watermark"),
+                         {"watermark": watermark})
+
+    # Also when nothing was exported: an earlier run may have committed and failed before this point
+    if watermark != previous or total:
+        _write_watermark(directory, watermark, generation + 1 if total else generation)
+    print(f"Archived {total} measurements before {watermark} "
+          f"({len(archived)} partitions {'dropped' if drop else 'detached'}) to {directory}")
+    return watermark, total
+
+
+def read_archived_series(device_id, field, start_time, end_time, directory=ARCHIVE_DIR):
+    """(timestamp, value) pairs of a device and field between start_time and end_time (inclusive) from the archive.
+
+    Files are memory-mapped and only the row groups whose statistics can
+    match the device are decoded.
+    """
+    tables = []
+    day = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day <= end_time:
+        day_dir = _day_dir(directory, day)
+        if os.path.isdir(day_dir):
+            for name in sorted(os.listdir(day_dir)):
+                if not name.endswith(".parquet"):
+                    continue
+                tables.append(pq.read_table(
+                    os.path.join(day_dir, name),
+                    columns=["timestamp", "value"],
+                    filters=[("device_id", "=", device_id), ("field", "=", field),
+                             ("timestamp", ">=", start_time), ("timestamp", "<=", end_time)],
+                    memory_map=True,
+                ))
+        day += timedelta(days=1)
+    if not tables:
+        return []
+    # Late files can interleave with a day's main file
+    table = pa.concat_tables(tables).sort_by("timestamp")
+    return list(zip(table.column("timestamp").to_pylist(), table.column("value").to_pylist()))
+
+
+def start_archive_maintenance(engine, after_days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL,
+                              directory=ARCHIVE_DIR):
+    """Archive measurements older than after_days every interval seconds from a daemon thread"""
+    stop = threading.Event()
+
+    def run():
+        while True:
+            try:
+                archive_measurements(engine, datetime.now() - timedelta(days=after_days), directory)
+            except Exception as e:
+                print(f"Error archiving measurements: {e}")
+            if stop.wait(interval):
+                return
+
+    thread = threading.Thread(target=run, name="bms-archive", daemon=True)
+    thread.start()
+    return stop
+
+
+if __name__ == "__main__":
+    from db_models import init_db
+
+    parser = argparse.ArgumentParser(description="Archive old measurements to Parquet files")
+    parser.add_argument("--older-than-days", type=float, default=ARCHIVE_AFTER_DAYS or 90,
+                        help="archive measurements older than this many days")
+    parser.add_argument("--directory", default=ARCHIVE_DIR)
+    parser.add_argument("--keep-detached", action="store_true",
+                        help="detach archived partitions instead of dropping them")
+    args = parser.parse_args()
+
+    engine, _ = init_db()
+    archive_measurements(engine, datetime.now() - timedelta(days=args.older_than_days), args.directory,
+                         drop=ARCHIVE_DROP and not args.keep_detached)
@@ -0,0 +1,332 @@
+import argparse
+import asyncio
+import os
+import signal
+import time
+from types import SimpleNamespace
+import aiomqtt
+from BMS import (BuildingManagementSystem, MQTT_BROKER, MQTT_PORT, MQTT_TOPIC, BATCH_SIZE, FLUSH_INTERVAL,
+                 MAX_QUEUE, STATS_INTERVAL, BMS_WORKERS, TRANSIENT_ERRORS, run_workers)
+from buildings import BUILDING_DATABASES, building_from_topic
+from anomaly import ALERT_QOS, alert_message, store_alerts
+from db_models import init_db, init_async_db
+from ingest import RejectedRows, isolate_failures
+from metrics import MESSAGES_FAILED, READINGS_RECEIVED, PARSE_SECONDS, collector, pool_stats, count_message, start_metrics_server
+from payloads import decode_readings
+from registry import DeviceRegistry
+from partitions import start_partition_maintenance
+
+# Batches being written concurrently, each on its own pooled asyncpg connection
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", 4))
+
+
+class AsyncBuildingManagementSystem(BuildingManagementSystem):
+    """asyncio engine for the subscriber: one event loop overlaps MQTT receive with database writes.
+
+    Topic handling, parsing, the cleaning, deadband, latest-state and anomaly
+    stages and the write transaction (device upserts, measurements, rollups,
+    NOTIFY) are those of BuildingManagementSystem; the
+    statements run on asyncpg through SQLAlchemy's asyncio extension, which
+    pipelines the multi-row inserts. Readings are batched per building like
+    INGEST_MODE=batch and up to max_inflight batches are written concurrently.
+    Every building is written to the default database, so BUILDING_DATABASES
+    is refused. Alerts are published and stored off the write path. When every slot is
+    busy the consumer stops pulling messages, so backpressure reaches the MQTT
+    client's bounded incoming queue instead of growing memory.
+    """
+
+    def __init__(self, worker_id=None, topic=MQTT_TOPIC, workers=1, max_inflight=ASYNC_MAX_INFLIGHT,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_queue=MAX_QUEUE):
+        # No paho client or writer thread, so BuildingManagementSystem.__init__ isn't called
+        self.worker_id = worker_id
+        self.topic = topic
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.writers = {}
+        if BUILDING_DATABASES:
+            # Shards would need an async engine and registry each; don't silently write them to the default database
+            raise SystemExit("BUILDING_DATABASES is not supported by the asyncio engine; use BMS.py")
+
+        # Schema setup and the registry load stay synchronous; they only run at startup
+        self.engine, self.SessionFactory = init_db()
+        self.registry = DeviceRegistry(self.SessionFactory)
+        self.registry.load()
+        self.init_pipeline()
+        self.mqtt = None  # connected aiomqtt client, for publishing alerts
+        self.async_engine, self.AsyncSessionFactory = init_async_db(pool_size=max_inflight)
+
+        self._pending = {}  # building id -> parsed readings not yet handed to a write
+        self._tasks = set()
+        self._inflight = None  # semaphore bounding concurrent writes, created on the event loop
+        self._inflight_count = 0
+
+        # Counters reported by stats()
+        self.received = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.total_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.register_metrics()
+
+    def register_metrics(self):
+        collector.register("bms_db_pool", pool_stats(self.async_engine.sync_engine.pool))
+        self.register_pipeline_metrics()
+        collector.register("bms_async", self.stats, counters=("received", "flushes", "flushed_rows", "failed_rows"))
+
+    async def write_batch_async(self, rows):
+        """Store a batch of measurement rows in a single transaction; returns the rows written
+
+        As in write_batch, a batch failing for a reason other than the database
+        being unavailable is not dropped as a whole: it is written again with
+        every chunk in a savepoint, split until the offending rows are found.
+        The rest commits and RejectedRows is raised for those rows.
+        """
+        rows, stored = self.prepare_batch(rows)
+        if not rows:
+            return 0
+        start = time.perf_counter()
+        failed, error = [], None
+        try:
+            try:
+                async with self.AsyncSessionFactory() as session:
+                    new_devices = await session.run_sync(self.write_rows, rows, None, stored)
+                    await session.commit()
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception:
+                async with self.AsyncSessionFactory() as session:
+                    new_devices, failed, error = await session.run_sync(self.write_isolated, rows, stored)
+                    await session.commit()
+        except Exception:
+            self.batch_failed(rows)
+            raise
+        if failed:
+            self.batch_failed(failed)
+            rejected = {id(row) for row in failed}
+            rows = [row for row in rows if id(row) not in rejected]
+            stored = [row for row in stored if id(row) not in rejected]
+        if rows:
+            self.batch_committed(rows, stored, new_devices, self.registry, start)
+        if failed:
+            raise RejectedRows(failed, error)
+        return len(rows)
+
+    def write_isolated(self, session, rows, stored):
+        """write_rows with isolate_failures, each chunk in a savepoint; returns (new devices, failed rows, first error)"""
+        kept = {id(row) for row in stored}
+        new_devices = []
+
+        def write(chunk):
+            with session.begin_nested():
+                devices = self.write_rows(session, chunk, None, [row for row in chunk if id(row) in kept])
+            new_devices.extend(devices)
+
+        failed, error = isolate_failures(write, rows, TRANSIENT_ERRORS)
+        return new_devices, failed, error
+
+    async def process_alerts_async(self, alerts):
+        """Publish alerts, then store them in their own transaction"""
+        await self.publish_alerts(alerts)
+        try:
+            async with self.AsyncSessionFactory() as session:
+                await session.run_sync(store_alerts, alerts)
+                await session.commit()
+        except Exception as e:
+            self.log("alert-error", "Error storing alerts: {}", e)
+
+    async def publish_alerts(self, alerts):
+        if self.mqtt is None:
+            return
+        for alert in alerts:
+            topic, payload = alert_message(alert)
+            try:
+                await self.mqtt.publish(topic, payload, qos=ALERT_QOS)
+            except aiomqtt.MqttError as e:
+                self.log("alert-error", "Error publishing alert: {}", e)
+
+    async def _flush(self, batch):
+        start = time.perf_counter()
+        try:
+            written = await self.write_batch_async(batch)
+        except RejectedRows as e:
+            # The rest of the batch was stored
+            print(f"Dropped {len(e.rows)} of {len(batch)} measurements that could not be stored: {e.error}")
+            self.failed_rows += len(e.rows)
+            written = len(batch) - len(e.rows)
+        except Exception as e:
+            print(f"Error flushing batch of {len(batch)} measurements: {e}")
+            self.failed_rows += len(batch)
+            return
+        finally:
+            self._inflight_count -= 1
+            self._inflight.release()
+        latency = time.perf_counter() - start
+        self.flushes += 1
+        self.flushed_rows += written
+        self.total_flush_latency += latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    async def flush(self, building_id):
+        """Hand up to batch_size of a building's pending readings to a write, waiting for a free in-flight slot"""
+        pending = self._pending.get(building_id)
+        if not pending:
+            return
+        batch, self._pending[building_id] = pending[:self.batch_size], pending[self.batch_size:]
+        if self.detector is not None:
+            # Raw values, before the cleaner repairs them in place; never waits on the write
+            alerts = self.detector.detect([dict(row) for row in batch])
+            if alerts:
+                task = asyncio.create_task(self.process_alerts_async(alerts))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        await self._inflight.acquire()
+        self._inflight_count += 1
+        task = asyncio.create_task(self._flush(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def handle_message(self, msg):
+        """Parse one MQTT message into pending readings; same topic and payload handling as on_message"""
+        count_message(msg.topic)
+        topic_parts = msg.topic.split('/')
+        building_id = building_from_topic(msg.topic)
+        if len(topic_parts) < 3 or building_id is None:
+            MESSAGES_FAILED.inc()
+            self.log("invalid-topic", "Invalid topic format: {}", msg.topic)
+            return
+        start = time.perf_counter()
+        try:
+            rows = self.parse_readings(self.owned(decode_readings(msg)), building_id)
+        except Exception as e:
+            MESSAGES_FAILED.inc()
+            self.log("message-error", "Error processing message: {}", e)
+            return
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        READINGS_RECEIVED.inc(len(rows))
+        self.received += len(rows)
+        pending = self._pending.setdefault(building_id, [])
+        pending.extend(rows)
+        while len(self._pending[building_id]) >= self.batch_size:
+            await self.flush(building_id)
+
+    async def consume(self, messages):
+        """Process an async iterable of MQTT messages (anything with topic, payload and properties)"""
+        if self._inflight is None:
+            self._inflight = asyncio.Semaphore(self.max_inflight)
+        async for message in messages:
+            await self.handle_message(message)
+
+    async def drain(self):
+        """Write everything still pending and wait for in-flight writes to finish"""
+        for building_id in list(self._pending):
+            while self._pending[building_id]:
+                await self.flush(building_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _ticker(self):
+        """Flush partial batches every flush_interval and print stats every STATS_INTERVAL"""
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            for building_id in list(self._pending):
+                await self.flush(building_id)
+            if STATS_INTERVAL and time.monotonic() - last_report >= STATS_INTERVAL:
+                last_report = time.monotonic()
+                s = self.stats()
+                print(f"Ingest stats: pending={s['pending']} inflight={s['inflight']}/{self.max_inflight} "
+                      f"flushed={s['flushed_rows']} failed={s['failed_rows']} "
+                      f"flush_latency avg={s['avg_flush_latency']*1000:.1f}ms max={s['max_flush_latency']*1000:.1f}ms")
+
+    async def _consume_mqtt(self):
+        client_id = f"bms-async-{self.worker_id}-{os.getpid()}" if self.worker_id is not None else None
+        retry_count = 0
+        while True:
+            try:
+                async with aiomqtt.Client(MQTT_BROKER, MQTT_PORT, identifier=client_id,
+                                          protocol=aiomqtt.ProtocolVersion.V5,
+                                          max_queued_incoming_messages=self.max_queue) as client:
+                    print(f"Connected to MQTT broker at {MQTT_BROKER}")
+                    retry_count = 0
+                    self.mqtt = client
+                    await client.subscribe(self.topic)
+                    print(f"Subscribed to topic: {self.topic}")
+                    # decode_readings expects a paho-style message with a str topic
+                    await self.consume(
+                        SimpleNamespace(topic=message.topic.value, payload=message.payload,
+                                        properties=message.properties)
+                        async for message in client.messages
+                    )
+            except aiomqtt.MqttError as e:
+                retry_count += 1
+                wait_time = min(30, 2 ** retry_count)  # Exponential backoff
+                print(f"MQTT connection failed: {e}; retrying in {wait_time} seconds...")
+                await asyncio.sleep(wait_time)
+            finally:
+                self.mqtt = None
+
+    async def run_async(self):
+        """Consume until SIGINT/SIGTERM, then drain pending writes before exiting"""
+        print("Starting Building Management System (asyncio engine)...")
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        start_metrics_server(self.worker_id)
+        if self.worker_id in (None, 0):
+            # One process keeps future measurement partitions created
+            start_partition_maintenance(self.engine)
+
+        tasks = [asyncio.create_task(self._consume_mqtt()), asyncio.create_task(self._ticker())]
+        await stop.wait()
+        print("Shutting down...")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.drain()
+        await self.async_engine.dispose()
+        print(f"Async writer stopped: {self.stats()}")
+        self.print_pipeline_stats()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    def stats(self):
+        """Snapshot of pending readings, in-flight writes, throughput and flush latency (seconds)"""
+        return {
+            "pending": sum(len(pending) for pending in self._pending.values()),
+            "inflight": self._inflight_count,
+            "received": self.received,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failed_rows": self.failed_rows,
+            "avg_flush_latency": self.total_flush_latency / self.flushes if self.flushes else 0.0,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+
+def run_async_worker(worker_id, topic, workers=1):
+    """Entry point of an asyncio worker process"""
+    AsyncBuildingManagementSystem(worker_id=worker_id, topic=topic, workers=workers).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Building Management System subscriber (asyncio engine)")
+    parser.add_argument("--workers", type=int, default=BMS_WORKERS,
+                        help="number of subscriber processes (default: $BMS_WORKERS or 1)")
+    args = parser.parse_args()
+
+    # Allow time for the database and broker to start up
+    print("Waiting for services to start...")
+    time.sleep(10)
+
+    if args.workers > 1:
+        run_workers(args.workers, target=run_async_worker)
+    else:
+        AsyncBuildingManagementSystem().run()
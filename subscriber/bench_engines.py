@@ -0,0 +1,235 @@
+"""
+Per-core throughput of the threaded and asyncio subscriber engines.
+
+Each engine runs in its own process pinned to one CPU (--core) and stores a
+fixed number of readings in Postgres (DB_* environment variables). The harness
+reports wall-clock throughput and the CPU seconds the subscriber process used,
+so the engines can be compared per core:
+
+  direct   - BuildingManagementSystem, one transaction per reading
+  threaded - BuildingManagementSystem with the batch writer thread (INGEST_MODE=batch)
+  async    - AsyncBuildingManagementSystem (async_bms.py)
+
+With --source broker the readings are published to the MQTT broker and each
+engine consumes them through its own MQTT client. With --source inline the same
+messages are fed straight into the engines, leaving the broker out.
+
+    python bench_engines.py --source broker --broker localhost --messages 20000
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import time
+from datetime import datetime
+from types import SimpleNamespace
+import paho.mqtt.client as mqtt
+
+BENCH_TOPIC = "bench-engines/sensors"
+ENGINES = ("direct", "threaded", "async")
+
+
+def make_payloads(count, run_id):
+    """(topic, payload) pairs shaped like the router's single-reading JSON messages"""
+    messages = []
+    for i in range(count):
+        zone = i % 3 + 1
+        payload = json.dumps({
+            "device_id": f"temperature-bench{run_id}x{i % 50}",
+            "zone_id": zone,
+            "reading": 70 + (i % 5) * 0.5,
+            "timestamp": datetime.now().isoformat(),
+            "field": "temperature",
+            "unit": "F",
+        }).encode()
+        messages.append((f"{BENCH_TOPIC}/{run_id}/zone{zone}/temperature", payload))
+    return messages
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_for(committed, expected, timeout):
+    deadline = time.monotonic() + timeout
+    while committed[0] < expected and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def run_threaded(engine, args, topic, payloads, committed, ready, start):
+    import BMS
+    bms = BMS.BuildingManagementSystem(topic=topic)
+    write_batch = bms.write_batch
+
+    def counted(rows):
+        written = write_batch(rows)
+        committed[0] += written
+        return written
+
+    # Per-building writers are created on the first message, so they pick up the wrapper
+    bms.write_batch = counted
+
+    if args.source == "broker":
+        bms.client.on_subscribe = lambda client, userdata, mid, reason_codes, properties=None: ready.set()
+        bms.client.connect(args.broker, args.port, 60)
+        bms.client.loop_start()
+        start.wait()
+        cpu, began = cpu_seconds(), time.perf_counter()
+        wait_for(committed, args.messages, args.timeout)
+        bms.client.loop_stop()
+    else:
+        ready.set()
+        start.wait()
+        cpu, began = cpu_seconds(), time.perf_counter()
+        # Same thread does the parsing that paho's network thread would
+        for topic, payload in payloads:
+            bms.on_message(None, None, SimpleNamespace(topic=topic, payload=payload, properties=None))
+        wait_for(committed, args.messages, args.timeout)
+    elapsed, cpu = time.perf_counter() - began, cpu_seconds() - cpu
+    for writer in bms.writers.values():
+        writer.stop()
+    return elapsed, cpu
+
+
+def run_async(args, topic, payloads, committed, ready, start):
+    import aiomqtt
+    from async_bms import AsyncBuildingManagementSystem
+    bms = AsyncBuildingManagementSystem(topic=topic, max_inflight=args.max_inflight)
+    write_batch_async = bms.write_batch_async
+
+    async def counted(rows):
+        written = await write_batch_async(rows)
+        committed[0] += written
+        return written
+
+    bms.write_batch_async = counted
+
+    async def wait_async():
+        deadline = time.monotonic() + args.timeout
+        while committed[0] < args.messages and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)
+
+    async def bench():
+        loop = asyncio.get_running_loop()
+        if args.source == "broker":
+            async with aiomqtt.Client(args.broker, args.port, protocol=aiomqtt.ProtocolVersion.V5) as client:
+                await client.subscribe(topic)
+                ready.set()
+                await loop.run_in_executor(None, start.wait)
+                cpu, began = cpu_seconds(), time.perf_counter()
+                consumer = asyncio.create_task(bms.consume(
+                    SimpleNamespace(topic=message.topic.value, payload=message.payload,
+                                    properties=message.properties)
+                    async for message in client.messages))
+                ticker = asyncio.create_task(bms._ticker())
+                await wait_async()
+                consumer.cancel()
+                ticker.cancel()
+        else:
+            ready.set()
+            await loop.run_in_executor(None, start.wait)
+            cpu, began = cpu_seconds(), time.perf_counter()
+
+            async def messages():
+                for topic_name, payload in payloads:
+                    yield SimpleNamespace(topic=topic_name, payload=payload, properties=None)
+
+            await bms.consume(messages())
+            await bms.drain()
+            await wait_async()
+        elapsed, cpu = time.perf_counter() - began, cpu_seconds() - cpu
+        await bms.drain()
+        await bms.async_engine.dispose()
+        return elapsed, cpu
+
+    return asyncio.run(bench())
+
+
+def engine_process(engine, args, run_id, results, ready, start):
+    # BMS reads its configuration from the environment at import time
+    os.environ["MQTT_BROKER"] = args.broker
+    os.environ["MQTT_PORT"] = str(args.port)
+    os.environ["INGEST_MODE"] = "direct" if engine == "direct" else "batch"
+    os.environ.setdefault("STATS_INTERVAL", "0")
+    if args.core is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {args.core})
+
+    topic = f"{BENCH_TOPIC}/{run_id}/#"
+    payloads = make_payloads(args.messages, run_id) if args.source == "inline" else None
+    committed = [0]
+    if engine == "async":
+        elapsed, cpu = run_async(args, topic, payloads, committed, ready, start)
+    else:
+        elapsed, cpu = run_threaded(engine, args, topic, payloads, committed, ready, start)
+    results.put({
+        "engine": engine,
+        "readings": committed[0],
+        "seconds": round(elapsed, 3),
+        "readings_per_sec": round(committed[0] / elapsed, 1),
+        "cpu_seconds": round(cpu, 3),
+        "readings_per_cpu_sec": round(committed[0] / cpu, 1) if cpu else None,
+    })
+
+
+def publish(args, payloads):
+    client = mqtt.Client(client_id="bench-engines-publisher", protocol=mqtt.MQTTv5)
+    client.max_inflight_messages_set(1000)
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+    infos = [client.publish(topic, payload, qos=args.qos) for topic, payload in payloads]
+    for info in infos:
+        info.wait_for_publish()
+    client.loop_stop()
+    client.disconnect()
+
+
+def run(engine, args):
+    run_id = f"{os.getpid()}{int(time.time()) % 100000}{ENGINES.index(engine)}"
+    results = multiprocessing.Queue()
+    ready, start = multiprocessing.Event(), multiprocessing.Event()
+    process = multiprocessing.Process(target=engine_process, args=(engine, args, run_id, results, ready, start))
+    process.start()
+    if not ready.wait(timeout=60):
+        process.terminate()
+        raise RuntimeError(f"{engine} engine did not start within 60 seconds")
+    start.set()
+    if args.source == "broker":
+        publish(args, make_payloads(args.messages, run_id))
+    result = results.get(timeout=args.timeout + 60)
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=["broker", "inline"], default="broker")
+    parser.add_argument("--broker", default=os.environ.get("MQTT_BROKER", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("MQTT_PORT", 1883)))
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--engines", default=",".join(ENGINES), help="comma separated engines to run")
+    parser.add_argument("--qos", type=int, default=1, choices=[0, 1, 2])
+    parser.add_argument("--max-inflight", type=int, default=4, help="concurrent writes of the async engine")
+    parser.add_argument("--core", type=int, default=0, help="CPU to pin the subscriber to")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for all readings")
+    parser.add_argument("--output", help="write the results JSON to this file")
+    args = parser.parse_args()
+
+    results = [run(engine, args) for engine in args.engines.split(",")]
+    baseline = next((r["readings_per_cpu_sec"] for r in results if r["engine"] == "threaded"), None)
+    for result in results:
+        result["per_core_vs_threaded"] = (round(result["readings_per_cpu_sec"] / baseline, 2)
+                                          if baseline and result["readings_per_cpu_sec"] else None)
+        print(f"{result['engine']:>8}: {result['readings']}/{args.messages} readings in {result['seconds']}s "
+              f"-> {result['readings_per_sec']} readings/s, {result['readings_per_cpu_sec']} readings/cpu-s "
+              f"(x{result['per_core_vs_threaded']} vs threaded)")
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Throughput harness for the multi-worker subscriber.
+
+Starts N BuildingManagementSystem worker processes routed as BMS.py routes
+them (WORKER_ROUTING: by device hash, or over an MQTT v5 shared subscription),
+publishes a fixed number of readings to the local mosquitto broker and
+measures how long it takes until all of them are committed to Postgres
+(DB_* environment variables). Progress is read from the measurements table,
+not from message receipt, so buffering in the workers doesn't count as done.
+Repeating this for several worker counts shows how throughput scales.
+
+The deadband filter is disabled so that every reading is stored as a raw row.
+
+    python bench_workers.py --broker localhost --messages 5000 --workers 1,2,4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime, timedelta
+import paho.mqtt.client as mqtt
+from sqlalchemy import create_engine, text
+
+BENCH_TOPIC = "bench/sensors"
+SHARE_GROUP = "bms-bench"
+
+
+def worker(worker_id, num_workers, args, ready):
+    """Run the real subscriber ingest path for this worker's share of the readings"""
+    os.environ["MQTT_BROKER"] = args.broker
+    import BMS
+    if args.routing == "shared":
+        bms = BMS.BuildingManagementSystem(worker_id=worker_id, topic=f"$share/{SHARE_GROUP}/{BENCH_TOPIC}/#")
+    else:
+        bms = BMS.BuildingManagementSystem(worker_id=worker_id, topic=f"{BENCH_TOPIC}/#", workers=num_workers)
+    client = bms.client
+    client.on_connect = lambda client, userdata, flags, rc, properties=None: client.subscribe(bms.topic, qos=args.qos)
+    client.on_subscribe = lambda client, userdata, mid, reason_codes, properties=None: ready.release()
+    client.connect(args.broker, args.port, 60)
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def publish(args, tag):
+    """Publish args.messages readings as fast as the broker accepts them"""
+    client = mqtt.Client(client_id="bench-publisher", protocol=mqtt.MQTTv5)
+    client.max_inflight_messages_set(1000)
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+    infos = []
+    start = datetime.now()
+    for i in range(args.messages):
+        zone = i % 3 + 1
+        payload = json.dumps({
+            "device_id": f"temp-bench{tag}-{i % args.devices}",
+            "zone_id": zone,
+            "reading": 70 + i % 7 * 0.5,
+            "timestamp": (start + timedelta(milliseconds=i)).isoformat(),
+            "field": "temperature",
+            "unit": "F",
+        })
+        infos.append(client.publish(f"{BENCH_TOPIC}/zone{zone}/temperature", payload, qos=args.qos))
+    for info in infos:
+        info.wait_for_publish()
+    client.loop_stop()
+    client.disconnect()
+
+
+def committed(engine, tag):
+    """Readings of this run stored so far"""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM measurements WHERE device_id LIKE :pattern"),
+                            {"pattern": f"temp-bench{tag}-%"}).scalar()
+
+
+def run(num_workers, args, engine):
+    tag = f"{int(time.time())}w{num_workers}"
+    ready = multiprocessing.Semaphore(0)
+    processes = [multiprocessing.Process(target=worker, args=(i, num_workers, args, ready))
+                 for i in range(num_workers)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        if not ready.acquire(timeout=30):
+            raise RuntimeError("Workers did not subscribe within 30 seconds")
+
+    start = time.perf_counter()
+    publish(args, tag)
+    deadline = time.monotonic() + args.timeout
+    stored = committed(engine, tag)
+    while stored < args.messages and time.monotonic() < deadline:
+        time.sleep(0.05)
+        stored = committed(engine, tag)
+    elapsed = time.perf_counter() - start
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+    return {
+        "workers": num_workers,
+        "routing": args.routing,
+        "messages": args.messages,
+        "committed": stored,
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(stored / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", default=os.environ.get("MQTT_BROKER", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("MQTT_PORT", 1883)))
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--routing", default=os.environ.get("WORKER_ROUTING", "device"), choices=["device", "shared"])
+    parser.add_argument("--qos", type=int, default=1, choices=[0, 1, 2])
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for all readings to be committed")
+    args = parser.parse_args()
+
+    # Read by the workers when they import BMS
+    os.environ["DEADBAND_FILTER"] = "0"
+    if args.routing == "shared":
+        # The stages that keep per-device state can't run on a shared subscription
+        for stage in ("BATCH_CLEANING", "LATEST_ENABLED", "ANOMALY_DETECTION"):
+            os.environ[stage] = "0"
+
+    from db_models import database_url, init_db
+    init_db()  # create the schema once, before the workers race on it
+    engine = create_engine(database_url())
+    results = [run(int(n), args, engine) for n in args.workers.split(",")]
+    baseline = results[0]["msgs_per_sec"]
+    for result in results:
+        result["speedup"] = round(result["msgs_per_sec"] / baseline, 2) if baseline else None
+        print(f"{result['workers']:>3} workers ({result['routing']}): {result['committed']}/{result['messages']} "
+              f"committed in {result['seconds']}s -> {result['msgs_per_sec']} msg/s (x{result['speedup']})")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import warnings
+from collections import Counter
+from datetime import datetime
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Valid (min, max) per field. Mirrors the measurement metadata of the sensors in
+# publishers/devices.py; FIELD_LIMITS='{"co2": [300, 2000]}' overrides entries.
+FIELD_LIMITS = {
+    "temperature": (65, 85),
+    "humidity": (30, 70),
+    "co2": (350, 1500),
+}
+FIELD_LIMITS.update({field: tuple(limits) for field, limits in json.loads(os.environ.get("FIELD_LIMITS", "{}")).items()})
+
+MEDIAN_WINDOW = int(os.environ.get("MEDIAN_WINDOW", 15))  # valid readings per device+field used as fallback
+MAX_CLOCK_SKEW = float(os.environ.get("MAX_CLOCK_SKEW", 300))  # seconds a timestamp may be in the future
+MAX_READING_AGE = float(os.environ.get("MAX_READING_AGE", 7 * 86400))  # seconds a timestamp may be in the past
+
+# Rejection / repair counters reported by BatchCleaner.stats()
+RULES = ("null", "out_of_range", "no_fallback", "timestamp_future", "timestamp_stale")
+
+
+class BatchCleaner:
+    """Validates and repairs batches of readings with NumPy array operations.
+
+    Values outside FIELD_LIMITS and missing values are replaced with the median
+    of the valid readings among the previous MEDIAN_WINDOW of the same device and
+    field; readings with nothing to fall back on are dropped.
+    Timestamps too far in the future or past are replaced with the receive
+    time, like the per-message cleaning does for unparseable timestamps.
+    """
+
+    def __init__(self, limits=FIELD_LIMITS, window=MEDIAN_WINDOW,
+                 max_clock_skew=MAX_CLOCK_SKEW, max_age=MAX_READING_AGE):
+        self.limits = limits
+        self.window = window
+        self.max_clock_skew = np.timedelta64(int(max_clock_skew * 1e6), "us")
+        self.max_age = np.timedelta64(int(max_age * 1e6), "us")
+        # Last `window` readings of every device+field series, newest in the last
+        # column and invalid readings as NaN; slots maps (device_id, field) to a row
+        self.slots = {}
+        self.history = np.full((1024, window), np.nan)
+        self.counters = Counter()
+        self.seen = 0
+        self._lock = threading.Lock()
+
+    def _fix_timestamps(self, rows):
+        now = datetime.now()
+        timestamps = np.array([row["timestamp"] for row in rows], dtype="datetime64[us]")
+        now64 = np.datetime64(now, "us")
+        future = timestamps > now64 + self.max_clock_skew
+        stale = timestamps < now64 - self.max_age
+        self.counters["timestamp_future"] += int(future.sum())
+        self.counters["timestamp_stale"] += int(stale.sum())
+        for i in np.flatnonzero(future | stale):
+            rows[i]["timestamp"] = now
+
+    def _slot_ids(self, rows):
+        slots = self.slots
+        ids = np.fromiter((slots.setdefault((row["device_id"], row["field"]), len(slots)) for row in rows),
+                          dtype=np.intp, count=len(rows))
+        if len(slots) > len(self.history):
+            grown = np.full((max(len(slots), 2 * len(self.history)), self.window), np.nan)
+            grown[:len(self.history)] = self.history
+            self.history = grown
+        return ids
+
+    def _bounds(self, rows):
+        # A dict rather than np.unique: sorting an object array fails on mixed types such as None
+        codes = {}
+        inverse = np.fromiter((codes.setdefault(row["field"], len(codes)) for row in rows),
+                              dtype=np.intp, count=len(rows))
+        limits = [self.limits.get(field, (-np.inf, np.inf)) for field in codes]
+        low, high = np.array(limits, dtype=float).reshape(-1, 2).T
+        return low[inverse], high[inverse]
+
+    def clean(self, rows):
+        """Return the batch with repaired values/timestamps and unrecoverable readings removed"""
+        if not rows:
+            return rows
+        with self._lock:
+            self.seen += len(rows)
+            self._fix_timestamps(rows)
+
+            values = np.array([row["value"] for row in rows], dtype=float)
+            low, high = self._bounds(rows)
+            null = np.isnan(values)
+            out_of_range = ~null & ((values < low) | (values > high))
+            bad = null | out_of_range
+            self.counters["null"] += int(null.sum())
+            self.counters["out_of_range"] += int(out_of_range.sum())
+
+            # Group the batch by series, keeping arrival order within each series
+            slot_ids = self._slot_ids(rows)
+            order = np.argsort(slot_ids, kind="stable")
+            series, starts, counts = np.unique(slot_ids[order], return_index=True, return_counts=True)
+            group = np.repeat(np.arange(len(series)), counts)
+            rank = np.arange(len(rows)) - starts[group]
+
+            # One row per series: its history followed by this batch's readings,
+            # so the reading at rank r sees the `window` readings before it
+            timeline = np.full((len(series), self.window + counts.max()), np.nan)
+            timeline[:, :self.window] = self.history[series]
+            timeline[group, self.window + rank] = np.where(bad[order], np.nan, values[order])
+            windows = sliding_window_view(timeline, self.window, axis=1)
+
+            repair = np.flatnonzero(bad[order])
+            if len(repair):
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN windows -> NaN
+                    medians = np.nanmedian(windows[group[repair], rank[repair]], axis=1)
+                values[order[repair]] = medians
+            self.history[series] = windows[np.arange(len(series)), counts]
+
+            keep = ~np.isnan(values)
+            self.counters["no_fallback"] += int(len(rows) - keep.sum())
+
+            cleaned = []
+            for i in np.flatnonzero(keep):
+                row = rows[i]
+                row["value"] = float(values[i])
+                cleaned.append(row)
+            return cleaned
+
+    def stats(self):
+        with self._lock:
+            return {"seen": self.seen, **{rule: self.counters[rule] for rule in RULES}}
@@ -1,8 +1,11 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, MetaData, Table, ForeignKey
+from sqlalchemy import create_engine, inspect, Column, BigInteger, Integer, String, Float, DateTime, MetaData, Table, ForeignKey, Index, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 import os
 import time
+from datetime import datetime
+from partitions import migrate_measurements, ensure_partitions
 
 # Get database connection parameters from environment variables
 DB_HOST = os.environ.get("DB_HOST", "postgres")
@@ -10,6 +13,13 @@ DB_NAME = os.environ.get("DB_NAME", "building_data")
 DB_USER = os.environ.get("DB_USER", "building_user")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "building_password")
 
+# Connection pool settings; each subscriber worker process gets its own pool
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+
+# Building that owns the seeded zones and any rows stored before buildings existed
+DEFAULT_BUILDING = os.environ.get("DEFAULT_BUILDING", "hyatt-place")
+
 # Create SQLAlchemy base
 Base = declarative_base()
 
@@ -25,27 +35,43 @@ Each device has a set of measurements (temperature, humidity, etc.)
 """
 
 
+# Define the Building model; the id is the first level of the MQTT topic (e.g. 'hyatt-place')
+class Building(Base):
+    __tablename__ = 'buildings'
+    
+    id = Column(String(50), primary_key=True)
+    name = Column(String(100), nullable=False)
+    
+    # Relationships
+    zones = relationship("Zone", back_populates="building")
+    
+    def __repr__(self):
+        return f"<Building(id='{self.id}', name='{self.name}')>"
+
 # Define the Zone model
 class Zone(Base):
     __tablename__ = 'zones'
     
     id = Column(Integer, primary_key=True)
+    building_id = Column(String(50), ForeignKey('buildings.id'), index=True)
     name = Column(String(100), nullable=False)
     description = Column(String(255))
     square_footage = Column(Integer)  # Added square footage property
     
     # Relationships
+    building = relationship("Building", back_populates="zones")
     devices = relationship("Device", back_populates="zone")
     
     def __repr__(self):
-        return f"<Zone(id={self.id}, name='{self.name}', square_footage={self.square_footage})>"
+        return f"<Zone(id={self.id}, building_id='{self.building_id}', name='{self.name}', square_footage={self.square_footage})>"
 
 # Define the Device model
 class Device(Base):
     __tablename__ = 'devices'
     
     id = Column(String(50), primary_key=True)  # Using device_id as primary key
-    zone_id = Column(Integer, ForeignKey('zones.id'))
+    zone_id = Column(Integer, ForeignKey('zones.id'), index=True)
+    building_id = Column(String(50), ForeignKey('buildings.id'), index=True)  # also set for devices without a zone
     device_type = Column(String(50), nullable=False)
     
     # Relationships
@@ -56,12 +82,19 @@ class Device(Base):
         return f"<Device(id='{self.id}', type='{self.device_type}', zone_id={self.zone_id})>"
 
 # Define the Measurement model
+# Range-partitioned on timestamp (see partitions.py); Postgres requires the
+# partition key to be part of the primary key
 class Measurement(Base):
     __tablename__ = 'measurements'
+    __table_args__ = (
+        Index('ix_measurements_device_field_timestamp', 'device_id', 'field', 'timestamp'),
+        Index('ix_measurements_timestamp_brin', 'timestamp', postgresql_using='brin'),
+        {'postgresql_partition_by': 'RANGE ("timestamp")'},
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     device_id = Column(String(50), ForeignKey('devices.id'))
-    timestamp = Column(DateTime, nullable=False)
+    timestamp = Column(DateTime, primary_key=True, nullable=False)
     field = Column(String(50), nullable=False)  # e.g., 'temperature', 'humidity'
     value = Column(Float, nullable=False)
     unit = Column(String(20), nullable=False)
@@ -72,10 +105,159 @@ class Measurement(Base):
     def __repr__(self):
         return f"<Measurement(id={self.id}, device_id='{self.device_id}', field='{self.field}', value={self.value})>"
 
+# Current state: the newest reading of every device and field, upserted with each
+# batch (see latest.py) so "what is the zone like now" never scans measurements
+class LatestReading(Base):
+    __tablename__ = 'latest_readings'
+    
+    device_id = Column(String(50), ForeignKey('devices.id'), primary_key=True)
+    field = Column(String(50), primary_key=True)
+    timestamp = Column(DateTime, nullable=False)
+    value = Column(Float, nullable=False)
+    unit = Column(String(20), nullable=False)
+    
+    def __repr__(self):
+        return f"<LatestReading(device_id='{self.device_id}', field='{self.field}', value={self.value}, timestamp={self.timestamp})>"
+
+# Alerts raised by the in-stream anomaly detector (see anomaly.py); device_id has no
+# foreign key since alerts may be stored before the device is registered
+class Alert(Base):
+    __tablename__ = 'alerts'
+    __table_args__ = (
+        Index('ix_alerts_building_timestamp', 'building_id', 'timestamp'),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    device_id = Column(String(50), nullable=False)
+    zone_id = Column(Integer)
+    building_id = Column(String(50))
+    field = Column(String(50), nullable=False)
+    kind = Column(String(20), nullable=False)  # above_limit, below_limit, back_in_range or zscore
+    value = Column(Float, nullable=False)
+    threshold = Column(Float)  # the limit crossed, for limit alerts
+    score = Column(Float)  # z-score, for zscore alerts
+    timestamp = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f"<Alert(device_id='{self.device_id}', field='{self.field}', kind='{self.kind}', value={self.value}, timestamp={self.timestamp})>"
+
+# Pre-aggregated measurements (see rollups.py). One row per resolution
+# ('1m', '1h', '1d'), device or zone, field and bucket; the average is
+# sum_value / count so buckets can be merged incrementally.
+class DeviceRollup(Base):
+    __tablename__ = 'device_rollups'
+    
+    resolution = Column(String(4), primary_key=True)
+    device_id = Column(String(50), ForeignKey('devices.id'), primary_key=True)
+    field = Column(String(50), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False)
+    sum_value = Column(Float, nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    last_value = Column(Float, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f"<DeviceRollup(resolution='{self.resolution}', device_id='{self.device_id}', field='{self.field}', bucket_start={self.bucket_start}, count={self.count})>"
+
+class ZoneRollup(Base):
+    __tablename__ = 'zone_rollups'
+    
+    resolution = Column(String(4), primary_key=True)
+    zone_id = Column(Integer, ForeignKey('zones.id'), primary_key=True)
+    field = Column(String(50), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False)
+    sum_value = Column(Float, nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    last_value = Column(Float, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f"<ZoneRollup(resolution='{self.resolution}', zone_id={self.zone_id}, field='{self.field}', bucket_start={self.bucket_start}, count={self.count})>"
+
+# How far each spool (see spool.py) has been stored. Written in the transaction that
+# stores the spooled rows, so a batch replayed after a crash or a lost COMMIT
+# acknowledgement can be recognised and skipped
+class SpoolCheckpoint(Base):
+    __tablename__ = 'spool_checkpoints'
+    
+    spool_id = Column(String(64), primary_key=True)
+    segment = Column(Integer, nullable=False)
+    byte_offset = Column(BigInteger, nullable=False)  # end of the last stored record
+    updated = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f"<SpoolCheckpoint(spool_id='{self.spool_id}', segment={self.segment}, byte_offset={self.byte_offset})>"
+
+def save_spool_position(session, spool_id, position):
+    """Advance a spool's stored position in the session's transaction; never moves it back"""
+    table = SpoolCheckpoint.__table__
+    stmt = insert(SpoolCheckpoint).values(spool_id=spool_id, segment=position[0], byte_offset=position[1],
+                                          updated=datetime.now())
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.spool_id],
+        set_={"segment": stmt.excluded.segment, "byte_offset": stmt.excluded.byte_offset,
+              "updated": stmt.excluded.updated},
+        where=tuple_(table.c.segment, table.c.byte_offset) < tuple_(stmt.excluded.segment, stmt.excluded.byte_offset),
+    ))
+
+def load_spool_position(engine, spool_id):
+    """(segment, offset) a spool has been stored up to, or None"""
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT segment, byte_offset FROM spool_checkpoints WHERE spool_id = :spool_id"),
+                           {"spool_id": spool_id}).first()
+    return (row.segment, row.byte_offset) if row else None
+
+def database_url(driver="postgresql"):
+    return f"{driver}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+
+def migrate_buildings(engine, default_building=DEFAULT_BUILDING):
+    """Add building_id to zones and devices tables created before the buildings table.
+
+    Existing zones and devices are assigned to default_building.
+    """
+    with engine.begin() as conn:
+        for table in ("zones", "devices"):
+            exists = conn.execute(text("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'building_id'
+            """), {"table": table}).first()
+            if exists:
+                continue
+            conn.execute(insert(Building).values(id=default_building, name=default_building).on_conflict_do_nothing())
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN building_id VARCHAR(50) REFERENCES buildings (id)"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_building_id ON {table} (building_id)"))
+            count = conn.execute(text(f"UPDATE {table} SET building_id = :building"),
+                                 {"building": default_building}).rowcount
+            print(f"Assigned {count} existing {table} to building {default_building}")
+
+def backfill_latest_readings(engine):
+    """Fill a newly created latest_readings table from the stored measurements"""
+    with engine.begin() as conn:
+        # Zone lookups of the current state go through devices.zone_id
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_devices_zone_id ON devices (zone_id)"))
+        count = conn.execute(text("""
+            INSERT INTO latest_readings (device_id, field, timestamp, value, unit)
+            SELECT DISTINCT ON (device_id, field) device_id, field, timestamp, value, unit
+            FROM measurements
+            ORDER BY device_id, field, timestamp DESC
+            ON CONFLICT DO NOTHING
+        """)).rowcount
+    if count:
+        print(f"Backfilled {count} latest readings from measurements")
+
 # Function to initialize the database
-def init_db():
+def init_db(db_url=None, seed_zones=True):
+    """Create or migrate the schema and return (engine, session factory).
+
+    db_url defaults to the DB_* settings; building shards pass their own URL
+    and seed_zones=False, since the sample zones belong to DEFAULT_BUILDING.
+    """
     # Create connection string
-    db_url = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+    db_url = db_url or database_url()
     
     # Attempt to connect with retry logic
     max_retries = 5
@@ -84,10 +266,18 @@ def init_db():
     for retry in range(max_retries):
         try:
             print(f"Connecting to database (attempt {retry+1}/{max_retries})...")
-            engine = create_engine(db_url)
+            engine = create_engine(db_url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
             
+            # Move an existing single-table measurements layout to partitions
+            migrate_measurements(engine, Measurement.__table__)
+
             # Create tables
+            new_latest = not inspect(engine).has_table(LatestReading.__tablename__)
             Base.metadata.create_all(engine)
+            migrate_buildings(engine)
+            ensure_partitions(engine)
+            if new_latest:
+                backfill_latest_readings(engine)
             
             # Create session factory
             Session = sessionmaker(bind=engine)
@@ -95,12 +285,13 @@ def init_db():
             
             # Initialize zones if they don't exist
             zone_count = session.query(Zone).count()
-            if zone_count == 0:
+            if zone_count == 0 and seed_zones:
                 print("Initializing zones...")
+                session.execute(insert(Building).values(id=DEFAULT_BUILDING, name=DEFAULT_BUILDING).on_conflict_do_nothing())
                 zones = [
-                    Zone(id=1, name="Office Area", description="Main office workspace", square_footage=2500),
-                    Zone(id=2, name="Conference Rooms", description="Meeting and conference areas", square_footage=1200),
-                    Zone(id=3, name="Common Areas", description="Hallways, lobby, and break rooms", square_footage=1800)
+                    Zone(id=1, building_id=DEFAULT_BUILDING, name="Office Area", description="Main office workspace", square_footage=2500),
+                    Zone(id=2, building_id=DEFAULT_BUILDING, name="Conference Rooms", description="Meeting and conference areas", square_footage=1200),
+                    Zone(id=3, building_id=DEFAULT_BUILDING, name="Common Areas", description="Hallways, lobby, and break rooms", square_footage=1800)
                 ]
                 session.add_all(zones)
                 session.commit()
@@ -121,4 +312,11 @@ def init_db():
                 raise
     
     # This shouldn't be reached due to the raise above, but just in case
-    raise Exception("Failed to initialize database after multiple attempts")
\ No newline at end of file
+    raise Exception("Failed to initialize database after multiple attempts")
+
+def init_async_db(pool_size=DB_POOL_SIZE):
+    """asyncpg-backed engine and session factory for the asyncio engine; run init_db first for the schema"""
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    engine = create_async_engine(database_url("postgresql+asyncpg"), pool_size=pool_size,
+                                 max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
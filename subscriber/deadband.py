@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+from collections import Counter
+
+# Change-of-value filtering of raw rows. DEADBAND_FILTER=1 stores a reading only when it
+# moves more than the field's deadband away from the last stored value of its device+field,
+# or when nothing was stored for MAX_SILENCE seconds (heartbeat). Rollups still see every reading.
+DEADBAND_FILTER = os.environ.get("DEADBAND_FILTER", "0") == "1"
+# Deadband per field, in the field's unit; DEADBANDS='{"co2": 25}' overrides entries.
+# Fields without an entry use DEFAULT_DEADBAND (0 stores every change).
+DEADBANDS = {
+    "temperature": 0.2,
+    "humidity": 0.5,
+    "co2": 10,
+}
+DEADBANDS.update({field: float(band) for field, band in json.loads(os.environ.get("DEADBANDS", "{}")).items()})
+DEFAULT_DEADBAND = float(os.environ.get("DEFAULT_DEADBAND", 0))
+MAX_SILENCE = float(os.environ.get("MAX_SILENCE", 900))  # seconds between stored readings of a series
+
+
+class DeadbandFilter:
+    """Drops readings that don't move beyond their field's deadband, with a heartbeat.
+
+    Keeps the last stored (timestamp, value) of every device+field series in
+    memory. A series' stored rows are therefore its change points: between two
+    of them the value stayed within the deadband of the earlier one, so the
+    stored rows held until the next one (see get_device_step_series) reconstruct
+    the series to within the deadband. The first reading of a series and
+    readings older than its last stored one are always kept.
+    """
+
+    def __init__(self, deadbands=DEADBANDS, default=DEFAULT_DEADBAND, max_silence=MAX_SILENCE):
+        self.deadbands = deadbands
+        self.default = default
+        self.max_silence = max_silence
+        self.last = {}  # (device_id, field) -> (timestamp, value) of the last stored reading
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, rows):
+        """Return the readings of the batch that should be stored"""
+        stored = []
+        with self._lock:
+            for row in rows:
+                key = (row["device_id"], row["field"])
+                timestamp, value = row["timestamp"], row["value"]
+                last = self.last.get(key)
+                if last is None or timestamp < last[0]:
+                    reason = "first" if last is None else "out_of_order"
+                elif abs(value - last[1]) > self.deadbands.get(row["field"], self.default):
+                    reason = "changed"
+                elif (timestamp - last[0]).total_seconds() >= self.max_silence:
+                    reason = "heartbeat"
+                else:
+                    self.counters["suppressed"] += 1
+                    continue
+                self.counters[reason] += 1
+                if reason != "out_of_order":
+                    self.last[key] = (timestamp, value)
+                stored.append(row)
+        return stored
+
+    def forget(self, rows):
+        """Drop the state of the rows' series, e.g. after their write failed, so their next reading is stored"""
+        with self._lock:
+            for row in rows:
+                self.last.pop((row["device_id"], row["field"]), None)
+
+    def stats(self):
+        with self._lock:
+            seen = sum(self.counters.values())
+            stored = seen - self.counters["suppressed"]
+            return {
+                "seen": seen,
+                "stored": stored,
+                **{reason: self.counters[reason]
+                   for reason in ("suppressed", "changed", "heartbeat", "first", "out_of_order")},
+                # Fraction of readings that were not written as raw rows
+                "reduction_ratio": round(1 - stored / seen, 4) if seen else 0.0,
+            }
@@ -0,0 +1,223 @@
+import queue
+import threading
+import time
+
+# Backpressure policies applied when the buffer is full:
+#   block       - the MQTT callback waits up to put_timeout seconds for room, then drops the reading;
+#                 after a wait has timed out readings are dropped without waiting until there is
+#                 room again, so the network thread (which also answers keepalives) never stalls for long
+#   drop_newest - the incoming reading is discarded
+#   drop_oldest - the oldest buffered reading is discarded to make room
+BACKPRESSURE_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+
+class RejectedRows(Exception):
+    """Raised by a flush function once everything else is stored; rows are the readings that failed on their own"""
+
+    def __init__(self, rows, error):
+        super().__init__(f"{len(rows)} rows failed: {error}")
+        self.rows = rows
+        self.error = error
+
+
+def isolate_failures(write_fn, rows, transient=(), reject=None):
+    """Write rows with write_fn, splitting a failing batch in halves down to single rows.
+
+    Errors in transient (e.g. the database being unreachable) would fail every
+    chunk alike and are re-raised at once. Chunks are written in order, and
+    reject(row, error) is called for every row that fails on its own as soon
+    as it is found. Returns those rows and the first error.
+    """
+    try:
+        write_fn(rows)
+        return [], None
+    except transient:
+        raise
+    except Exception as e:
+        if len(rows) == 1:
+            if reject is not None:
+                reject(rows[0], e)
+            return list(rows), e
+    middle = len(rows) // 2
+    failed, error = isolate_failures(write_fn, rows[:middle], transient, reject)
+    failed_right, error_right = isolate_failures(write_fn, rows[middle:], transient, reject)
+    return failed + failed_right, error or error_right
+
+
+class BatchWriter:
+    """Bounded buffer of parsed readings drained by a background writer thread.
+
+    Readings are handed to flush_fn in batches, either when batch_size readings
+    have accumulated or when flush_interval seconds have passed since the first
+    reading of the batch arrived, whichever comes first. A flush_fn that
+    stores what it can and raises RejectedRows for the rest (see
+    isolate_failures) only has those rows counted as failed.
+    """
+
+    def __init__(self, flush_fn, batch_size=500, flush_interval=1.0, max_queue=10000,
+                 backpressure="drop_oldest", put_timeout=0.5, stats_interval=60, name=None):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {backpressure}")
+
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+        self.put_timeout = put_timeout
+        self.stats_interval = stats_interval
+        self.name = name  # e.g. the building whose readings this writer stores
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._saturated = False  # a blocking put timed out and the buffer hasn't had room since
+
+        # Counters reported by stats()
+        self._enqueued = 0
+        self._dropped = 0
+        self._flushes = 0
+        self._flushed_rows = 0
+        self._failed_flushes = 0
+        self._failed_rows = 0
+        self._last_batch_size = 0
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+        self._last_stats_report = time.monotonic()
+
+    def start(self):
+        """Start the background writer thread"""
+        self._stop.clear()
+        thread_name = f"bms-batch-writer-{self.name}" if self.name else "bms-batch-writer"
+        self._thread = threading.Thread(target=self._run, name=thread_name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=30):
+        """Stop accepting work and flush whatever is still buffered"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def put(self, row):
+        """Enqueue a parsed reading, applying the configured backpressure policy.
+
+        Returns True if the reading was buffered and False if it was dropped.
+        """
+        try:
+            if self.backpressure == "block" and not self._saturated:
+                self._queue.put(row, timeout=self.put_timeout)
+            else:
+                self._queue.put_nowait(row)
+            self._saturated = False
+        except queue.Full:
+            if self.backpressure != "drop_oldest":
+                self._saturated = self.backpressure == "block"
+                self._count_dropped()
+                return False
+            # Make room by discarding the oldest reading; another producer may
+            # race us for the free slot, in which case the new reading is dropped.
+            try:
+                self._queue.get_nowait()
+                self._count_dropped()
+                self._queue.put_nowait(row)
+            except (queue.Empty, queue.Full):
+                self._count_dropped()
+                return False
+
+        with self._lock:
+            self._enqueued += 1
+        return True
+
+    def _count_dropped(self):
+        with self._lock:
+            self._dropped += 1
+
+    def _collect(self):
+        """Block until a batch is full or its time window expires"""
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                # Take whatever is immediately available without waiting
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        failed = 0
+        try:
+            self.flush_fn(batch)
+        except RejectedRows as e:
+            # The rest of the batch was stored
+            failed = len(e.rows)
+            print(f"Dropped {failed} of {len(batch)} measurements that could not be stored: {e.error}")
+        except Exception as e:
+            print(f"Error flushing batch of {len(batch)} measurements: {e}")
+            with self._lock:
+                self._failed_flushes += 1
+                self._failed_rows += len(batch)
+            return
+
+        latency = time.perf_counter() - start
+        with self._lock:
+            self._flushes += 1
+            self._flushed_rows += len(batch) - failed
+            self._failed_rows += failed
+            self._last_batch_size = len(batch)
+            self._last_flush_latency = latency
+            self._max_flush_latency = max(self._max_flush_latency, latency)
+            self._total_flush_latency += latency
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+            self._maybe_report()
+
+    def _maybe_report(self):
+        if not self.stats_interval:
+            return
+        now = time.monotonic()
+        if now - self._last_stats_report < self.stats_interval:
+            return
+        self._last_stats_report = now
+        s = self.stats()
+        label = f" [{self.name}]" if self.name else ""
+        print(f"Ingest stats{label}: queue={s['queue_depth']}/{s['max_queue']} "
+              f"flushed={s['flushed_rows']} dropped={s['dropped']} failed={s['failed_rows']} "
+              f"flush_latency avg={s['avg_flush_latency']*1000:.1f}ms max={s['max_flush_latency']*1000:.1f}ms")
+
+    def stats(self):
+        """Snapshot of queue depth, throughput and flush latency (seconds)"""
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue": self._queue.maxsize,
+                "enqueued": self._enqueued,
+                "dropped": self._dropped,
+                "flushes": self._flushes,
+                "flushed_rows": self._flushed_rows,
+                "failed_flushes": self._failed_flushes,
+                "failed_rows": self._failed_rows,
+                "last_batch_size": self._last_batch_size,
+                "last_flush_latency": self._last_flush_latency,
+                "max_flush_latency": self._max_flush_latency,
+                "avg_flush_latency": self._total_flush_latency / self._flushes if self._flushes else 0.0,
+            }
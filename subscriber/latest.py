@@ -0,0 +1,104 @@
+import os
+import threading
+from sqlalchemy.dialects.postgresql import insert
+from db_models import Device, LatestReading
+
+LATEST_ENABLED = os.environ.get("LATEST_ENABLED", "1") == "1"
+
+
+class LatestState:
+    """In-process snapshot of the newest reading of every device and field.
+
+    merge() folds a batch into the snapshot and returns only the readings that
+    advanced it, one per device+field, so the latest_readings upsert carries
+    no more rows than there are series in the batch. Readings older than the
+    snapshot (replayed spool, late messages) are skipped entirely.
+    """
+
+    def __init__(self):
+        self.latest = {}  # (device_id, field) -> row
+        # zone id / building id -> {(device_id, field): row}, the same rows as latest
+        self.by_zone = {}
+        self.by_building = {}
+        self._lock = threading.Lock()
+
+    def merge(self, rows):
+        advanced = {}
+        with self._lock:
+            for row in rows:
+                key = (row["device_id"], row["field"])
+                current = self.latest.get(key)
+                if current is None or row["timestamp"] >= current["timestamp"]:
+                    if current is not None:
+                        self._unindex(key, current)
+                    self.latest[key] = advanced[key] = row
+                    self.by_zone.setdefault(row["zone_id"], {})[key] = row
+                    self.by_building.setdefault(row["building_id"], {})[key] = row
+        return list(advanced.values())
+
+    def _unindex(self, key, row):
+        for index, scope in ((self.by_zone, row["zone_id"]), (self.by_building, row["building_id"])):
+            rows = index.get(scope)
+            if rows is not None:
+                rows.pop(key, None)
+                if not rows:
+                    del index[scope]
+
+    def forget(self, rows):
+        """Drop the snapshot of the rows' series, e.g. after their write failed"""
+        with self._lock:
+            for row in rows:
+                key = (row["device_id"], row["field"])
+                current = self.latest.pop(key, None)
+                if current is not None:
+                    self._unindex(key, current)
+
+    def zone(self, zone_id):
+        """Snapshot rows of a zone's devices"""
+        with self._lock:
+            return list(self.by_zone.get(zone_id, {}).values())
+
+    def building(self, building_id):
+        """Snapshot rows of a building's devices, with or without a zone"""
+        with self._lock:
+            return list(self.by_building.get(building_id, {}).values())
+
+    def stats(self):
+        with self._lock:
+            return {"series": len(self.latest)}
+
+
+def upsert_latest(session, rows):
+    """Store the rows in latest_readings unless a newer reading of the same device and field is already there"""
+    if not rows:
+        return
+    table = LatestReading.__table__
+    stmt = insert(LatestReading)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.device_id, table.c.field],
+        set_={"timestamp": stmt.excluded.timestamp, "value": stmt.excluded.value, "unit": stmt.excluded.unit},
+        # Another worker or a replayed spool may hold older readings than the stored ones
+        where=table.c.timestamp <= stmt.excluded.timestamp,
+    )
+    # Sorted by primary key so concurrent writers lock rows in the same order
+    session.execute(stmt, [
+        {
+            "device_id": row["device_id"],
+            "field": row["field"],
+            "timestamp": row["timestamp"],
+            "value": row["value"],
+            "unit": row["unit"],
+        } for row in sorted(rows, key=lambda row: (row["device_id"], row["field"]))
+    ])
+
+
+def get_current_state(session, zone_id=None, building_id=None):
+    """Newest reading of every device and field in a zone or a building; one index lookup per device"""
+    query = session.query(LatestReading.device_id, Device.zone_id, LatestReading.field, LatestReading.value,
+                          LatestReading.unit, LatestReading.timestamp).join(Device)
+    if zone_id is not None:
+        query = query.filter(Device.zone_id == zone_id)
+    else:
+        # Devices carry their building, so those registered without a zone are included
+        query = query.filter(Device.building_id == building_id)
+    return query.order_by(Device.zone_id, LatestReading.device_id, LatestReading.field).all()
@@ -0,0 +1,49 @@
+import os
+from prometheus_client import Counter, Histogram, REGISTRY, start_http_server
+from stats import SampledLog, StatsCollector  # noqa: F401 (re-exported)
+
+# Prometheus endpoint; worker N of a multi-process subscriber listens on METRICS_PORT + N
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+MESSAGES_RECEIVED = Counter("bms_messages_received", "MQTT messages received", ["topic"])
+MESSAGES_FAILED = Counter("bms_messages_failed", "MQTT messages that could not be decoded or parsed")
+READINGS_RECEIVED = Counter("bms_readings_received", "Readings decoded from MQTT messages")
+READINGS_REJECTED = Counter("bms_readings_rejected", "Readings discarded before parsing", ["reason"])
+READINGS_STORED = Counter("bms_readings_stored", "Readings committed to the database")
+WRITE_ERRORS = Counter("bms_write_errors", "Batch writes that raised (the writer decides whether rows are retried)")
+PARSE_SECONDS = Histogram("bms_parse_seconds", "Decode and parse time per MQTT message", buckets=LATENCY_BUCKETS)
+CLEAN_SECONDS = Histogram("bms_clean_seconds", "Validation time per batch", buckets=LATENCY_BUCKETS)
+COMMIT_SECONDS = Histogram("bms_commit_seconds", "Database write and commit time per batch", buckets=LATENCY_BUCKETS)
+BATCH_ROWS = Histogram("bms_batch_rows", "Readings per database write",
+                       buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+
+_topic_counters = {}
+
+
+def count_message(topic):
+    """MESSAGES_RECEIVED.labels(topic).inc() with the label lookup cached per topic"""
+    counter = _topic_counters.get(topic)
+    if counter is None:
+        counter = _topic_counters[topic] = MESSAGES_RECEIVED.labels(topic)
+    counter.inc()
+
+
+collector = StatsCollector()
+REGISTRY.register(collector)
+
+
+def pool_stats(pool):
+    """Usage of a SQLAlchemy QueuePool"""
+    return lambda: {"size": pool.size(), "checked_out": pool.checkedout(), "overflow": max(0, pool.overflow())}
+
+
+def start_metrics_server(worker_id=None):
+    """Serve /metrics over HTTP from a daemon thread"""
+    port = METRICS_PORT + (worker_id or 0)
+    try:
+        start_http_server(port)
+        print(f"Metrics available on :{port}/metrics")
+    except OSError as e:
+        print(f"Could not start metrics server on port {port}: {e}")
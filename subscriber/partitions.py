@@ -0,0 +1,166 @@
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+# measurements is range-partitioned on timestamp, one partition per day or month
+PARTITION_INTERVAL = os.environ.get("MEASUREMENT_PARTITION_INTERVAL", "month")  # "day" or "month"
+PARTITIONS_AHEAD = int(os.environ.get("MEASUREMENT_PARTITIONS_AHEAD", 3))  # future partitions kept ready
+PARTITION_CHECK_INTERVAL = float(os.environ.get("MEASUREMENT_PARTITION_CHECK_INTERVAL", 3600))  # seconds
+KEEP_LEGACY_TABLE = os.environ.get("MEASUREMENT_KEEP_LEGACY_TABLE", "0") == "1"
+
+PARENT_TABLE = "measurements"
+LEGACY_TABLE = "measurements_legacy"
+DEFAULT_PARTITION = "measurements_default"
+
+# pg_get_expr(relpartbound) of a range partition
+_RANGE_BOUND = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def partition_start(ts, interval=PARTITION_INTERVAL):
+    """Lower bound of the partition containing ts"""
+    if interval == "day":
+        return datetime(ts.year, ts.month, ts.day)
+    if interval == "month":
+        return datetime(ts.year, ts.month, 1)
+    raise ValueError(f"Unknown partition interval: {interval}")
+
+
+def next_partition_start(start, interval=PARTITION_INTERVAL):
+    """Lower bound of the partition following the one starting at start"""
+    if interval == "day":
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return datetime(start.year + 1, 1, 1)
+    return datetime(start.year, start.month + 1, 1)
+
+
+def partition_name(start, interval=PARTITION_INTERVAL):
+    if interval == "day":
+        return f"{PARENT_TABLE}_p{start:%Y%m%d}"
+    return f"{PARENT_TABLE}_p{start:%Y%m}"
+
+
+def table_kind(conn, table):
+    """pg_class.relkind of a table in the current schema ('r' plain, 'p' partitioned), None if missing"""
+    return conn.execute(text("""
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = :table AND n.nspname = current_schema()
+    """), {"table": table}).scalar()
+
+
+def list_partitions(conn):
+    """(name, start, end) of the range partitions of measurements, oldest first; the default partition is left out"""
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE p.relname = :parent AND n.nspname = current_schema()
+    """), {"parent": PARENT_TABLE})
+    partitions = []
+    for name, bound in rows:
+        match = _RANGE_BOUND.fullmatch(bound)
+        if match:
+            partitions.append((name, datetime.fromisoformat(match[1]), datetime.fromisoformat(match[2])))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partition(conn, start, interval=PARTITION_INTERVAL):
+    """Create the partition starting at start if it doesn't exist yet"""
+    end = next_partition_start(start, interval)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(start, interval)} PARTITION OF {PARENT_TABLE} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    ))
+
+
+def create_partitions(conn, first, last, interval=PARTITION_INTERVAL):
+    """Create every partition needed to cover timestamps from first through last"""
+    start = partition_start(first, interval)
+    while start <= last:
+        create_partition(conn, start, interval)
+        start = next_partition_start(start, interval)
+
+
+def ensure_partitions(engine, interval=PARTITION_INTERVAL, ahead=PARTITIONS_AHEAD):
+    """Make sure partitions exist for the current period and the next `ahead` periods.
+
+    A default partition catches readings with timestamps outside the managed
+    range so an odd device clock never fails an insert.
+    """
+    with engine.begin() as conn:
+        if table_kind(conn, PARENT_TABLE) != "p":
+            return
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"))
+
+    start = partition_start(datetime.now(), interval)
+    for _ in range(ahead + 1):
+        # Separate transactions so one failing partition (e.g. rows for its range
+        # already sitting in the default partition) doesn't block the others
+        try:
+            with engine.begin() as conn:
+                create_partition(conn, start, interval)
+        except Exception as e:
+            print(f"Could not create partition {partition_name(start, interval)}: {e}")
+        start = next_partition_start(start, interval)
+
+
+def migrate_measurements(engine, measurement_table, interval=PARTITION_INTERVAL):
+    """Convert a single-table measurements layout into the partitioned one.
+
+    Runs in one transaction: the old table is renamed out of the way, the
+    partitioned table is created from the model, partitions covering the old
+    data are created and the rows are copied across. The old table is dropped
+    afterwards unless MEASUREMENT_KEEP_LEGACY_TABLE=1.
+    """
+    with engine.begin() as conn:
+        if table_kind(conn, PARENT_TABLE) != "r":
+            return False
+
+        print("Migrating measurements to the partitioned layout...")
+        conn.execute(text(f"LOCK TABLE {PARENT_TABLE} IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text(f"ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_TABLE}"))
+        # Free the names the new table will need
+        conn.execute(text(f"ALTER TABLE {LEGACY_TABLE} RENAME CONSTRAINT {PARENT_TABLE}_pkey TO {LEGACY_TABLE}_pkey"))
+        conn.execute(text(f"ALTER SEQUENCE IF EXISTS {PARENT_TABLE}_id_seq RENAME TO {LEGACY_TABLE}_id_seq"))
+
+        measurement_table.create(conn)
+
+        first, last, count = conn.execute(text(
+            f"SELECT min(timestamp), max(timestamp), count(*) FROM {LEGACY_TABLE}"
+        )).one()
+        if count:
+            create_partitions(conn, first, last, interval)
+            conn.execute(text(f"""
+                INSERT INTO {PARENT_TABLE} (id, device_id, timestamp, field, value, unit)
+                SELECT id, device_id, timestamp, field, value, unit FROM {LEGACY_TABLE}
+            """))
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{PARENT_TABLE}', 'id'), "
+                f"(SELECT max(id) FROM {PARENT_TABLE}))"
+            ))
+
+        if not KEEP_LEGACY_TABLE:
+            conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+        print(f"Migrated {count} measurements into partitioned table")
+    return True
+
+
+def start_partition_maintenance(engine, interval=PARTITION_INTERVAL, check_interval=PARTITION_CHECK_INTERVAL):
+    """Periodically create upcoming partitions from a daemon thread"""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(check_interval):
+            try:
+                ensure_partitions(engine, interval)
+            except Exception as e:
+                print(f"Error creating measurement partitions: {e}")
+
+    thread = threading.Thread(target=run, name="bms-partition-maintenance", daemon=True)
+    thread.start()
+    return stop
@@ -0,0 +1,109 @@
+import json
+import struct
+from datetime import datetime
+from metrics import READINGS_REJECTED
+
+try:
+    import msgpack
+except ImportError:  # only needed to receive the "msgpack" format
+    msgpack = None
+
+# Decoding side of the compact wire formats in publishers/payloads.py; the
+# code tables and struct layouts must stay in sync with that module.
+FIELDS = {1: "temperature", 2: "humidity", 3: "co2"}
+UNITS = {1: "F", 2: "%", 3: "ppm"}
+
+CONTENT_TYPE_FORMATS = {
+    "application/json": "json",
+    "application/x-msgpack": "msgpack",
+    "application/msgpack": "msgpack",
+    "application/vnd.bms.readings": "struct",
+}
+
+STRUCT_MAGIC = b"BR"
+STRUCT_VERSION = 1
+STRUCT_HEADER = struct.Struct("!2sBH")
+STRUCT_READING = struct.Struct("!HBBdq")
+
+
+def payload_format(msg):
+    """Pick the payload format from the MQTT v5 content type, then the topic.
+
+    Batched envelopes are published to <building>/sensors/batch/<format>;
+    anything else without a content type is a single JSON reading.
+    """
+    properties = getattr(msg, "properties", None)
+    content_type = getattr(properties, "ContentType", None) if properties is not None else None
+    if content_type:
+        fmt = CONTENT_TYPE_FORMATS.get(content_type.split(";")[0].strip())
+        if fmt is None:
+            raise ValueError(f"Unsupported content type: {content_type}")
+        return fmt
+
+    topic_parts = msg.topic.split('/')
+    if len(topic_parts) >= 4 and topic_parts[-2] == "batch":
+        return topic_parts[-1]
+    return "json"
+
+
+def _from_millis(timestamp_ms):
+    return datetime.fromtimestamp(timestamp_ms / 1000.0)
+
+
+def _compact_reading(device_id, zone_id, field_code, unit_code, value, timestamp_ms):
+    """Reading dict of a compact record, or None if it carries a field or unit code we don't know"""
+    field, unit = FIELDS.get(field_code), UNITS.get(unit_code)
+    if field is None or unit is None:
+        READINGS_REJECTED.labels("unknown-code").inc()
+        return None
+    return {"device_id": device_id, "zone_id": zone_id, "field": field, "unit": unit,
+            "reading": value, "timestamp": _from_millis(timestamp_ms)}
+
+
+def decode_readings(msg):
+    """Decode an MQTT message into a list of reading dicts.
+
+    Each dict has the keys of the original JSON message (device_id, zone_id,
+    reading, timestamp, field, unit). Compact formats carry epoch millis, which
+    are converted to datetimes here so no ISO string parsing is needed.
+    Compact records with unknown field or unit codes (e.g. from a newer
+    publisher) are dropped and counted.
+    """
+    fmt = payload_format(msg)
+
+    if fmt == "json":
+        data = json.loads(msg.payload)
+        readings = data["readings"] if isinstance(data, dict) and "readings" in data else data
+        if isinstance(readings, dict):
+            readings = [readings]
+        for reading in readings:
+            if "timestamp_ms" in reading:
+                reading["timestamp"] = _from_millis(reading.pop("timestamp_ms"))
+        return readings
+
+    if fmt == "msgpack":
+        if msgpack is None:
+            raise ValueError("Received a msgpack payload but msgpack is not installed")
+        envelope = msgpack.unpackb(msg.payload)
+        readings = [_compact_reading(*record) for record in envelope["r"]]
+        return [reading for reading in readings if reading is not None]
+
+    if fmt == "struct":
+        payload = msg.payload
+        magic, version, count = STRUCT_HEADER.unpack_from(payload, 0)
+        if magic != STRUCT_MAGIC or version != STRUCT_VERSION:
+            raise ValueError(f"Bad struct payload header: {magic!r} v{version}")
+        offset = STRUCT_HEADER.size
+        readings = []
+        for _ in range(count):
+            length = payload[offset]
+            device_id = payload[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+            zone_id, field_code, unit_code, value, timestamp_ms = STRUCT_READING.unpack_from(payload, offset)
+            offset += STRUCT_READING.size
+            reading = _compact_reading(device_id, zone_id, field_code, unit_code, value, timestamp_ms)
+            if reading is not None:
+                readings.append(reading)
+        return readings
+
+    raise ValueError(f"Unknown payload format: {fmt}")
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from db_models import Building, Device, Zone
+from stats import SampledLog
+
+# Shortest time between zone table reloads triggered by readings naming an unknown zone
+ZONE_RELOAD_INTERVAL = float(os.environ.get("ZONE_RELOAD_INTERVAL", 30))  # seconds
+
+
+class DeviceRegistry:
+    """In-memory view of the buildings, zones and devices tables.
+
+    Loaded once at startup so the ingest path can check device existence
+    without querying the database. Unknown devices are registered with an
+    INSERT ... ON CONFLICT DO NOTHING, so concurrent writers (or several
+    subscriber processes) racing to add the same device never collide.
+    Zones created after startup are picked up by reloading the zones table
+    when a reading names one not seen yet, at most once per reload_interval;
+    devices registered without a zone are then moved into it.
+    """
+
+    def __init__(self, SessionFactory, reload_interval=ZONE_RELOAD_INTERVAL):
+        self.SessionFactory = SessionFactory
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._zones_loaded = float("-inf")
+        self.devices = {}  # device id -> zone id
+        self.zones = {}  # zone id -> building id
+        self.buildings = set()
+        self.log = SampledLog()
+
+    def load(self):
+        """(Re)load all known devices, zones and buildings from the database"""
+        session = self.SessionFactory()
+        try:
+            buildings = {building_id for (building_id,) in session.query(Building.id)}
+            zones = dict(session.query(Zone.id, Zone.building_id))
+            devices = dict(session.query(Device.id, Device.zone_id))
+        finally:
+            session.close()
+
+        with self._lock:
+            self.buildings = buildings
+            self.zones = zones
+            self.devices = devices
+            self._zones_loaded = time.monotonic()
+        print(f"Device registry loaded {len(devices)} devices in {len(zones)} zones of {len(buildings)} buildings")
+
+    def has_device(self, device_id):
+        return device_id in self.devices
+
+    def reload_zones(self):
+        """Re-read the zones table unless it was read less than reload_interval ago; returns whether it was"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._zones_loaded < self.reload_interval:
+                return False
+            self._zones_loaded = now
+        session = self.SessionFactory()
+        try:
+            zones = dict(session.query(Zone.id, Zone.building_id))
+        finally:
+            session.close()
+        with self._lock:
+            added = len(zones) - len(self.zones)
+            self.zones = zones
+        if added:
+            print(f"Device registry loaded {added} new zones")
+        return True
+
+    def has_zone(self, zone_id, building_id=None):
+        """Whether zone_id exists (and, if building_id is given, belongs to that building)"""
+        if zone_id not in self.zones:
+            # Possibly created since the last load
+            if zone_id is None or not self.reload_zones() or zone_id not in self.zones:
+                return False
+        owner = self.zones[zone_id]
+        return building_id is None or owner is None or owner == building_id
+
+    def ensure_devices(self, session, device_zones):
+        """Register any devices in device_zones (device id -> (zone id, building id)) not seen before.
+
+        Buildings seen for the first time are registered too, and devices
+        registered without a zone are assigned the zone their readings name
+        once it exists. Runs inside the caller's session so the new rows commit
+        together with the measurements that reference them.
+        """
+        missing = {device_id: location for device_id, location in device_zones.items()
+                   if device_id not in self.devices}
+        unzoned = {device_id: (zone_id, building_id) for device_id, (zone_id, building_id) in device_zones.items()
+                   if device_id in self.devices and self.devices[device_id] is None and zone_id is not None
+                   and self.has_zone(zone_id, building_id)}
+        assigned = self.assign_zones(session, unzoned)
+        if not missing:
+            return assigned
+
+        new_buildings = sorted({building_id for _, building_id in missing.values()} - self.buildings)
+        if new_buildings:
+            session.execute(insert(Building).values([{"id": b, "name": b} for b in new_buildings])
+                            .on_conflict_do_nothing(index_elements=[Building.id]))
+
+        values = []
+        for device_id, (zone_id, building_id) in missing.items():
+            if not self.has_zone(zone_id, building_id):
+                # Keep the reading but don't violate the zones foreign key or cross buildings
+                self.log("unknown-zone", "Unknown zone {} in building {} for device {}; registering without a zone",
+                         zone_id, building_id, device_id)
+                zone_id = None
+            device_type = device_id.split('-')[0]  # Extract type from device_id (e.g., 'temp' from 'temp-1')
+            values.append({"id": device_id, "zone_id": zone_id, "building_id": building_id, "device_type": device_type})
+
+        session.execute(insert(Device).values(values).on_conflict_do_nothing(index_elements=[Device.id]))
+        return assigned + values
+
+    def assign_zones(self, session, device_zones):
+        """Move devices registered without a zone into the zones in device_zones (device id -> (zone id, building id))"""
+        by_zone = {}
+        for device_id, (zone_id, _) in device_zones.items():
+            by_zone.setdefault(zone_id, []).append(device_id)
+        for zone_id, device_ids in sorted(by_zone.items()):
+            # Only devices still without a zone: a concurrent writer or an operator may have placed them
+            session.execute(update(Device).where(Device.id.in_(device_ids), Device.zone_id.is_(None))
+                            .values(zone_id=zone_id))
+        return [{"id": device_id, "zone_id": zone_id, "building_id": building_id}
+                for device_id, (zone_id, building_id) in device_zones.items()]
+
+    def mark_registered(self, values):
+        """Record devices returned by ensure_devices once their transaction has committed"""
+        if not values:
+            return
+        with self._lock:
+            for value in values:
+                if value["building_id"] not in self.buildings:
+                    self.log("new-building", "Added new building: {}", value["building_id"])
+                    self.buildings.add(value["building_id"])
+                if value["id"] not in self.devices:
+                    self.log("new-device", "Added new device: {}", value["id"])
+                elif self.devices[value["id"]] is None and value["zone_id"] is not None:
+                    self.log("zone-assigned", "Assigned device {} to zone {}", value["id"], value["zone_id"])
+                self.devices[value["id"]] = value["zone_id"]
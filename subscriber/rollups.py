@@ -0,0 +1,266 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+from db_models import Device, Measurement, DeviceRollup, Zone, ZoneRollup
+from deadband import DEADBAND_FILTER
+from archive import ARCHIVE_DIR, read_watermark
+
+# Rollup resolutions from finest to coarsest
+RESOLUTIONS = {
+    "1m": timedelta(minutes=1),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+ROLLUPS_ENABLED = os.environ.get("ROLLUPS_ENABLED", "1") == "1"
+# Query helpers use the coarsest resolution that still yields this many buckets
+ROLLUP_MIN_BUCKETS = int(os.environ.get("ROLLUP_MIN_BUCKETS", 60))
+
+# Postgres date_trunc unit for each resolution
+_TRUNC_UNITS = {"1m": "minute", "1h": "hour", "1d": "day"}
+
+
+def bucket_floor(ts, resolution):
+    """Start of the bucket containing ts"""
+    if resolution == "1m":
+        return ts.replace(second=0, microsecond=0)
+    if resolution == "1h":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if resolution == "1d":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown rollup resolution: {resolution}")
+
+
+def bucket_ceil(ts, resolution):
+    """Start of the first bucket beginning at or after ts"""
+    start = bucket_floor(ts, resolution)
+    return start if start == ts else start + RESOLUTIONS[resolution]
+
+
+def choose_resolution(start_time, end_time, min_buckets=ROLLUP_MIN_BUCKETS):
+    """Coarsest resolution giving at least min_buckets buckets, or None for raw data"""
+    span = end_time - start_time
+    for resolution in reversed(list(RESOLUTIONS)):
+        if span / RESOLUTIONS[resolution] >= min_buckets:
+            return resolution
+    return None
+
+
+def _aggregate(rows, key):
+    """Fold rows into per-bucket [count, sum, min, max, last_value, last_timestamp] for every resolution"""
+    buckets = {}
+    for row in rows:
+        key_value = row[key]
+        if key_value is None:
+            continue
+        value, ts = row["value"], row["timestamp"]
+        for resolution in RESOLUTIONS:
+            bucket_key = (resolution, key_value, row["field"], bucket_floor(ts, resolution))
+            agg = buckets.get(bucket_key)
+            if agg is None:
+                buckets[bucket_key] = [1, value, value, value, value, ts]
+                continue
+            agg[0] += 1
+            agg[1] += value
+            agg[2] = min(agg[2], value)
+            agg[3] = max(agg[3], value)
+            if ts >= agg[5]:
+                agg[4], agg[5] = value, ts
+    return buckets
+
+
+def _upsert(session, model, key_column, buckets):
+    if not buckets:
+        return
+    # Sorted by primary key so concurrent writers lock rows in the same order
+    values = [
+        {
+            "resolution": resolution,
+            key_column: key_value,
+            "field": field,
+            "bucket_start": bucket_start,
+            "count": agg[0],
+            "sum_value": agg[1],
+            "min_value": agg[2],
+            "max_value": agg[3],
+            "last_value": agg[4],
+            "last_timestamp": agg[5],
+        }
+        for (resolution, key_value, field, bucket_start), agg in sorted(buckets.items())
+    ]
+    table = model.__table__
+    stmt = insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.resolution, table.c[key_column], table.c.field, table.c.bucket_start],
+        set_={
+            "count": table.c.count + stmt.excluded.count,
+            "sum_value": table.c.sum_value + stmt.excluded.sum_value,
+            "min_value": func.least(table.c.min_value, stmt.excluded.min_value),
+            "max_value": func.greatest(table.c.max_value, stmt.excluded.max_value),
+            "last_value": text(
+                f"CASE WHEN excluded.last_timestamp >= {table.name}.last_timestamp "
+                f"THEN excluded.last_value ELSE {table.name}.last_value END"
+            ),
+            "last_timestamp": func.greatest(table.c.last_timestamp, stmt.excluded.last_timestamp),
+        },
+    )
+    session.execute(stmt, values)
+
+
+def update_rollups(session, rows, in_zone=None):
+    """Merge a batch of measurement rows into the device and zone rollups.
+
+    Runs in the caller's transaction so rollups commit together with the raw
+    rows. Readings for which in_zone(row) is false (unknown zone, or a zone of
+    another building) only update device rollups.
+    """
+    _upsert(session, DeviceRollup, "device_id", _aggregate(rows, "device_id"))
+    if in_zone is not None:
+        rows = [row for row in rows if in_zone(row)]
+    _upsert(session, ZoneRollup, "zone_id", _aggregate(rows, "zone_id"))
+
+
+def _sum_count(session, model, key_filter, raw_query, start_time, end_time, include_end, resolutions,
+               raw_complete=True):
+    """Sum and count of values in [start_time, end_time), using the coarsest
+    rollups that fit entirely inside the range and finer ones (down to raw
+    measurements) for the partial buckets at either edge.
+
+    When raw rows are incomplete (raw_complete=False, the deadband filter
+    holds readings back) the partial edges come from the finest rollup
+    buckets overlapping them instead, so the range widens to whole minutes.
+    """
+    if start_time >= end_time and not (include_end and raw_complete):
+        return 0.0, 0
+
+    for i, resolution in enumerate(resolutions):
+        first = bucket_ceil(start_time, resolution)
+        last = bucket_floor(end_time, resolution)
+        if first >= last:
+            continue
+        total, count = session.query(func.sum(model.sum_value), func.sum(model.count)).filter(
+            model.resolution == resolution,
+            key_filter,
+            model.bucket_start >= first,
+            model.bucket_start < last,
+        ).one()
+        finer = resolutions[i + 1:]
+        left = _sum_count(session, model, key_filter, raw_query, start_time, first, False, finer, raw_complete)
+        right = _sum_count(session, model, key_filter, raw_query, last, end_time, include_end, finer, raw_complete)
+        return (total or 0.0) + left[0] + right[0], (count or 0) + left[1] + right[1]
+
+    if not raw_complete:
+        finest = next(iter(RESOLUTIONS))
+        total, count = session.query(func.sum(model.sum_value), func.sum(model.count)).filter(
+            model.resolution == finest,
+            key_filter,
+            model.bucket_start >= bucket_floor(start_time, finest),
+            model.bucket_start < end_time,
+        ).one()
+        return total or 0.0, count or 0
+
+    upper = Measurement.timestamp <= end_time if include_end else Measurement.timestamp < end_time
+    total, count = raw_query.filter(Measurement.timestamp >= start_time, upper).one()
+    return total or 0.0, count or 0
+
+
+def get_zone_average(session, zone_id, field, start_time, end_time, raw_complete=not DEADBAND_FILTER):
+    """Average of a field over a zone's devices between start_time and end_time (inclusive)"""
+    raw_query = session.query(func.sum(Measurement.value), func.count(Measurement.value)).\
+        join(Device).\
+        filter(Device.zone_id == zone_id, Measurement.field == field)
+    key_filter = (ZoneRollup.zone_id == zone_id) & (ZoneRollup.field == field)
+    resolutions = list(reversed(list(RESOLUTIONS)))
+    total, count = _sum_count(session, ZoneRollup, key_filter, raw_query, start_time, end_time, True, resolutions,
+                              raw_complete)
+    return total / count if count else None
+
+
+def get_building_average(session, building_id, field, start_time, end_time, raw_complete=not DEADBAND_FILTER):
+    """Average of a field over the devices in a building's zones between start_time and end_time (inclusive)"""
+    zone_ids = session.query(Zone.id).filter(Zone.building_id == building_id).scalar_subquery()
+    raw_query = session.query(func.sum(Measurement.value), func.count(Measurement.value)).\
+        join(Device).\
+        filter(Device.zone_id.in_(zone_ids), Measurement.field == field)
+    key_filter = ZoneRollup.zone_id.in_(zone_ids) & (ZoneRollup.field == field)
+    resolutions = list(reversed(list(RESOLUTIONS)))
+    total, count = _sum_count(session, ZoneRollup, key_filter, raw_query, start_time, end_time, True, resolutions,
+                              raw_complete)
+    return total / count if count else None
+
+
+def get_device_rollup_series(session, device_id, field, start_time, end_time, resolution):
+    """(bucket_start, average) pairs for a device and field at the given resolution"""
+    return session.query(DeviceRollup.bucket_start, DeviceRollup.sum_value / DeviceRollup.count).\
+        filter(
+            DeviceRollup.resolution == resolution,
+            DeviceRollup.device_id == device_id,
+            DeviceRollup.field == field,
+            DeviceRollup.bucket_start >= bucket_floor(start_time, resolution),
+            DeviceRollup.bucket_start <= end_time
+        ).order_by(DeviceRollup.bucket_start).all()
+
+
+def backfill_rollups(engine, start_time, end_time, archive_dir=ARCHIVE_DIR, deadband_filter=DEADBAND_FILTER):
+    """Recompute rollups for [start_time, end_time) from the raw measurements.
+
+    Bucket rows in the range are overwritten with what the raw rows add up
+    to, e.g. after enabling rollups on a database that already holds history.
+    The range is widened to whole days so every resolution sees complete
+    buckets. Days up to the archive watermark are skipped: their raw rows
+    have moved to Parquet and the rollups are the only complete record.
+    Refused under the deadband filter, for the same reason: raw rows are only
+    the change points and would undercount. Returns the range actually
+    rebuilt, or None if nothing was left of it.
+    """
+    if deadband_filter:
+        raise ValueError("Rollups can't be rebuilt from raw rows stored through the deadband filter")
+    start_time = bucket_floor(start_time, "1d")
+    end_time = bucket_ceil(end_time, "1d")
+    watermark = read_watermark(archive_dir)
+    if watermark is not None:
+        start_time = max(start_time, bucket_ceil(watermark, "1d"))
+    if start_time >= end_time:
+        return None
+    with engine.begin() as conn:
+        for resolution, unit in _TRUNC_UNITS.items():
+            for table, key, source in (
+                ("device_rollups", "device_id", "measurements m"),
+                ("zone_rollups", "zone_id", "measurements m JOIN devices d ON d.id = m.device_id"),
+            ):
+                key_expr = "m.device_id" if key == "device_id" else "d.zone_id"
+                conn.execute(text(f"""
+                    INSERT INTO {table} (resolution, {key}, field, bucket_start, count, sum_value,
+                                         min_value, max_value, last_value, last_timestamp)
+                    SELECT :resolution, {key_expr}, m.field, date_trunc('{unit}', m.timestamp),
+                           count(*), sum(m.value), min(m.value), max(m.value),
+                           (array_agg(m.value ORDER BY m.timestamp DESC))[1], max(m.timestamp)
+                    FROM {source}
+                    WHERE m.timestamp >= :start_time AND m.timestamp < :end_time AND {key_expr} IS NOT NULL
+                    GROUP BY {key_expr}, m.field, date_trunc('{unit}', m.timestamp)
+                    ON CONFLICT (resolution, {key}, field, bucket_start) DO UPDATE SET
+                        count = excluded.count,
+                        sum_value = excluded.sum_value,
+                        min_value = excluded.min_value,
+                        max_value = excluded.max_value,
+                        last_value = excluded.last_value,
+                        last_timestamp = excluded.last_timestamp
+                """), {"resolution": resolution, "start_time": start_time, "end_time": end_time})
+    return start_time, end_time
+
+
+if __name__ == "__main__":
+    from db_models import init_db
+
+    parser = argparse.ArgumentParser(description="Rebuild measurement rollups from raw data")
+    parser.add_argument("--start", type=datetime.fromisoformat, required=True, help="ISO start time")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.now(), help="ISO end time (default: now)")
+    args = parser.parse_args()
+
+    engine, _ = init_db()
+    rebuilt = backfill_rollups(engine, args.start, args.end)
+    if rebuilt is None:
+        print(f"Nothing to rebuild: raw measurements before {read_watermark()} are archived")
+    else:
+        print(f"Rebuilt rollups from {rebuilt[0]} to {rebuilt[1]}")
@@ -0,0 +1,451 @@
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from ingest import RejectedRows
+
+# Record framing: payload length, CRC32 of the payload, append time (epoch seconds)
+FRAME_HEADER = struct.Struct("!IId")
+SEGMENT_SUFFIX = ".seg"
+READ_CHUNK = 4 * 1024 * 1024
+CHECKPOINT_FILE = "checkpoint.json"
+SPOOL_ID_FILE = "spool.id"
+QUARANTINE_DIR = "quarantine"
+# Key of the (spool id, segment, offset after the record) tag on every drained row
+POSITION_KEY = "spool_position"
+
+
+def encode_row(row):
+    return json.dumps([row["device_id"], row["zone_id"], row["timestamp"].isoformat(),
+                       row["field"], row["value"], row["unit"], row["building_id"]]).encode()
+
+
+def encode_frame(row):
+    payload = encode_row(row)
+    return FRAME_HEADER.pack(len(payload), zlib.crc32(payload), time.time()) + payload
+
+
+def decode_row(payload, default_building=None):
+    # Records spooled before buildings existed have six fields
+    device_id, zone_id, timestamp, field, value, unit, *building = json.loads(payload)
+    return {"device_id": device_id, "zone_id": zone_id, "timestamp": datetime.fromisoformat(timestamp),
+            "field": field, "value": value, "unit": unit, "building_id": building[0] if building else default_building}
+
+
+class Spool:
+    """Durable append-only spool of parsed readings between MQTT and the database.
+
+    The MQTT callback appends framed records to the current segment file; a sync
+    thread flushes and fsyncs them every fsync_interval seconds (or as soon as
+    fsync_batch records are pending), so the callback never waits on the disk or
+    the database. A drainer thread hands everything synced so far to flush_fn in
+    batches of up to batch_size, checkpoints its position after every successful
+    batch and deletes fully drained segments. Exceptions in retry_on (database
+    unavailable) are retried with backoff without losing the batch; after a
+    restart draining resumes from the checkpoint. Once max_bytes are on disk
+    (quarantined readings included) new readings are dropped.
+
+    Every drained row is tagged with POSITION_KEY. A flush_fn that stores the
+    newest position in the same transaction as the rows, and a stored_position
+    callable returning it, make replays exactly once: before retrying, and
+    when starting, rows the database already holds are skipped. flush_fn is
+    called as flush_fn(rows, reject=...); rows it can't store are passed to
+    reject (or raised as RejectedRows, or the whole batch on any other error)
+    and kept in a quarantine segment instead of being retried forever.
+    """
+
+    def __init__(self, directory, flush_fn, segment_bytes=64 * 1024 * 1024, max_bytes=1024 * 1024 * 1024,
+                 batch_size=5000, fsync_interval=0.5, fsync_batch=1000, retry_on=(Exception,),
+                 max_backoff=30.0, stats_interval=60, name=None, stored_position=None):
+        self.directory = directory
+        self.name = name  # e.g. the building whose readings this spool holds
+        self.flush_fn = flush_fn
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.retry_on = retry_on
+        self.max_backoff = max_backoff
+        self.stats_interval = stats_interval
+        self.stored_position = stored_position  # spool id -> (segment, offset) in the database, or None
+        self.spool_id = None
+
+        self._lock = threading.Lock()
+        self._synced_cond = threading.Condition(self._lock)
+        self._sync_needed = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+        self._sizes = {}          # segment seq -> bytes on disk
+        self._disk_bytes = 0      # segments plus quarantine files
+        self._quarantine_bytes = 0
+        self._file = None         # segment being appended to
+        self._write_seq = 0
+        self._pending = 0         # records appended since the last sync
+        self._synced = (0, 0)     # (seq, offset) the drainer may read up to
+        self._read_seq = 0        # drainer position; also the checkpoint once committed
+        self._read_offset = 0
+        self._read_file = None
+
+        # Counters reported by stats()
+        self._appended = 0
+        self._dropped = 0
+        self._drained = 0
+        self._failed_batches = 0
+        self._failed_rows = 0
+        self._quarantined = 0
+        self._skipped = 0  # replayed rows the database already had
+        self._retries = 0
+        self._oldest_undrained = None  # append time of the first record of the batch being drained
+        self._last_stats_report = time.monotonic()
+
+        self._open()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:012d}{SEGMENT_SUFFIX}")
+
+    def _open(self):
+        """Recover existing segments and the checkpoint, then start a fresh segment"""
+        os.makedirs(self.directory, exist_ok=True)
+        # Names this spool in the database's stored positions; kept for the directory's lifetime
+        id_path = os.path.join(self.directory, SPOOL_ID_FILE)
+        try:
+            with open(id_path) as f:
+                self.spool_id = f.read().strip()
+        except FileNotFoundError:
+            pass
+        if not self.spool_id:
+            self.spool_id = uuid.uuid4().hex
+            with open(id_path + ".tmp", "w") as f:
+                f.write(self.spool_id)
+            os.replace(id_path + ".tmp", id_path)
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self._sizes[seq] = os.path.getsize(self._segment_path(seq))
+        # Quarantined readings stay on disk until someone deals with them, so they count against max_bytes
+        quarantine = os.path.join(self.directory, QUARANTINE_DIR)
+        if os.path.isdir(quarantine):
+            self._quarantine_bytes = sum(os.path.getsize(os.path.join(quarantine, name))
+                                         for name in os.listdir(quarantine))
+        self._disk_bytes = sum(self._sizes.values()) + self._quarantine_bytes
+
+        checkpoint = (min(self._sizes), 0) if self._sizes else (1, 0)
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                saved = json.load(f)
+            checkpoint = (saved["segment"], saved["offset"])
+        except (OSError, ValueError, KeyError):
+            pass
+        self._read_seq, self._read_offset = checkpoint
+        if self._read_seq not in self._sizes:
+            self._read_offset = 0
+        for seq in [seq for seq in self._sizes if seq < self._read_seq]:
+            self._delete_segment(seq)
+
+        # Never append to a recovered segment; a crash may have left a torn record at its end
+        self._write_seq = max(max(self._sizes, default=0) + 1, self._read_seq)
+        self._file = open(self._segment_path(self._write_seq), "ab")
+        self._sizes[self._write_seq] = 0
+        self._synced = (self._write_seq, 0)
+
+        backlog = self.lag_bytes()
+        if backlog:
+            print(f"Spool recovered {backlog} bytes of undrained readings in {self.directory}")
+
+    def _delete_segment(self, seq):
+        try:
+            os.remove(self._segment_path(seq))
+        except FileNotFoundError:
+            pass
+        self._disk_bytes -= self._sizes.pop(seq, 0)
+
+    def start(self):
+        """Start the sync and drainer threads"""
+        self._stop.clear()
+        suffix = f"-{self.name}" if self.name else ""
+        self._threads = [
+            threading.Thread(target=self._sync_loop, name=f"bms-spool-sync{suffix}", daemon=True),
+            threading.Thread(target=self._drain_loop, name=f"bms-spool-drainer{suffix}", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=30):
+        """Sync everything appended and give the drainer up to timeout seconds to catch up"""
+        self.sync()
+        deadline = time.monotonic() + timeout
+        while self.lag_bytes() and time.monotonic() < deadline and self._threads[1].is_alive():
+            time.sleep(0.1)
+        self._stop.set()
+        self._sync_needed.set()
+        with self._synced_cond:
+            self._synced_cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        with self._lock:
+            self._file.close()
+            if self._read_file is not None:
+                self._read_file.close()
+
+    def put(self, row):
+        """Append a parsed reading; returns False if the spool is full and it was dropped"""
+        frame = encode_frame(row)
+        with self._lock:
+            if self._disk_bytes + len(frame) > self.max_bytes:
+                self._dropped += 1
+                return False
+            if self._sizes[self._write_seq] + len(frame) > self.segment_bytes and self._sizes[self._write_seq]:
+                self._roll()
+            self._file.write(frame)
+            self._sizes[self._write_seq] += len(frame)
+            self._disk_bytes += len(frame)
+            self._appended += 1
+            self._pending += 1
+            if self._pending >= self.fsync_batch:
+                self._sync_needed.set()
+        return True
+
+    def _roll(self):
+        """Seal the current segment and start the next one (called with the lock held)"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._write_seq += 1
+        self._file = open(self._segment_path(self._write_seq), "ab")
+        self._sizes[self._write_seq] = 0
+        self._pending = 0
+        self._synced = (self._write_seq, 0)
+        self._synced_cond.notify_all()
+
+    def sync(self):
+        """Flush and fsync appended records, then make them visible to the drainer"""
+        with self._lock:
+            if not self._pending:
+                return
+            self._file.flush()
+            fd = os.dup(self._file.fileno())
+            position = (self._write_seq, self._sizes[self._write_seq])
+            self._pending = 0
+        try:
+            # fsync outside the lock so appends aren't blocked on the disk
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self._synced_cond:
+            if position > self._synced:
+                self._synced = position
+            self._synced_cond.notify_all()
+
+    def _sync_loop(self):
+        while not self._stop.is_set():
+            self._sync_needed.wait(self.fsync_interval)
+            self._sync_needed.clear()
+            try:
+                self.sync()
+            except OSError as e:
+                print(f"Error syncing spool: {e}")
+
+    def _next_segment(self, seq):
+        with self._lock:
+            return min(s for s in self._sizes if s > seq)
+
+    def _read_batch(self):
+        """Read up to batch_size synced records from the drainer position.
+
+        Returns (rows, position after the last record, append time of the first record).
+        """
+        with self._lock:
+            synced_seq, synced_offset = self._synced
+        seq, offset = self._read_seq, self._read_offset
+        rows, first_appended = [], None
+        while len(rows) < self.batch_size:
+            end = synced_offset if seq == synced_seq else self._sizes.get(seq, 0)
+            if offset >= end:
+                if seq >= synced_seq:
+                    break
+                seq, offset = self._next_segment(seq), 0
+                continue
+
+            if self._read_file is None or self._read_file.name != self._segment_path(seq):
+                if self._read_file is not None:
+                    self._read_file.close()
+                self._read_file = open(self._segment_path(seq), "rb")
+            self._read_file.seek(offset)
+            data = self._read_file.read(min(end - offset, READ_CHUNK))
+
+            position, corrupt = 0, False
+            while len(rows) < self.batch_size and position + FRAME_HEADER.size <= len(data):
+                length, crc, appended = FRAME_HEADER.unpack_from(data, position)
+                start = position + FRAME_HEADER.size
+                if start + length > len(data):
+                    # Record continues past this chunk, or is torn if the chunk reached the end
+                    corrupt = offset + len(data) >= end
+                    break
+                payload = data[start:start + length]
+                if zlib.crc32(payload) != crc:
+                    corrupt = True
+                    break
+                row = decode_row(payload, self.name)
+                row[POSITION_KEY] = (self.spool_id, seq, offset + start + length)
+                rows.append(row)
+                if first_appended is None:
+                    first_appended = appended
+                position = start + length
+            else:
+                corrupt = len(rows) < self.batch_size and position < len(data) and offset + len(data) >= end
+            offset += position
+
+            if corrupt:
+                # Torn or corrupt tail left by a crash; skip the rest of the segment
+                print(f"Skipping {end - offset} unreadable bytes at the end of spool segment {seq}")
+                offset = end
+        return rows, (seq, offset), first_appended
+
+    def _commit(self, position, count):
+        """Persist the drainer position and delete segments it has moved past"""
+        checkpoint = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(checkpoint + ".tmp", "w") as f:
+            json.dump({"segment": position[0], "offset": position[1]}, f)
+        os.replace(checkpoint + ".tmp", checkpoint)
+        with self._lock:
+            self._read_seq, self._read_offset = position
+            for seq in [seq for seq in self._sizes if seq < position[0]]:
+                self._delete_segment(seq)
+            self._drained += count
+            self._oldest_undrained = None
+
+    def _database_position(self):
+        """Position the database has stored this spool up to, or None if unknown"""
+        if self.stored_position is None:
+            return None
+        try:
+            return self.stored_position(self.spool_id)
+        except Exception as e:
+            print(f"Could not read the stored position of spool {self.spool_id}: {e}")
+            return None
+
+    def _unstored(self, rows):
+        """The rows of a batch the database doesn't hold yet, e.g. after a lost COMMIT acknowledgement"""
+        stored = self._database_position()
+        if stored is None:
+            return rows
+        remaining = [row for row in rows if row[POSITION_KEY][1:] > stored]
+        with self._lock:
+            self._skipped += len(rows) - len(remaining)
+        return remaining
+
+    def _quarantine(self, rows, error):
+        """Keep readings that can't be stored in a quarantine segment, with the same framing"""
+        directory = os.path.join(self.directory, QUARANTINE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, time.strftime("%Y%m%d") + SEGMENT_SUFFIX)
+        frames = b"".join(encode_frame(row) for row in rows)
+        with open(path, "ab") as f:
+            f.write(frames)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._quarantined += len(rows)
+            self._quarantine_bytes += len(frames)
+            self._disk_bytes += len(frames)
+        print(f"Quarantined {len(rows)} spooled readings in {path}: {error}")
+
+    def _drain_loop(self):
+        # Resume after the rows a previous run stored but didn't get to checkpoint
+        stored = self._database_position()
+        if stored is not None and stored > (self._read_seq, self._read_offset) and stored[0] in self._sizes:
+            self._commit(stored, 0)
+
+        while not self._stop.is_set():
+            rows, position, first_appended = self._read_batch()
+            if not rows:
+                if position != (self._read_seq, self._read_offset):
+                    self._commit(position, 0)  # moved past an empty or corrupt tail
+                    continue
+                with self._synced_cond:
+                    self._synced_cond.wait(self.fsync_interval)
+                self._maybe_report()
+                continue
+
+            with self._lock:
+                self._oldest_undrained = first_appended
+            backoff = 1.0
+            count = len(rows)
+            while rows:
+                try:
+                    self.flush_fn(rows, reject=lambda row, error: self._quarantine([row], error))
+                    break
+                except self.retry_on as e:
+                    # Database unavailable: keep the batch and try again, nothing is lost
+                    with self._lock:
+                        self._retries += 1
+                    print(f"Spool drain of {len(rows)} readings failed, retrying in {backoff:.0f}s: {e}")
+                    if self._stop.wait(backoff):
+                        return
+                    backoff = min(self.max_backoff, backoff * 2)
+                    # Part of the batch may have been committed before the failure
+                    rows = self._unstored(rows)
+                except RejectedRows as e:
+                    # Stored except for e.rows, which flush_fn already passed to reject
+                    with self._lock:
+                        self._failed_rows += len(e.rows)
+                    break
+                except Exception as e:
+                    self._quarantine(rows, e)
+                    with self._lock:
+                        self._failed_batches += 1
+                        self._failed_rows += len(rows)
+                    break
+            self._commit(position, count)
+            self._maybe_report()
+
+    def lag_bytes(self):
+        """Bytes appended to the spool but not yet drained into the database"""
+        with self._lock:
+            return sum(size for seq, size in self._sizes.items() if seq >= self._read_seq) - self._read_offset
+
+    def _maybe_report(self):
+        if not self.stats_interval:
+            return
+        now = time.monotonic()
+        if now - self._last_stats_report < self.stats_interval:
+            return
+        self._last_stats_report = now
+        s = self.stats()
+        label = f" [{self.name}]" if self.name else ""
+        print(f"Spool stats{label}: lag={s['lag_bytes']}B/{s['lag_seconds']:.1f}s disk={s['disk_bytes']}B "
+              f"segments={s['segments']} appended={s['appended']} drained={s['drained']} "
+              f"dropped={s['dropped']} retries={s['retries']} failed={s['failed_rows']} "
+              f"quarantined={s['quarantined']}/{s['quarantine_bytes']}B skipped={s['skipped']}")
+
+    def stats(self):
+        """Snapshot of spool size, lag and throughput counters"""
+        lag_bytes = self.lag_bytes()
+        with self._lock:
+            # Age of the oldest reading still waiting for the database
+            lag_seconds = 0.0
+            if lag_bytes and self._oldest_undrained is not None:
+                lag_seconds = max(0.0, time.time() - self._oldest_undrained)
+            return {
+                "lag_bytes": lag_bytes,
+                "lag_seconds": lag_seconds,
+                "disk_bytes": self._disk_bytes,
+                "max_bytes": self.max_bytes,
+                "segments": len(self._sizes),
+                "appended": self._appended,
+                "dropped": self._dropped,
+                "drained": self._drained,
+                "retries": self._retries,
+                "failed_batches": self._failed_batches,
+                "failed_rows": self._failed_rows,
+                "quarantined": self._quarantined,
+                "quarantine_bytes": self._quarantine_bytes,
+                "skipped": self._skipped,
+            }
@@ -0,0 +1,58 @@
+import unittest
+from datetime import datetime
+
+from anomaly import AnomalyDetector
+
+
+def row(value, device_id="temp-1", field="temperature"):
+    return {"device_id": device_id, "zone_id": 1, "building_id": "hyatt-place", "field": field, "value": value,
+            "timestamp": datetime.now()}
+
+
+class AnomalyDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.detector = self.make(warmup=1000)
+
+    def make(self, warmup):
+        return AnomalyDetector(limits={"temperature": (65, 85), "co2": (None, 1000)}, warmup=warmup,
+                               z_threshold=4, cooldown=300, hysteresis=0.02)
+
+    def kinds(self, rows):
+        return [alert["kind"] for alert in self.detector.detect(rows)]
+
+    def test_limit_alerts_with_hysteresis(self):
+        # Range 20, so back in range takes 84.6 or less
+        self.assertEqual(self.kinds([row(80.0), row(86.0)]), ["above_limit"])
+        self.assertEqual(self.kinds([row(84.8), row(85.5), row(84.7)]), [])
+        self.assertEqual(self.kinds([row(84.5)]), ["back_in_range"])
+        self.assertEqual(self.kinds([row(60.0), row(65.2), row(66.0)]), ["below_limit", "back_in_range"])
+
+    def test_one_sided_limits_use_a_fraction_of_the_limit(self):
+        self.assertEqual(self.kinds([row(1001.0, field="co2"), row(985.0, field="co2")]), ["above_limit"])
+        alerts = self.detector.detect([row(979.0, field="co2")])
+        self.assertEqual([(a["kind"], a["threshold"]) for a in alerts], [("back_in_range", None)])
+
+    def test_readings_of_one_series_in_a_batch_are_applied_in_order(self):
+        alerts = self.detector.detect([row(90.0), row(70.0, "temp-2"), row(70.0), row(90.0)])
+        self.assertEqual([(a["kind"], a["value"]) for a in alerts],
+                         [("above_limit", 90.0), ("back_in_range", 70.0), ("above_limit", 90.0)])
+
+    def test_zscore_after_warmup_with_cooldown(self):
+        self.detector = self.make(warmup=5)
+        self.assertEqual(self.kinds([row(70.0 + (i % 2) * 0.1) for i in range(10)]), [])
+        self.assertEqual(self.kinds([row(80.0)]), ["zscore"])
+        self.assertEqual(self.kinds([row(60.0 + 20 * (i % 2)) for i in range(4)]), ["below_limit", "back_in_range",
+                                                                                    "below_limit", "back_in_range"])
+
+    def test_unknown_and_missing_fields_do_not_break_the_batch(self):
+        alerts = self.detector.detect([row(1.0, field=None), row(5.0, field="pressure"), row(90.0)])
+        self.assertEqual([a["kind"] for a in alerts], ["above_limit"])
+        self.assertEqual(self.detector.stats()["series"], 3)
+
+    def test_nan_readings_are_ignored(self):
+        self.assertEqual(self.kinds([row(float("nan"))]), [])
+        self.assertEqual(self.detector.stats()["seen"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import asyncio
+import unittest
+from contextlib import contextmanager
+from datetime import datetime
+
+from async_bms import AsyncBuildingManagementSystem
+from ingest import RejectedRows
+
+
+def row(i, value=None):
+    return {"device_id": f"temp-{i}", "zone_id": 1, "timestamp": datetime(2025, 1, 1, 0, 0, i),
+            "field": "temperature", "value": 70.0 + i if value is None else value, "unit": "F",
+            "building_id": "hyatt-place"}
+
+
+class FakeDatabase:
+    """Committed rows, written through FakeSession transactions and savepoints"""
+
+    def __init__(self):
+        self.rows = []
+        self.transactions = 0
+
+
+class FakeSession:
+    """Sync session handed to run_sync: statements are kept until commit, savepoints undo theirs"""
+
+    def __init__(self, database):
+        self.database = database
+        self.pending = []
+
+    @contextmanager
+    def begin_nested(self):
+        savepoint = len(self.pending)
+        try:
+            yield
+        except Exception:
+            del self.pending[savepoint:]
+            raise
+
+    def commit(self):
+        self.database.rows.extend(self.pending)
+        self.database.transactions += 1
+
+
+class FakeAsyncSession:
+    def __init__(self, database):
+        self.sync_session = FakeSession(database)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def run_sync(self, fn, *args):
+        return fn(self.sync_session, *args)
+
+    async def commit(self):
+        self.sync_session.commit()
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.registered = []
+
+    def mark_registered(self, values):
+        self.registered.extend(values)
+
+
+def write_rows(session, rows, registry=None, stored=None):
+    """Stands in for the measurements INSERT; a non-numeric value fails the whole statement"""
+    session.pending.extend(row["device_id"] for row in rows)
+    if any(row["value"] == "bad" for row in rows):
+        raise ValueError("invalid input syntax for type double precision: \"bad\"")
+    return [{"id": row["device_id"], "zone_id": 1, "building_id": "hyatt-place"} for row in rows]
+
+
+class AsyncWriteTest(unittest.TestCase):
+    def setUp(self):
+        # No broker or Postgres: only the write path, with the database faked
+        self.database = FakeDatabase()
+        self.bms = AsyncBuildingManagementSystem.__new__(AsyncBuildingManagementSystem)
+        self.bms.cleaner = self.bms.deadband = self.bms.latest = None
+        self.bms.registry = FakeRegistry()
+        self.bms.AsyncSessionFactory = lambda: FakeAsyncSession(self.database)
+        self.bms.write_rows = write_rows
+        self.bms.flushes = self.bms.flushed_rows = self.bms.failed_rows = 0
+        self.bms.total_flush_latency = self.bms.max_flush_latency = 0.0
+        self.bms._inflight_count = 0
+
+    def test_invalid_row_is_rejected_and_the_rest_stored(self):
+        batch = [row(0), row(1), row(2, "bad"), row(3), row(4)]
+        with self.assertRaises(RejectedRows) as caught:
+            asyncio.run(self.bms.write_batch_async(batch))
+        self.assertEqual([r["device_id"] for r in caught.exception.rows], ["temp-2"])
+        self.assertEqual(self.database.rows, ["temp-0", "temp-1", "temp-3", "temp-4"])
+        self.assertNotIn("temp-2", [d["id"] for d in self.bms.registry.registered])
+
+    def test_flush_counts_only_the_invalid_row_as_failed(self):
+        async def flush(batch):
+            self.bms._inflight = asyncio.Semaphore(1)
+            await self.bms._inflight.acquire()
+            self.bms._inflight_count += 1
+            await self.bms._flush(batch)
+
+        asyncio.run(flush([row(0), row(1, "bad"), row(2)]))
+        self.assertEqual((self.bms.flushed_rows, self.bms.failed_rows), (2, 1))
+        self.assertEqual(self.database.rows, ["temp-0", "temp-2"])
+
+    def test_valid_batch_is_written_once(self):
+        self.assertEqual(asyncio.run(self.bms.write_batch_async([row(0), row(1)])), 2)
+        self.assertEqual((self.database.rows, self.database.transactions), (["temp-0", "temp-1"], 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
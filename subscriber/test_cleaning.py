@@ -0,0 +1,51 @@
+import unittest
+from datetime import datetime, timedelta
+
+from cleaning import BatchCleaner
+
+
+def row(value, device_id="temp-1", field="temperature", timestamp=None):
+    return {"device_id": device_id, "field": field, "value": value, "timestamp": timestamp or datetime.now()}
+
+
+class BatchCleanerTest(unittest.TestCase):
+    def setUp(self):
+        self.cleaner = BatchCleaner(limits={"temperature": (65, 85)}, window=3)
+
+    def test_out_of_range_and_null_use_the_rolling_median(self):
+        cleaned = self.cleaner.clean([row(70.0), row(72.0), row(74.0), row(500.0), row(float("nan"))])
+        self.assertEqual([r["value"] for r in cleaned], [70.0, 72.0, 74.0, 72.0, 73.0])
+        stats = self.cleaner.stats()
+        self.assertEqual((stats["out_of_range"], stats["null"], stats["no_fallback"]), (1, 1, 0))
+
+    def test_history_carries_over_between_batches(self):
+        self.cleaner.clean([row(70.0), row(80.0)])
+        [cleaned] = self.cleaner.clean([row(10.0)])
+        self.assertEqual(cleaned["value"], 75.0)
+
+    def test_readings_without_fallback_are_dropped(self):
+        self.assertEqual(self.cleaner.clean([row(float("nan"))]), [])
+        self.assertEqual(self.cleaner.stats()["no_fallback"], 1)
+
+    def test_series_are_kept_apart(self):
+        self.cleaner.clean([row(70.0, "temp-1"), row(80.0, "temp-2")])
+        cleaned = self.cleaner.clean([row(1.0, "temp-1"), row(1.0, "temp-2")])
+        self.assertEqual([r["value"] for r in cleaned], [70.0, 80.0])
+
+    def test_missing_and_unknown_fields_do_not_break_the_batch(self):
+        # np.unique over an object array raised TypeError when a field was None
+        cleaned = self.cleaner.clean([row(70.0), row(5.0, field=None), row(1e6, field="pressure")])
+        self.assertEqual([r["value"] for r in cleaned], [70.0, 5.0, 1e6])
+
+    def test_timestamps_out_of_bounds_are_replaced(self):
+        future = datetime.now() + timedelta(days=1)
+        stale = datetime.now() - timedelta(days=30)
+        cleaned = self.cleaner.clean([row(70.0, timestamp=future), row(70.0, timestamp=stale)])
+        for reading in cleaned:
+            self.assertLess(abs(reading["timestamp"] - datetime.now()), timedelta(minutes=1))
+        stats = self.cleaner.stats()
+        self.assertEqual((stats["timestamp_future"], stats["timestamp_stale"]), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from datetime import datetime, timedelta
+
+from db_models import ZoneRollup
+from deadband import DeadbandFilter
+from rollups import RESOLUTIONS, _sum_count, backfill_rollups
+
+START = datetime(2025, 1, 1)
+
+
+def row(seconds, value, device_id="temp-1", field="temperature"):
+    return {"device_id": device_id, "field": field, "value": value, "timestamp": START + timedelta(seconds=seconds)}
+
+
+class DeadbandFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.deadband = DeadbandFilter(deadbands={"temperature": 0.5}, default=0, max_silence=60)
+
+    def values(self, rows):
+        return [r["value"] for r in self.deadband.filter(rows)]
+
+    def test_only_changes_beyond_the_deadband_are_stored(self):
+        self.assertEqual(self.values([row(0, 70.0), row(1, 70.3), row(2, 70.4), row(3, 70.6), row(4, 70.9)]),
+                         [70.0, 70.6])
+        stats = self.deadband.stats()
+        self.assertEqual((stats["seen"], stats["stored"], stats["suppressed"]), (5, 2, 3))
+
+    def test_heartbeat_after_max_silence(self):
+        self.assertEqual(self.values([row(0, 70.0), row(30, 70.0), row(60, 70.0)]), [70.0, 70.0])
+        self.assertEqual(self.deadband.stats()["heartbeat"], 1)
+
+    def test_out_of_order_readings_are_kept_without_moving_the_state(self):
+        self.assertEqual(self.values([row(10, 70.0), row(5, 70.0), row(11, 70.1)]), [70.0, 70.0])
+        self.assertEqual(self.deadband.stats()["out_of_order"], 1)
+
+    def test_series_are_kept_apart(self):
+        self.assertEqual(self.values([row(0, 70.0), row(0, 70.0, "temp-2"), row(0, 40.0, field="humidity")]),
+                         [70.0, 70.0, 40.0])
+
+    def test_forget_stores_the_next_reading(self):
+        self.deadband.filter([row(0, 70.0)])
+        self.deadband.forget([row(0, 70.0)])
+        self.assertEqual(self.values([row(1, 70.0)]), [70.0])
+
+
+class FakeQuery:
+    def __init__(self, queries):
+        self.queries = queries
+
+    def filter(self, *conditions):
+        # Bound values of the resolution and bucket_start conditions, in order
+        self.queries.append([c.right.value for c in conditions if hasattr(c.right, "value")])
+        return self
+
+    def one(self):
+        return 0.0, 0
+
+
+class FakeSession:
+    def __init__(self):
+        self.queries = []
+
+    def query(self, *columns):
+        return FakeQuery(self.queries)
+
+
+class RawQuery:
+    def __init__(self):
+        self.used = False
+
+    def filter(self, *conditions):
+        self.used = True
+        return self
+
+    def one(self):
+        return 0.0, 0
+
+
+class SumCountEdgesTest(unittest.TestCase):
+    """Under the deadband filter raw rows are incomplete; averages must not read them"""
+
+    def sum_count(self, start, end, raw_complete):
+        session, raw_query = FakeSession(), RawQuery()
+        _sum_count(session, ZoneRollup, ZoneRollup.zone_id == 1, raw_query, start, end, True,
+                   list(reversed(list(RESOLUTIONS))), raw_complete)
+        return session.queries, raw_query.used
+
+    def test_partial_minutes_come_from_raw_rows_by_default(self):
+        queries, raw_used = self.sum_count(START + timedelta(seconds=30), START + timedelta(minutes=5, seconds=10), True)
+        self.assertTrue(raw_used)
+        self.assertEqual(queries, [["1m", 1, START + timedelta(minutes=1), START + timedelta(minutes=5)]])
+
+    def test_partial_minutes_come_from_overlapping_rollups_without_raw_rows(self):
+        queries, raw_used = self.sum_count(START + timedelta(seconds=30), START + timedelta(minutes=5, seconds=10), False)
+        self.assertFalse(raw_used)
+        self.assertEqual(queries, [
+            ["1m", 1, START + timedelta(minutes=1), START + timedelta(minutes=5)],
+            ["1m", 1, START, START + timedelta(minutes=1)],
+            ["1m", 1, START + timedelta(minutes=5), START + timedelta(minutes=5, seconds=10)],
+        ])
+
+    def test_range_inside_one_minute(self):
+        queries, raw_used = self.sum_count(START + timedelta(seconds=10), START + timedelta(seconds=20), False)
+        self.assertFalse(raw_used)
+        self.assertEqual(queries, [["1m", 1, START, START + timedelta(seconds=20)]])
+
+    def test_backfill_is_refused(self):
+        # Rebuilding from change points would overwrite exact rollups with undercounts; no engine is touched
+        with self.assertRaises(ValueError):
+            backfill_rollups(None, START, START + timedelta(days=1), deadband_filter=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
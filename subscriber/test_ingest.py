@@ -0,0 +1,74 @@
+import time
+import unittest
+
+from ingest import BatchWriter, RejectedRows, isolate_failures
+
+
+class TransientError(Exception):
+    pass
+
+
+class IsolateFailuresTest(unittest.TestCase):
+    def test_stores_everything_but_the_bad_rows(self):
+        written = []
+
+        def write(chunk):
+            if any(row < 0 for row in chunk):
+                raise ValueError("negative")
+            written.extend(chunk)
+
+        rejected = []
+        failed, error = isolate_failures(write, [1, 2, -3, 4, 5, -6, 7], reject=lambda row, e: rejected.append(row))
+        self.assertEqual(failed, [-3, -6])
+        self.assertEqual(rejected, [-3, -6])
+        self.assertIsInstance(error, ValueError)
+        self.assertEqual(sorted(written), [1, 2, 4, 5, 7])
+
+    def test_transient_errors_are_not_split(self):
+        calls = []
+
+        def write(chunk):
+            calls.append(chunk)
+            raise TransientError()
+
+        with self.assertRaises(TransientError):
+            isolate_failures(write, [1, 2, 3, 4], transient=(TransientError,))
+        self.assertEqual(calls, [[1, 2, 3, 4]])
+
+
+class BatchWriterTest(unittest.TestCase):
+    def test_rejected_rows_count_as_partial_failure(self):
+        def flush(batch):
+            raise RejectedRows(batch[:1], ValueError("bad"))
+
+        writer = BatchWriter(flush, batch_size=3, flush_interval=0.05, stats_interval=0)
+        writer.start()
+        for row in range(3):
+            writer.put(row)
+        writer.stop()
+        stats = writer.stats()
+        self.assertEqual(stats["flushed_rows"], 2)
+        self.assertEqual(stats["failed_rows"], 1)
+        self.assertEqual(stats["failed_flushes"], 0)
+
+    def test_drop_oldest_is_the_default(self):
+        writer = BatchWriter(lambda batch: None, max_queue=2, stats_interval=0)
+        for row in range(3):
+            self.assertTrue(writer.put(row))
+        self.assertEqual(writer.stats()["dropped"], 1)
+        self.assertEqual([writer._queue.get_nowait() for _ in range(2)], [1, 2])
+
+    def test_block_waits_once_while_the_queue_stays_full(self):
+        writer = BatchWriter(lambda batch: None, max_queue=1, backpressure="block", put_timeout=0.2,
+                             stats_interval=0)
+        writer.put(0)
+        start = time.monotonic()
+        self.assertFalse(writer.put(1))
+        self.assertFalse(writer.put(2))
+        self.assertFalse(writer.put(3))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(writer.stats()["dropped"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
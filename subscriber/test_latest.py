@@ -0,0 +1,52 @@
+import unittest
+from datetime import datetime, timedelta
+
+from latest import LatestState
+
+START = datetime(2025, 1, 1)
+
+
+def row(device_id, seconds, value=70.0, zone_id=1, building_id="hyatt-place", field="temperature"):
+    return {"device_id": device_id, "field": field, "value": value, "unit": "F", "zone_id": zone_id,
+            "building_id": building_id, "timestamp": START + timedelta(seconds=seconds)}
+
+
+def devices(rows):
+    return sorted((r["device_id"], r["value"]) for r in rows)
+
+
+class LatestStateTest(unittest.TestCase):
+    def setUp(self):
+        self.latest = LatestState()
+
+    def test_merge_returns_one_advancing_row_per_series(self):
+        advanced = self.latest.merge([row("temp-1", 1, 70.0), row("temp-1", 2, 71.0), row("temp-2", 1, 72.0)])
+        self.assertEqual(devices(advanced), [("temp-1", 71.0), ("temp-2", 72.0)])
+        self.assertEqual(self.latest.merge([row("temp-1", 0, 60.0)]), [])
+
+    def test_zone_and_building_views(self):
+        self.latest.merge([row("temp-1", 1), row("temp-2", 1, zone_id=2), row("temp-3", 1, zone_id=None),
+                           row("temp-9", 1, zone_id=9, building_id="annex")])
+        self.assertEqual(devices(self.latest.zone(1)), [("temp-1", 70.0)])
+        self.assertEqual(devices(self.latest.building("hyatt-place")),
+                         [("temp-1", 70.0), ("temp-2", 70.0), ("temp-3", 70.0)])
+        self.assertEqual(self.latest.zone(3), [])
+
+    def test_a_device_moving_zone_leaves_the_old_one(self):
+        self.latest.merge([row("temp-1", 1, zone_id=None)])
+        self.latest.merge([row("temp-1", 2, 71.0, zone_id=4)])
+        self.assertEqual(self.latest.zone(None), [])
+        self.assertEqual(devices(self.latest.zone(4)), [("temp-1", 71.0)])
+        self.assertEqual(len(self.latest.building("hyatt-place")), 1)
+
+    def test_forget_drops_the_series_from_every_view(self):
+        self.latest.merge([row("temp-1", 1), row("temp-2", 1)])
+        self.latest.forget([row("temp-1", 1)])
+        self.assertEqual(devices(self.latest.zone(1)), [("temp-2", 70.0)])
+        self.assertEqual(devices(self.latest.building("hyatt-place")), [("temp-2", 70.0)])
+        self.assertEqual(devices(self.latest.merge([row("temp-1", 0, 60.0)])), [("temp-1", 60.0)])
+        self.assertEqual(self.latest.stats(), {"series": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+from payloads import STRUCT_HEADER, STRUCT_MAGIC, STRUCT_READING, STRUCT_VERSION, decode_readings, msgpack
+
+TIMESTAMP_MS = 1700000000000
+
+
+def message(topic, payload, content_type=None):
+    properties = SimpleNamespace(ContentType=content_type) if content_type else None
+    return SimpleNamespace(topic=topic, payload=payload, properties=properties)
+
+
+def struct_payload(records):
+    payload = bytearray(STRUCT_HEADER.pack(STRUCT_MAGIC, STRUCT_VERSION, len(records)))
+    for device_id, zone_id, field_code, unit_code, value, timestamp_ms in records:
+        encoded = device_id.encode()
+        payload += bytes([len(encoded)]) + encoded
+        payload += STRUCT_READING.pack(zone_id, field_code, unit_code, value, timestamp_ms)
+    return bytes(payload)
+
+
+class DecodeReadingsTest(unittest.TestCase):
+    def test_single_json_reading(self):
+        reading = {"device_id": "temp-1", "zone_id": 1, "reading": 70.5, "field": "temperature", "unit": "F",
+                   "timestamp": "2025-01-01T00:00:00"}
+        self.assertEqual(decode_readings(message("hyatt-place/sensors/zone1/temperature", json.dumps(reading))),
+                         [reading])
+
+    def test_json_envelope_with_millis(self):
+        payload = json.dumps({"readings": [{"device_id": "temp-1", "timestamp_ms": TIMESTAMP_MS}]})
+        [reading] = decode_readings(message("hyatt-place/sensors/batch/json", payload))
+        self.assertEqual(reading["timestamp"], datetime.fromtimestamp(TIMESTAMP_MS / 1000.0))
+
+    def test_struct_drops_unknown_codes(self):
+        payload = struct_payload([
+            ("temp-1", 1, 1, 1, 70.5, TIMESTAMP_MS),
+            ("new-1", 1, 99, 1, 1.0, TIMESTAMP_MS),  # field code from a newer publisher
+            ("hum-1", 2, 2, 99, 45.0, TIMESTAMP_MS),  # unknown unit code
+            ("co2-1", 3, 3, 3, 800.0, TIMESTAMP_MS),
+        ])
+        readings = decode_readings(message("hyatt-place/sensors/batch", payload, "application/vnd.bms.readings"))
+        self.assertEqual([(r["device_id"], r["field"], r["unit"]) for r in readings],
+                         [("temp-1", "temperature", "F"), ("co2-1", "co2", "ppm")])
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_drops_unknown_codes(self):
+        payload = msgpack.packb({"r": [["temp-1", 1, 1, 1, 70.5, TIMESTAMP_MS], ["x-1", 1, 7, 1, 1.0, TIMESTAMP_MS]]})
+        readings = decode_readings(message("hyatt-place/sensors/batch/msgpack", payload))
+        self.assertEqual([r["device_id"] for r in readings], ["temp-1"])
+        self.assertEqual(readings[0]["reading"], 70.5)
+
+    def test_unsupported_content_type(self):
+        with self.assertRaises(ValueError):
+            decode_readings(message("hyatt-place/sensors/batch", b"", "text/plain"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+
+from ingest import RejectedRows
+from spool import FRAME_HEADER, POSITION_KEY, QUARANTINE_DIR, Spool, decode_row
+
+
+class Unavailable(Exception):
+    pass
+
+
+def row(i):
+    return {"device_id": f"temp-{i}", "zone_id": 1, "timestamp": datetime(2025, 1, 1, 0, 0, i % 60),
+            "field": "temperature", "value": 70.0 + i, "unit": "F", "building_id": "hyatt-place"}
+
+
+class FakeDatabase:
+    """flush_fn storing rows and the spool position together, like BMS.write_rows"""
+
+    def __init__(self, fail=None):
+        self.rows = []
+        self.position = None
+        self.fail = fail  # called with each batch; may raise
+        self.lock = threading.Lock()
+
+    def write(self, rows, reject=None):
+        with self.lock:
+            if self.fail is not None:
+                self.fail(self, rows, reject)
+            self.store(rows)
+
+    def store(self, rows):
+        self.rows.extend(r["device_id"] for r in rows)
+        self.position = max(r[POSITION_KEY] for r in rows)[1:]
+
+    def stored_position(self, spool_id):
+        return self.position
+
+
+def read_frames(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    rows, position = [], 0
+    while position < len(data):
+        length, _, _ = FRAME_HEADER.unpack_from(data, position)
+        start = position + FRAME_HEADER.size
+        rows.append(decode_row(data[start:start + length]))
+        position = start + length
+    return rows
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def spool(self, database, **kwargs):
+        options = dict(batch_size=10, fsync_interval=0.01, stats_interval=0, retry_on=(Unavailable,),
+                       max_backoff=0.05, stored_position=database.stored_position)
+        options.update(kwargs)
+        return Spool(self.directory, database.write, **options)
+
+    def drain(self, spool, count):
+        spool.start()
+        for i in range(count):
+            spool.put(row(i))
+        spool.stop(timeout=5)
+
+    def test_rows_are_drained_in_order_with_positions(self):
+        database = FakeDatabase()
+        self.drain(self.spool(database), 25)
+        self.assertEqual(database.rows, [f"temp-{i}" for i in range(25)])
+        self.assertEqual(database.position[1], os.path.getsize(os.path.join(self.directory, "000000000001.seg")))
+
+    def test_torn_tail_is_skipped_after_a_restart(self):
+        database = FakeDatabase()
+        spool = self.spool(database)
+        for i in range(3):
+            spool.put(row(i))
+        spool.sync()
+        spool._file.write(FRAME_HEADER.pack(100, 0, 0.0) + b"torn")  # crash in the middle of a record
+        spool._file.close()
+
+        self.drain(self.spool(database), 0)
+        self.assertEqual(database.rows, ["temp-0", "temp-1", "temp-2"])
+
+    def test_rejected_rows_are_quarantined(self):
+        def fail(database, rows, reject):
+            bad = [r for r in rows if r["device_id"] == "temp-3"]
+            if bad:
+                database.store([r for r in rows if r not in bad])
+                reject(bad[0], ValueError("bad row"))
+                raise RejectedRows(bad, ValueError("bad row"))
+
+        database = FakeDatabase(fail)
+        spool = self.spool(database)
+        self.drain(spool, 6)
+        self.assertEqual(database.rows, ["temp-0", "temp-1", "temp-2", "temp-4", "temp-5"])
+        [name] = os.listdir(os.path.join(self.directory, QUARANTINE_DIR))
+        quarantined = read_frames(os.path.join(self.directory, QUARANTINE_DIR, name))
+        self.assertEqual([r["device_id"] for r in quarantined], ["temp-3"])
+        self.assertEqual(spool.stats()["quarantined"], 1)
+
+    def test_quarantined_bytes_count_against_max_bytes(self):
+        def fail(database, rows, reject):
+            raise KeyError("bug")
+
+        spool = self.spool(FakeDatabase(fail))
+        self.drain(spool, 4)
+        quarantine_bytes = spool.stats()["quarantine_bytes"]
+        self.assertGreater(quarantine_bytes, 0)
+
+        # After a restart the quarantine still counts, and leaves no room for new readings
+        spool = self.spool(FakeDatabase(), max_bytes=quarantine_bytes)
+        self.assertEqual(spool.stats()["quarantine_bytes"], quarantine_bytes)
+        self.assertFalse(spool.put(row(9)))
+        self.assertEqual(spool.stats()["dropped"], 1)
+
+    def test_unexpected_errors_quarantine_the_batch(self):
+        def fail(database, rows, reject):
+            raise KeyError("bug")
+
+        spool = self.spool(FakeDatabase(fail))
+        self.drain(spool, 4)
+        stats = spool.stats()
+        self.assertEqual((stats["failed_batches"], stats["quarantined"], stats["lag_bytes"]), (1, 4, 0))
+
+    def test_retry_skips_rows_committed_before_the_failure(self):
+        attempts = []
+
+        def fail(database, rows, reject):
+            attempts.append([r["device_id"] for r in rows])
+            if len(attempts) == 1:
+                # The first half commits, then the connection drops
+                database.store(rows[:len(rows) // 2])
+                raise Unavailable()
+
+        database = FakeDatabase(fail)
+        spool = self.spool(database)
+        for i in range(6):
+            spool.put(row(i))
+        spool.sync()
+        self.drain(spool, 0)
+        self.assertEqual(database.rows, [f"temp-{i}" for i in range(6)])
+        self.assertEqual(attempts[1], ["temp-3", "temp-4", "temp-5"])
+        self.assertEqual(spool.stats()["skipped"], 3)
+
+    def test_restart_resumes_from_the_stored_position(self):
+        database = FakeDatabase()
+        spool = self.spool(database)
+        for i in range(5):
+            spool.put(row(i))
+        spool.sync()
+        spool._file.close()
+        # Rows 0-2 were committed but the file checkpoint was never written (crash)
+        rows, _, _ = spool._read_batch()
+        database.store(rows[:3])
+
+        self.drain(self.spool(database), 0)
+        self.assertEqual(database.rows, [f"temp-{i}" for i in range(5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
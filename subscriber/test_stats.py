@@ -0,0 +1,52 @@
+import os
+import unittest
+
+from stats import SampledLog, StatsCollector
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+COPIES = [os.path.join(HERE, "..", service, "stats.py") for service in ("frontend", "publishers")]
+
+
+class StatsCollectorTest(unittest.TestCase):
+    def test_labels_share_a_family_and_non_numeric_values_are_skipped(self):
+        collector = StatsCollector()
+        collector.register("bms_batch", lambda: {"flushed": 3, "name": "a"}, counters=("flushed",),
+                           labels={"building": "a"})
+        collector.register("bms_batch", lambda: {"flushed": 5, "name": "b"}, counters=("flushed",),
+                           labels={"building": "b"})
+        [family] = collector.collect()
+        self.assertEqual(family.type, "counter")
+        self.assertEqual(sorted((s.labels["building"], s.value) for s in family.samples if s.name.endswith("_total")),
+                         [("a", 3), ("b", 5)])
+
+    def test_failing_sources_are_skipped(self):
+        collector = StatsCollector()
+        collector.register("broken", lambda: 1 / 0)
+        collector.register("queue", lambda: {"depth": 2})
+        self.assertEqual([family.name for family in collector.collect()], ["queue_depth"])
+
+
+class SampledLogTest(unittest.TestCase):
+    def test_suppressed_lines_are_counted(self):
+        lines = []
+        log = SampledLog(lines.append, interval=60)
+        for i in range(3):
+            log("stored", "Stored {}", i)
+        log("other", "Other")
+        log._state["stored"] = (float("-inf"), log._state["stored"][1])
+        log("stored", "Stored {}", 3)
+        self.assertEqual(lines, ["Stored 0", "Other", "Stored 3 (+2 similar)"])
+
+
+class CopiesTest(unittest.TestCase):
+    @unittest.skipUnless(all(os.path.exists(path) for path in COPIES), "service directories not present")
+    def test_service_copies_are_identical(self):
+        with open(os.path.join(HERE, "stats.py")) as f:
+            expected = f.read()
+        for path in COPIES:
+            with open(path) as f:
+                self.assertEqual(f.read(), expected, f"{os.path.normpath(path)} differs from subscriber/stats.py")
+
+
+if __name__ == "__main__":
+    unittest.main()